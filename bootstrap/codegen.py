@@ -1,5 +1,12 @@
+import json
+import platform
 from llvmlite import ir
-from n_parser import StructDef, EnumDef, ImplDef, FunctionDef, VariableExpr, UnaryExpr, MemberAccess, MethodCall, FloatLiteral, IndexAccess, CharLiteral, ExternBlock
+from n_parser import StructDef, EnumDef, ImplDef, FunctionDef, VariableExpr, UnaryExpr, MemberAccess, MethodCall, FloatLiteral, IndexAccess, CharLiteral, ExternBlock, LambdaExpr
+from n_parser import VarDecl, Assignment, IfStmt, ReturnStmt, BlockStmt, BinaryExpr, CallExpr, IntegerLiteral, BooleanLiteral
+
+class _Divergent(Exception):
+    # A kernel construct the SIMD lowering doesn't handle (see _emit_spmd_launcher)
+    pass
 
 class CodeGen:
     def __init__(
@@ -8,12 +15,16 @@ class CodeGen:
         emit_kernels_only: bool = False,
         spirv_env: str = "opencl",
         spirv_local_size: str = "1,1,1",
+        track_alloc: str = None,
+        kernel_lanes: int = 8,
     ):
         self.module = ir.Module(name="nexalang_module")
         self.target = target
         self.emit_kernels_only = emit_kernels_only
         self.spirv_env = spirv_env
         self.spirv_local_size = spirv_local_size
+        self.track_alloc = track_alloc  # --track-alloc report path, or None
+        self.kernel_lanes = kernel_lanes  # global ids per SIMD step of a CPU kernel launcher
         self._kernel_function_names = set()
         self._vulkan_kernel_arg_globals = {}  # (kernel_name, arg_name) -> ir.GlobalVariable
         self._vulkan_buffer_args = {}  # (kernel_name, arg_name) -> (data_gv, len_gv)
@@ -32,6 +43,16 @@ class CodeGen:
         self.malloc = None
         self.free = None
         self.realloc = None
+        self._alloc_hooks = {}
+        self._global_allocator = None
+        self._track = {}  # counting wrappers (--track-alloc)
+        self._coro = None  # async fn being lowered: frame, dispatch switch, resume points
+        self._uses_tasks = False
+        self._uses_threads = False
+        self._uses_par = False
+        self._uses_numbers = False
+        self._uses_stdout = False
+        self._alloc_sites = {}  # (file:line, kind) -> site index
         self.memcpy = None
         self.fopen = None
         self.fseek = None
@@ -48,6 +69,23 @@ class CodeGen:
         self.enum_payloads = {} # name -> {variant: payload_type}
         self.enum_definitions = {} # name -> (ir_struct_type, payload_size)
         self.scopes = []
+        # Stack slots whose value must not be auto-dropped: parameters, moved-from
+        # locals and shallow copies (`let x = *p;`, `let x = v.field;`).
+        self._unowned_slots = set()
+        # Locals with a destructor: slot -> i1 slot saying whether it still
+        # owns its value, so moves on one branch only skip that branch's drop
+        self._drop_flags = {}
+        # Temporaries of the statement being emitted, dropped at its end:
+        # (slot, type name)
+        self._stmt_temps = []
+        # Closure monomorphization: fn-typed slots bound to a known lambda, and
+        # per-lambda clones of functions taking closure parameters.
+        self._function_nodes = {} # name -> FunctionDef
+        self._closure_targets = {} # slot -> lambda function name
+        self._specializations = {} # (func name, bindings) -> ir.Function
+        self._pending_specializations = [] # [(FunctionDef, spec name, {param: lambda})]
+        self._gpu_launchers = {} # kernel name -> (CPU launcher, smallest chunk of ids)
+        self._spmd = None # kernel step being vectorized: builder, lane mask, scopes
         
         self._declare_intrinsics()
         self.loop_stack = [] # Stack of (continue_block, break_block, scope_depth, label)
@@ -60,10 +98,17 @@ class CodeGen:
             self._declare_printf()
             self._declare_exit()
             self._declare_malloc_free()
+            if self.track_alloc:
+                self._declare_alloc_tracking()
             self._declare_memcpy()
             self._declare_fileio()
             self._declare_gpu_state()
             self._declare_arena()
+            self._declare_task_runtime()
+            self._declare_thread_runtime()
+            self._declare_par_runtime()
+            self._declare_number_runtime()
+            self._declare_stdout_runtime()
 
     def _declare_fileio(self):
         # Minimal libc FILE* I/O for self-hosting bootstrap helpers.
@@ -167,16 +212,10 @@ class CodeGen:
         return out
 
     def _declare_gpu_state(self):
-        # Mock GPU execution state for bootstrap runtime dispatch (CPU loop).
-        # When target=spirv, we also provide a placeholder builtin global that
-        # external SPIR-V translation tools can optionally map.
+        # Native targets run kernels on the CPU (__nexa_gpu_launch); for
+        # target=spirv we provide a placeholder builtin global that external
+        # SPIR-V translation tools can optionally map.
         i32 = ir.IntType(32)
-        # Only create the CPU-mock global when we are not emitting kernels-only SPIR-V.
-        if not (self.target == "spirv" and self.emit_kernels_only):
-            gv = ir.GlobalVariable(self.module, i32, name="__gpu_global_id")
-            gv.linkage = "internal"
-            gv.initializer = ir.Constant(i32, 0)
-            self.gpu_global_id = gv
 
         # SPIR-V builtin (LLVM SPIR-V backend convention):
         # Declare `__spirv_BuiltInGlobalInvocationId` as v3i32 in addrspace(5).
@@ -233,102 +272,3160 @@ class CodeGen:
         self.coro_done = ir.Function(self.module, ir.FunctionType(i1, [void_ptr]), name="llvm.coro.done")
         self.coro_promise = ir.Function(self.module, ir.FunctionType(void_ptr, [void_ptr, i32, i1]), name="llvm.coro.promise")
 
+    # Arena chunk layout: [prev chunk: i8*][pad to 16][data...]. Large
+    # allocations get their own malloc with the same 16-byte link header.
+    ARENA_HEADER = 16
+    ARENA_FIRST_CHUNK = 4096
+    ARENA_MAX_CHUNK = 1 << 20
+    ARENA_LARGE = 1 << 16
+
     def _declare_arena(self):
-        # struct Arena { chunk: i8*, offset: i32, capacity: i32 }
+        # struct Arena { chunk: i8*, offset: i64, capacity: i64, large: i8* }
+        # `chunk` is the newest chunk (older ones are linked through its
+        # header), `offset`/`capacity` are bytes within it, `large` links
+        # the allocations that bypassed the chunks.
         void_ptr = ir.IntType(8).as_pointer()
-        i32 = ir.IntType(32)
+        i64 = ir.IntType(64)
         arena_ty = self.module.context.get_identified_type("Arena")
-        arena_ty.set_body(void_ptr, i32, i32)
+        arena_ty.set_body(void_ptr, i64, i64, void_ptr)
         self.struct_types['Arena'] = arena_ty
-        self.struct_fields['Arena'] = {'chunk': 0, 'offset': 1, 'capacity': 2}
+        self.struct_fields['Arena'] = {'chunk': 0, 'offset': 1, 'capacity': 2, 'large': 3}
         self._define_arena_methods()
 
     def _define_arena_methods(self):
         void_ptr = ir.IntType(8).as_pointer()
+        i1 = ir.IntType(1)
         i32 = ir.IntType(32)
+        i64 = ir.IntType(64)
         arena_ty = self.struct_types['Arena']
+        arena_ptr_ty = arena_ty.as_pointer()
+        null = ir.Constant(void_ptr, None)
+        header = ir.Constant(i64, self.ARENA_HEADER)
+
+        def field(b, arena, idx):
+            return b.gep(arena, [ir.Constant(i32, 0), ir.Constant(i32, idx)])
+
+        def link(b, block):
+            # The i8** stored in a block's header
+            return b.bitcast(block, void_ptr.as_pointer())
+
+        def malloc64(b, size):
+            return b.call(self.malloc, [size])
+
+        # __nexa_arena_free_list(i8*): free a chain of linked blocks
+        free_list = ir.Function(self.module, ir.FunctionType(ir.VoidType(), [void_ptr]), name="__nexa_arena_free_list")
+        free_list.linkage = 'internal'
+        b = ir.IRBuilder(free_list.append_basic_block("entry"))
+        loop_bb = free_list.append_basic_block("loop")
+        body_bb = free_list.append_basic_block("body")
+        done_bb = free_list.append_basic_block("done")
+        entry_bb = b.block
+        b.branch(loop_bb)
+        b.position_at_end(loop_bb)
+        cur = b.phi(void_ptr)
+        cur.add_incoming(free_list.args[0], entry_bb)
+        b.cbranch(b.icmp_unsigned("==", cur, null), done_bb, body_bb)
+        b.position_at_end(body_bb)
+        nxt = b.load(link(b, cur))
+        b.call(self.free, [cur])
+        cur.add_incoming(nxt, body_bb)
+        b.branch(loop_bb)
+        b.position_at_end(done_bb)
+        b.ret_void()
 
         # 1. Arena_new() -> Arena
-        new_ty = ir.FunctionType(arena_ty, [])
-        new_func = ir.Function(self.module, new_ty, name="Arena_new")
-        bb = new_func.append_basic_block("entry")
-        b = ir.IRBuilder(bb)
-
-        size = ir.Constant(i32, 4096) # Default 4KB
-        chunk = b.call(self.malloc, [size])
-
-        # Build struct
+        new_func = ir.Function(self.module, ir.FunctionType(arena_ty, []), name="Arena_new")
+        b = ir.IRBuilder(new_func.append_basic_block("entry"))
+        size = ir.Constant(i64, self.ARENA_FIRST_CHUNK)
+        chunk = malloc64(b, size)
+        b.store(null, link(b, chunk))
         val = ir.Constant(arena_ty, ir.Undefined)
         val = b.insert_value(val, chunk, 0)
-        val = b.insert_value(val, ir.Constant(i32, 0), 1)
+        val = b.insert_value(val, header, 1)
         val = b.insert_value(val, size, 2)
+        val = b.insert_value(val, null, 3)
         b.ret(val)
 
-        # 2. Arena_drop(Arena) -> void
-        # Passed by Value or Pointer? Drop usually takes by Value if we consume it,
-        # but here we might want ref. Auto-Drop passes by Value if it's not a pointer?
-        # Codegen.emit_scope_drops currently loads the value `b.load(ptr)`.
-        # So it passes the STRUCT VALUE (Aggregate).
-        # LLVM handling of First Class Structs as args is fine.
-        drop_ty = ir.FunctionType(ir.VoidType(), [arena_ty])
-        drop_func = ir.Function(self.module, drop_ty, name="Arena_drop")
-        bb = drop_func.append_basic_block("entry")
-        b = ir.IRBuilder(bb)
-        arg = drop_func.args[0]
-        chunk = b.extract_value(arg, 0)
-        b.call(self.free, [chunk])
+        # 2. Arena_drop(Arena) -> void: one pass over both lists
+        # (emit_scope_drops passes the struct by value)
+        drop_func = ir.Function(self.module, ir.FunctionType(ir.VoidType(), [arena_ty]), name="Arena_drop")
+        b = ir.IRBuilder(drop_func.append_basic_block("entry"))
+        b.call(free_list, [b.extract_value(drop_func.args[0], 0)])
+        b.call(free_list, [b.extract_value(drop_func.args[0], 3)])
+        b.ret_void()
+
+        # 3. Arena_reset(Arena*) -> void: keep the newest (largest) chunk,
+        # release everything else and start bumping from its beginning.
+        reset_func = ir.Function(self.module, ir.FunctionType(ir.VoidType(), [arena_ptr_ty]), name="Arena_reset")
+        b = ir.IRBuilder(reset_func.append_basic_block("entry"))
+        arena = reset_func.args[0]
+        chunk = b.load(field(b, arena, 0))
+        prev_slot = link(b, chunk)
+        b.call(free_list, [b.load(prev_slot)])
+        b.store(null, prev_slot)
+        b.store(header, field(b, arena, 1))
+        large_slot = field(b, arena, 3)
+        b.call(free_list, [b.load(large_slot)])
+        b.store(null, large_slot)
         b.ret_void()
 
-        # 3. Arena_alloc(Arena*, i32) -> i8*
-        # Takes POINTER to Arena
-        alloc_ty = ir.FunctionType(void_ptr, [arena_ty.as_pointer(), i32])
-        alloc_func = ir.Function(self.module, alloc_ty, name="Arena_alloc")
-        bb = alloc_func.append_basic_block("entry")
-        b = ir.IRBuilder(bb)
+        # 4. __nexa_arena_grow(Arena*, i64 needed) -> i1: chain a new chunk
+        # of twice the current size (capped), or larger if `needed` is.
+        grow = ir.Function(self.module, ir.FunctionType(i1, [arena_ptr_ty, i64]), name="__nexa_arena_grow")
+        grow.linkage = 'internal'
+        b = ir.IRBuilder(grow.append_basic_block("entry"))
+        arena, needed = grow.args
+        cap = b.load(field(b, arena, 2))
+        doubled = b.mul(cap, ir.Constant(i64, 2))
+        max_chunk = ir.Constant(i64, self.ARENA_MAX_CHUNK)
+        new_cap = b.select(b.icmp_signed(">", doubled, max_chunk), max_chunk, doubled)
+        min_cap = b.add(needed, header)
+        new_cap = b.select(b.icmp_signed("<", new_cap, min_cap), min_cap, new_cap)
+        chunk = malloc64(b, new_cap)
+        with b.if_then(b.icmp_unsigned("==", chunk, null)):
+            b.ret(ir.Constant(i1, 0))
+        chunk_slot = field(b, arena, 0)
+        b.store(b.load(chunk_slot), link(b, chunk))
+        b.store(chunk, chunk_slot)
+        b.store(header, field(b, arena, 1))
+        b.store(new_cap, field(b, arena, 2))
+        b.ret(ir.Constant(i1, 1))
+
+        # 5. Arena_alloc_aligned(Arena*, i32 size, i32 align) -> i8*
+        # `align` must be a power of two. Returns null only if malloc fails.
+        aligned_func = ir.Function(self.module, ir.FunctionType(void_ptr, [arena_ptr_ty, i32, i32]), name="Arena_alloc_aligned")
+        b = ir.IRBuilder(aligned_func.append_basic_block("entry"))
+        arena = aligned_func.args[0]
+        req = b.sext(aligned_func.args[1], i64)
+        align = b.sext(aligned_func.args[2], i64)
+        large_bb = aligned_func.append_basic_block("large")
+        bump_bb = aligned_func.append_basic_block("bump")
+        grow_bb = aligned_func.append_basic_block("grow")
+        oom_bb = aligned_func.append_basic_block("oom")
+        is_large = b.and_(b.icmp_signed(">", req, ir.Constant(i64, self.ARENA_LARGE)),
+                          b.icmp_signed("<=", align, header))
+        b.cbranch(is_large, large_bb, bump_bb)
+
+        # Large: own block, linked for bulk free (malloc is 16-aligned)
+        b.position_at_end(large_bb)
+        block = malloc64(b, b.add(req, header))
+        with b.if_then(b.icmp_unsigned("==", block, null)):
+            b.ret(null)
+        large_slot = field(b, arena, 3)
+        b.store(b.load(large_slot), link(b, block))
+        b.store(block, large_slot)
+        b.ret(b.gep(block, [header]))
+
+        # Bump: round the cursor up to `align`, then check the chunk end
+        b.position_at_end(bump_bb)
+        chunk = b.load(field(b, arena, 0))
+        base = b.ptrtoint(chunk, i64)
+        cursor = b.add(base, b.load(field(b, arena, 1)))
+        mask = b.sub(align, ir.Constant(i64, 1))
+        start = b.and_(b.add(cursor, mask), b.not_(mask))
+        end = b.add(b.sub(start, base), req)
+        fits = b.icmp_signed("<=", end, b.load(field(b, arena, 2)))
+        with b.if_then(fits):
+            b.store(end, field(b, arena, 1))
+            b.ret(b.inttoptr(start, void_ptr))
+        b.branch(grow_bb)
+
+        b.position_at_end(grow_bb)
+        ok = b.call(grow, [arena, b.add(req, align)])
+        b.cbranch(ok, bump_bb, oom_bb)
+        b.position_at_end(oom_bb)
+        b.ret(null)
+
+        # 6. Arena_alloc(Arena*, i32) -> i8*: 8-byte aligned
+        alloc_func = ir.Function(self.module, ir.FunctionType(void_ptr, [arena_ptr_ty, i32]), name="Arena_alloc")
+        b = ir.IRBuilder(alloc_func.append_basic_block("entry"))
+        b.ret(b.call(aligned_func, [alloc_func.args[0], alloc_func.args[1], ir.Constant(i32, 8)]))
+
+    # Runtime allocator: blocks up to POOL_MAX_SMALL bytes come from
+    # per-thread free lists, one per power-of-two size class (16..2048).
+    # Every block has a 16-byte header: [next: i8*][class: i32][pad: i32];
+    # larger blocks are plain libc mallocs. Slabs are POOL_SLAB-aligned and
+    # recorded in a two-level bitmap (POOL_MAP_TOP entries indexed by
+    # address bits 32..46, each a bitmap of the 64 KiB granules below), so
+    # free/realloc tell pool blocks from libc ones without reading memory
+    # in front of a pointer they do not own.
+    POOL_CLASSES = 8
+    POOL_MAX_SMALL = 2048
+    POOL_SLAB = 65536
+    POOL_MAP_TOP = 1 << 15
+
+    def _declare_malloc_free(self):
+        # Allocation hooks used by all generated code (user malloc/free/
+        # realloc calls, Arena, fs::read_file, async state). Bodies are
+        # emitted in generate(): the pool allocator below, or forwarding to
+        # an @[global_allocator] type.
+        void_ptr = ir.IntType(8).as_pointer()
+        i64 = ir.IntType(64)
+        self.malloc = ir.Function(self.module, ir.FunctionType(void_ptr, [i64]), name="__nexa_alloc")
+        self.free = ir.Function(self.module, ir.FunctionType(ir.VoidType(), [void_ptr]), name="__nexa_free")
+        self.realloc = ir.Function(self.module, ir.FunctionType(void_ptr, [void_ptr, i64]), name="__nexa_realloc")
+        self._alloc_hooks = {'malloc': self.malloc, 'free': self.free, 'realloc': self.realloc}
+
+        # libc, used by the pool itself
+        self.libc_malloc = ir.Function(self.module, ir.FunctionType(void_ptr, [i64]), name="malloc")
+        self.libc_free = ir.Function(self.module, ir.FunctionType(ir.VoidType(), [void_ptr]), name="free")
+        self.libc_realloc = ir.Function(self.module, ir.FunctionType(void_ptr, [void_ptr, i64]), name="realloc")
+
+    def _find_global_allocator(self, ast):
+        for node in ast:
+            if isinstance(node, StructDef) and any(name == 'global_allocator' for name, _ in node.attrs):
+                return node.name
+        return None
+
+    def _find_static_method(self, struct_name, method):
+        for name in self.module.globals:
+            if name == f"{struct_name}_{method}" or name.startswith(f"{struct_name}_{method}__args__"):
+                return self.module.get_global(name)
+        raise Exception(f"@[global_allocator] type '{struct_name}' has no '{method}' function")
+
+    def _define_alloc_hooks(self, allocator):
+        if allocator is None:
+            self._define_pool_allocator()
+            return
+        # Forward each hook to the user's allocator, adapting int widths
+        for hook, method in ((self.malloc, 'alloc'), (self.free, 'free'), (self.realloc, 'realloc')):
+            target = self._find_static_method(allocator, method)
+            b = ir.IRBuilder(hook.append_basic_block("entry"))
+            args = []
+            for arg, expected in zip(hook.args, target.function_type.args):
+                if isinstance(expected, ir.IntType) and expected.width < arg.type.width:
+                    arg = b.trunc(arg, expected)
+                elif arg.type != expected:
+                    arg = b.bitcast(arg, expected)
+                args.append(arg)
+            res = b.call(target, args)
+            if isinstance(hook.function_type.return_type, ir.VoidType):
+                b.ret_void()
+            else:
+                b.ret(b.bitcast(res, hook.function_type.return_type))
+
+    def _define_pool_allocator(self):
+        void_ptr = ir.IntType(8).as_pointer()
+        i32 = ir.IntType(32)
+        i64 = ir.IntType(64)
+        c32 = lambda v: ir.Constant(i32, v)
+        c64 = lambda v: ir.Constant(i64, v)
+        null = ir.Constant(void_ptr, None)
+        header = c64(16)
+
+        # Per-thread cache: pthread key -> calloc'd [POOL_CLASSES x i8*] heads
+        key = ir.GlobalVariable(self.module, i32, name="__nexa_pool_key")
+        key.linkage = 'internal'
+        key.initializer = c32(0)
+        once = ir.GlobalVariable(self.module, i32, name="__nexa_pool_once")
+        once.linkage = 'internal'
+        once.initializer = c32(0)  # PTHREAD_ONCE_INIT
+        init_ty = ir.FunctionType(ir.VoidType(), [])
+        key_create = ir.Function(self.module, ir.FunctionType(i32, [i32.as_pointer(), ir.FunctionType(ir.VoidType(), [void_ptr]).as_pointer()]), name="pthread_key_create")
+        pthread_once = ir.Function(self.module, ir.FunctionType(i32, [i32.as_pointer(), init_ty.as_pointer()]), name="pthread_once")
+        getspecific = ir.Function(self.module, ir.FunctionType(void_ptr, [i32]), name="pthread_getspecific")
+        setspecific = ir.Function(self.module, ir.FunctionType(i32, [i32, void_ptr]), name="pthread_setspecific")
+        calloc = self._libc_function("calloc", void_ptr, [i64, i64])
+        ctlz = ir.Function(self.module, ir.FunctionType(i64, [i64, ir.IntType(1)]), name="llvm.ctlz.i64")
+
+        # Free lists of threads that have exited, one per class. A thread's
+        # lists are spliced in here at exit and taken whole by the next
+        # refill of that class on any thread.
+        orphans = ir.GlobalVariable(self.module, ir.ArrayType(void_ptr, self.POOL_CLASSES), name="__nexa_pool_orphans")
+        orphans.linkage = 'internal'
+        orphans.initializer = ir.Constant(orphans.type.pointee, None)
+        lock = ir.GlobalVariable(self.module, ir.ArrayType(ir.IntType(8), 64), name="__nexa_pool_lock")
+        lock.linkage = 'internal'
+        lock.align = 16
+        lock.initializer = ir.Constant(lock.type.pointee, None)  # PTHREAD_MUTEX_INITIALIZER
+        mutex_lock = self._libc_function("pthread_mutex_lock", i32, [void_ptr])
+        mutex_unlock = self._libc_function("pthread_mutex_unlock", i32, [void_ptr])
+        lock_ptr = lock.gep([c32(0), c32(0)])
+        slab_map = ir.GlobalVariable(self.module, ir.ArrayType(i64.as_pointer(), self.POOL_MAP_TOP), name="__nexa_pool_map")
+        slab_map.linkage = 'internal'
+        slab_map.initializer = ir.Constant(slab_map.type.pointee, None)
+        aligned_alloc = self._libc_function("aligned_alloc", void_ptr, [i64, i64])
+
+        def block_field(b, base, offset, ty):
+            return b.bitcast(b.gep(base, [c64(offset)]), ty.as_pointer())
+
+        def map_word(b, addr):
+            # (top index, bitmap word index, bit) of a slab granule
+            return (b.lshr(addr, c64(32)),
+                    b.and_(b.lshr(addr, c64(22)), c64(1023)),
+                    b.shl(c64(1), b.and_(b.lshr(addr, c64(16)), c64(63))))
+
+        # __nexa_pool_owns(i8*) -> bool: is ptr inside a slab? Lock-free;
+        # bits are only ever set, and a pointer into a slab reaches another
+        # thread only after the slab was recorded.
+        owns = ir.Function(self.module, ir.FunctionType(ir.IntType(1), [void_ptr]), name="__nexa_pool_owns")
+        owns.linkage = 'internal'
+        b = ir.IRBuilder(owns.append_basic_block("entry"))
+        top, word, bit = map_word(b, b.ptrtoint(owns.args[0], i64))
+        with b.if_then(b.icmp_unsigned(">=", top, c64(self.POOL_MAP_TOP))):
+            b.ret(ir.Constant(ir.IntType(1), 0))
+        words = b.load_atomic(b.gep(slab_map, [c64(0), top]), 'acquire', 8)
+        with b.if_then(b.icmp_unsigned("==", words, ir.Constant(words.type, None))):
+            b.ret(ir.Constant(ir.IntType(1), 0))
+        bits = b.load_atomic(b.gep(words, [word]), 'monotonic', 8)
+        b.ret(b.icmp_unsigned("!=", b.and_(bits, bit), c64(0)))
+
+        # __nexa_pool_thread_exit(heads): TLS destructor of the cache key
+        thread_exit = ir.Function(self.module, ir.FunctionType(ir.VoidType(), [void_ptr]), name="__nexa_pool_thread_exit")
+        thread_exit.linkage = 'internal'
+        b = ir.IRBuilder(thread_exit.append_basic_block("entry"))
+        heads = b.bitcast(thread_exit.args[0], void_ptr.as_pointer())
+        b.call(mutex_lock, [lock_ptr])
+        for c in range(self.POOL_CLASSES):
+            first = b.load(b.gep(heads, [c32(c)]))
+            with b.if_then(b.icmp_unsigned("!=", first, null)):
+                # walk to the tail, then link it in front of the orphans
+                walk_bb = b.append_basic_block(f"walk{c}")
+                found_bb = b.append_basic_block(f"spliced{c}")
+                pre_bb = b.block
+                b.branch(walk_bb)
+                b.position_at_end(walk_bb)
+                tail = b.phi(void_ptr)
+                tail.add_incoming(first, pre_bb)
+                nxt = b.load(block_field(b, tail, 0, void_ptr))
+                tail.add_incoming(nxt, walk_bb)
+                b.cbranch(b.icmp_unsigned("==", nxt, null), found_bb, walk_bb)
+                b.position_at_end(found_bb)
+                slot = orphans.gep([c32(0), c32(c)])
+                b.store(b.load(slot), block_field(b, tail, 0, void_ptr))
+                b.store(first, slot)
+        b.call(mutex_unlock, [lock_ptr])
+        b.call(self.libc_free, [thread_exit.args[0]])
+        b.ret_void()
 
-        arena_ptr = alloc_func.args[0]
-        req_size = alloc_func.args[1]
+        init = ir.Function(self.module, init_ty, name="__nexa_pool_init")
+        init.linkage = 'internal'
+        b = ir.IRBuilder(init.append_basic_block("entry"))
+        b.call(key_create, [key, thread_exit])
+        b.ret_void()
 
-        # Load offset, capacity, chunk
-        chunk_ptr = b.gep(arena_ptr, [ir.Constant(i32, 0), ir.Constant(i32, 0)])
-        offset_ptr = b.gep(arena_ptr, [ir.Constant(i32, 0), ir.Constant(i32, 1)])
-        cap_ptr = b.gep(arena_ptr, [ir.Constant(i32, 0), ir.Constant(i32, 2)])
+        cache = ir.Function(self.module, ir.FunctionType(void_ptr.as_pointer(), []), name="__nexa_pool_cache")
+        cache.linkage = 'internal'
+        b = ir.IRBuilder(cache.append_basic_block("entry"))
+        b.call(pthread_once, [once, init])
+        k = b.load(key)
+        heads = b.call(getspecific, [k])
+        with b.if_then(b.icmp_unsigned("==", heads, null)):
+            fresh = b.call(calloc, [c64(self.POOL_CLASSES), c64(8)])
+            b.call(setspecific, [k, fresh])
+            b.ret(b.bitcast(fresh, void_ptr.as_pointer()))
+        b.ret(b.bitcast(heads, void_ptr.as_pointer()))
+
+        # __nexa_pool_refill(i8** head, i32 class) -> i8*: adopt the
+        # orphaned blocks of the class if there are any, else carve one
+        # slab into blocks of the class; return the first, push the rest.
+        refill = ir.Function(self.module, ir.FunctionType(void_ptr, [void_ptr.as_pointer(), i32]), name="__nexa_pool_refill")
+        refill.linkage = 'internal'
+        b = ir.IRBuilder(refill.append_basic_block("entry"))
+        head, cls = refill.args
+        slot = b.gep(orphans, [c32(0), cls])
+        b.call(mutex_lock, [lock_ptr])
+        adopted = b.load(slot)
+        b.store(null, slot)
+        b.call(mutex_unlock, [lock_ptr])
+        with b.if_then(b.icmp_unsigned("!=", adopted, null)):
+            b.store(b.load(block_field(b, adopted, 0, void_ptr)), head)
+            b.ret(adopted)
+        block_size = b.add(b.shl(c64(16), b.zext(cls, i64)), header)
+        count = b.sdiv(c64(self.POOL_SLAB), block_size)
+        slab = b.call(aligned_alloc, [c64(self.POOL_SLAB), c64(self.POOL_SLAB)])
+        with b.if_then(b.icmp_unsigned("==", slab, null)):
+            b.ret(null)
+        top, word, bit = map_word(b, b.ptrtoint(slab, i64))
+        with b.if_then(b.icmp_unsigned(">=", top, c64(self.POOL_MAP_TOP))):
+            # above the 47-bit user address space the map covers
+            b.call(self.libc_free, [slab])
+            b.ret(null)
+        top_slot = b.gep(slab_map, [c64(0), top])
+        b.call(mutex_lock, [lock_ptr])
+        words = b.load(top_slot)
+        with b.if_then(b.icmp_unsigned("==", words, ir.Constant(words.type, None))):
+            fresh = b.bitcast(b.call(calloc, [c64(1024), c64(8)]), words.type)
+            b.store_atomic(fresh, top_slot, 'release', 8)
+        words = b.load(top_slot)
+        with b.if_then(b.icmp_unsigned("==", words, ir.Constant(words.type, None))):
+            b.call(mutex_unlock, [lock_ptr])
+            b.call(self.libc_free, [slab])
+            b.ret(null)
+        b.atomic_rmw('or', b.gep(words, [word]), bit, 'monotonic')
+        b.call(mutex_unlock, [lock_ptr])
+        entry_bb = b.block
+        loop_bb = refill.append_basic_block("carve")
+        done_bb = refill.append_basic_block("done")
+        b.branch(loop_bb)
+        b.position_at_end(loop_bb)
+        i = b.phi(i64)
+        i.add_incoming(c64(0), entry_bb)
+        blk = b.gep(slab, [b.mul(i, block_size)])
+        nxt_i = b.add(i, c64(1))
+        is_last = b.icmp_signed("==", nxt_i, count)
+        nxt = b.select(is_last, null, b.gep(blk, [block_size]))
+        b.store(nxt, block_field(b, blk, 0, void_ptr))
+        b.store(cls, block_field(b, blk, 8, i32))
+        i.add_incoming(nxt_i, loop_bb)
+        b.cbranch(is_last, done_bb, loop_bb)
+        b.position_at_end(done_bb)
+        b.store(b.load(block_field(b, slab, 0, void_ptr)), head)
+        b.ret(slab)
+
+        # __nexa_alloc(i64) -> i8*
+        alloc = self.malloc
+        b = ir.IRBuilder(alloc.append_basic_block("entry"))
+        size = alloc.args[0]
+        with b.if_then(b.icmp_signed(">", size, c64(self.POOL_MAX_SMALL))):
+            b.ret(b.call(self.libc_malloc, [size]))
+        # class = ceil(log2(size)) - 4, with sizes <= 16 in class 0
+        bits = b.sub(c64(64), b.call(ctlz, [b.sub(size, c64(1)), ir.Constant(ir.IntType(1), 0)]))
+        cls = b.trunc(b.select(b.icmp_signed("<=", size, c64(16)), c64(0), b.sub(bits, c64(4))), i32)
+        head = b.gep(b.call(cache, []), [cls])
+        blk = b.load(head)
+        with b.if_then(b.icmp_unsigned("==", blk, null)):
+            carved = b.call(refill, [head, cls])
+            with b.if_then(b.icmp_unsigned("==", carved, null)):
+                b.ret(null)
+            b.ret(b.gep(carved, [header]))
+        b.store(b.load(block_field(b, blk, 0, void_ptr)), head)
+        b.ret(b.gep(blk, [header]))
+
+        # __nexa_free(i8*): anything outside a slab (large blocks, pointers
+        # from foreign code) belongs to libc
+        free = self.free
+        b = ir.IRBuilder(free.append_basic_block("entry"))
+        ptr = free.args[0]
+        with b.if_then(b.icmp_unsigned("==", ptr, null)):
+            b.ret_void()
+        with b.if_then(b.not_(b.call(owns, [ptr]))):
+            b.call(self.libc_free, [ptr])
+            b.ret_void()
+        base = b.gep(ptr, [c64(-16)])
+        cls = b.load(block_field(b, base, 8, i32))
+        head = b.gep(b.call(cache, []), [cls])
+        b.store(b.load(head), block_field(b, base, 0, void_ptr))
+        b.store(base, head)
+        b.ret_void()
 
-        base_chunk = b.load(chunk_ptr)
-        offset = b.load(offset_ptr)
-        cap = b.load(cap_ptr)
+        # __nexa_realloc(i8*, i64) -> i8*
+        realloc = self.realloc
+        b = ir.IRBuilder(realloc.append_basic_block("entry"))
+        ptr, size = realloc.args
+        with b.if_then(b.icmp_unsigned("==", ptr, null)):
+            b.ret(b.call(alloc, [size]))
+        with b.if_then(b.not_(b.call(owns, [ptr]))):
+            b.ret(b.call(self.libc_realloc, [ptr, size]))
+        cls = b.load(block_field(b, b.gep(ptr, [c64(-16)]), 8, i32))
+        capacity = b.shl(c64(16), b.zext(cls, i64))
+        with b.if_then(b.icmp_signed("<=", size, capacity)):
+            b.ret(ptr)
+        out = b.call(alloc, [size])
+        with b.if_then(b.icmp_unsigned("==", out, null)):
+            b.ret(null)
+        b.call(self.memcpy, [out, ptr, b.trunc(capacity, i32), ir.Constant(ir.IntType(1), 0)])
+        b.call(free, [ptr])
+        b.ret(out)
+
+    # --track-alloc: malloc/realloc/free calls go through counting wrappers
+    # keyed by call site (file:line). Tracked blocks carry a 16-byte header
+    # [size: i64][site: i32][magic: i32] in front of the hook allocation.
+    # Arena allocations are only counted; the region frees them in bulk.
+    TRACK_MAGIC = 0x4E585452  # "NXTR"
+    TRACK_TOP = 10
+    # per-site counters and process totals, as i64 slots
+    TRACK_FIELDS = ('count', 'bytes', 'live_count', 'live_bytes')
+    TRACK_TOTALS = ('allocs', 'frees', 'bytes', 'live_bytes', 'peak_live_bytes', 'arena_allocs', 'arena_bytes')
+
+    def _declare_alloc_tracking(self):
+        void_ptr = ir.IntType(8).as_pointer()
+        i32 = ir.IntType(32)
+        i64 = ir.IntType(64)
+        self._track = {
+            'malloc': ir.Function(self.module, ir.FunctionType(void_ptr, [i64, i32]), name="__nexa_track_alloc"),
+            'free': ir.Function(self.module, ir.FunctionType(ir.VoidType(), [void_ptr]), name="__nexa_track_free"),
+            'realloc': ir.Function(self.module, ir.FunctionType(void_ptr, [void_ptr, i64, i32]), name="__nexa_track_realloc"),
+            'arena': ir.Function(self.module, ir.FunctionType(ir.VoidType(), [i64, i32]), name="__nexa_track_arena"),
+            'report': ir.Function(self.module, ir.FunctionType(ir.VoidType(), []), name="__nexa_track_report"),
+        }
+        for name in ('free', 'arena', 'report'):
+            self._track[name].linkage = 'internal'
+
+    def _global_cstring(self, name, text):
+        # NUL-terminated constant usable outside a builder (runtime helpers)
+        data = bytearray(text.encode('utf-8') + b"\0")
+        gv = ir.GlobalVariable(self.module, ir.ArrayType(ir.IntType(8), len(data)), name=name)
+        gv.linkage = 'internal'
+        gv.global_constant = True
+        gv.initializer = ir.Constant(gv.type.pointee, data)
+        zero = ir.Constant(ir.IntType(32), 0)
+        return gv.gep([zero, zero])
+
+    def _alloc_site(self, node, kind='heap'):
+        # Functions remember their file (main.tag_source); lines come from the call
+        path = getattr(self._current_function_node, 'source_file', None) or '<unknown>'
+        key = (f"{path}:{getattr(node, 'line', 0)}", kind)
+        if key not in self._alloc_sites:
+            self._alloc_sites[key] = len(self._alloc_sites)
+        return ir.Constant(ir.IntType(32), self._alloc_sites[key])
+
+    def _emit_heap_alloc(self, size, node):
+        # Runtime-emitted allocations (fs::read_file, async state)
+        if self._track:
+            return self.builder.call(self._track['malloc'], [size, self._alloc_site(node)])
+        return self.builder.call(self.malloc, [size])
+
+    def _emit_tracked_alloc_call(self, hook, node):
+        # User-level malloc/realloc/free: widen sizes to i64, append the site
+        func = self._track[hook]
+        params = func.function_type.args
+        args = []
+        for arg, expected in zip(node.args, params):
+            val = self.visit(arg)
+            if isinstance(expected, ir.IntType) and val.type != expected:
+                val = self.builder.zext(val, expected) if val.type.width <= 8 else self.builder.sext(val, expected)
+            elif isinstance(val.type, ir.IntType) and isinstance(expected, ir.PointerType):
+                val = self.builder.inttoptr(val, expected)
+            elif val.type != expected:
+                val = self.builder.bitcast(val, expected)
+            args.append(val)
+        if len(params) > len(args):
+            args.append(self._alloc_site(node))
+        return self.builder.call(func, args)
 
-        new_offset = b.add(offset, req_size)
-        cond = b.icmp_unsigned(">", new_offset, cap)
+    def _emit_main_exit(self):
+        # Whatever main still owns after its drops is reported as live, and
+        # buffered stdout goes out before main returns
+        node = self._current_function_node
+        if self._coro is None and node.name == "main" and not getattr(node, 'is_lambda', False):
+            if not self.builder.block.is_terminated:
+                if self._track:
+                    self.builder.call(self._track['report'], [])
+                self._emit_out_flush()
+
+    def _define_alloc_tracking(self):
+        void_ptr = ir.IntType(8).as_pointer()
+        i32 = ir.IntType(32)
+        i64 = ir.IntType(64)
+        c32 = lambda v: ir.Constant(i32, v)
+        c64 = lambda v: ir.Constant(i64, v)
+        null = ir.Constant(void_ptr, None)
+        header = c64(16)
+        n_sites = len(self._alloc_sites)
+        n_fields = len(self.TRACK_FIELDS)
+
+        cstring = self._global_cstring
+
+        # Site labels as JSON members: "site": "std/vec.nxl:42", "kind": "heap"
+        labels = [None] * n_sites
+        for (site, kind), idx in self._alloc_sites.items():
+            labels[idx] = cstring(f"__nexa_track_site.{idx}", f"\"site\": {json.dumps(site)}, \"kind\": \"{kind}\"")
+        sites = ir.GlobalVariable(self.module, ir.ArrayType(void_ptr, n_sites), name="__nexa_track_sites")
+        sites.linkage = 'internal'
+        sites.global_constant = True
+        sites.initializer = ir.Constant(sites.type.pointee, labels)
+        stats_ty = ir.ArrayType(ir.ArrayType(i64, n_fields), n_sites)
+        stats = ir.GlobalVariable(self.module, stats_ty, name="__nexa_track_stats")
+        stats.linkage = 'internal'
+        stats.initializer = ir.Constant(stats_ty, None)
+        totals_ty = ir.ArrayType(i64, len(self.TRACK_TOTALS))
+        totals = ir.GlobalVariable(self.module, totals_ty, name="__nexa_track_totals")
+        totals.linkage = 'internal'
+        totals.initializer = ir.Constant(totals_ty, None)
+
+        # Counters are bumped atomically so threads may allocate concurrently
+        def stat(b, site, field):
+            return b.gep(stats, [c32(0), site, c32(self.TRACK_FIELDS.index(field))])
+
+        def total(field):
+            return totals.gep([c32(0), c32(self.TRACK_TOTALS.index(field))])
+
+        def bump(b, ptr, delta):
+            return b.atomic_rmw('add', ptr, delta, 'monotonic')
+
+        def header_field(b, base, offset, ty):
+            return b.bitcast(b.gep(base, [c64(offset)]), ty.as_pointer())
+
+        def account_alloc(b, site, size):
+            bump(b, stat(b, site, 'count'), c64(1))
+            bump(b, stat(b, site, 'bytes'), size)
+            bump(b, stat(b, site, 'live_count'), c64(1))
+            bump(b, stat(b, site, 'live_bytes'), size)
+            bump(b, total('allocs'), c64(1))
+            bump(b, total('bytes'), size)
+            live = b.add(bump(b, total('live_bytes'), size), size)
+            b.atomic_rmw('max', total('peak_live_bytes'), live, 'monotonic')
+
+        def account_free(b, site, size):
+            bump(b, stat(b, site, 'live_count'), c64(-1))
+            bump(b, stat(b, site, 'live_bytes'), b.neg(size))
+            bump(b, total('frees'), c64(1))
+            bump(b, total('live_bytes'), b.neg(size))
+
+        def write_header(b, base, size, site):
+            b.store(size, header_field(b, base, 0, i64))
+            b.store(site, header_field(b, base, 8, i32))
+            b.store(c32(self.TRACK_MAGIC), header_field(b, base, 12, i32))
+
+        def tracked_base(b, ptr):
+            # Foreign pointers (libc, allocator internals) have no magic
+            base = b.gep(ptr, [c64(-16)])
+            is_tracked = b.icmp_unsigned("==", b.load(header_field(b, base, 12, i32)), c32(self.TRACK_MAGIC))
+            return base, is_tracked
+
+        # __nexa_track_alloc(i64 size, i32 site) -> i8*
+        alloc = self._track['malloc']
+        b = ir.IRBuilder(alloc.append_basic_block("entry"))
+        size, site = alloc.args
+        base = b.call(self.malloc, [b.add(size, header)])
+        with b.if_then(b.icmp_unsigned("==", base, null)):
+            b.ret(null)
+        write_header(b, base, size, site)
+        account_alloc(b, site, size)
+        b.ret(b.gep(base, [header]))
+
+        # __nexa_track_free(i8*): the block is charged back to its allocation site
+        free = self._track['free']
+        b = ir.IRBuilder(free.append_basic_block("entry"))
+        ptr = free.args[0]
+        with b.if_then(b.icmp_unsigned("==", ptr, null)):
+            b.ret_void()
+        base, is_tracked = tracked_base(b, ptr)
+        with b.if_then(b.not_(is_tracked)):
+            b.call(self.free, [ptr])
+            b.ret_void()
+        account_free(b, b.load(header_field(b, base, 8, i32)), b.load(header_field(b, base, 0, i64)))
+        b.store(c32(0), header_field(b, base, 12, i32))
+        b.call(self.free, [base])
+        b.ret_void()
 
-        with b.if_then(cond):
-            b.call(self.exit_func, [ir.Constant(i32, 1)])
+        # __nexa_track_realloc(i8*, i64 size, i32 site) -> i8*: the moved block
+        # is re-attributed to the realloc call site
+        realloc = self._track['realloc']
+        b = ir.IRBuilder(realloc.append_basic_block("entry"))
+        ptr, size, site = realloc.args
+        with b.if_then(b.icmp_unsigned("==", ptr, null)):
+            b.ret(b.call(alloc, [size, site]))
+        base, is_tracked = tracked_base(b, ptr)
+        with b.if_then(b.not_(is_tracked)):
+            b.ret(b.call(self.realloc, [ptr, size]))
+        old_size = b.load(header_field(b, base, 0, i64))
+        old_site = b.load(header_field(b, base, 8, i32))
+        moved = b.call(self.realloc, [base, b.add(size, header)])
+        with b.if_then(b.icmp_unsigned("==", moved, null)):
+            b.ret(null)
+        account_free(b, old_site, old_size)
+        write_header(b, moved, size, site)
+        account_alloc(b, site, size)
+        b.ret(b.gep(moved, [header]))
+
+        # __nexa_track_arena(i64 size, i32 site)
+        arena = self._track['arena']
+        b = ir.IRBuilder(arena.append_basic_block("entry"))
+        size, site = arena.args
+        bump(b, stat(b, site, 'count'), c64(1))
+        bump(b, stat(b, site, 'bytes'), size)
+        bump(b, total('arena_allocs'), c64(1))
+        bump(b, total('arena_bytes'), size)
+        b.ret_void()
 
-        # Pointer arithmetic
-        base_int = b.ptrtoint(base_chunk, ir.IntType(64))
-        off_64 = b.zext(offset, ir.IntType(64))
-        res_int = b.add(base_int, off_64)
-        res_ptr = b.inttoptr(res_int, void_ptr)
+        fprintf = self.module.globals.get("fprintf")
+        if fprintf is None:
+            fprintf = ir.Function(self.module, ir.FunctionType(i32, [void_ptr, void_ptr], var_arg=True), name="fprintf")
+
+        def loop(fn, b, count, name):
+            # for (i = 0; i < count; i++) body(b, i) -- returns (body builder, i, exit block)
+            pre = b.block
+            head = fn.append_basic_block(f"{name}_head")
+            body = fn.append_basic_block(f"{name}_body")
+            exit_bb = fn.append_basic_block(f"{name}_exit")
+            b.branch(head)
+            b.position_at_end(head)
+            i = b.phi(i32)
+            i.add_incoming(c32(0), pre)
+            b.cbranch(b.icmp_signed("<", i, count), body, exit_bb)
+            b.position_at_end(body)
+            return i, head, exit_bb
+
+        # __nexa_track_rank(i32* order, i32 field): site indices by descending counter
+        rank = ir.Function(self.module, ir.FunctionType(ir.VoidType(), [i32.as_pointer(), i32]), name="__nexa_track_rank")
+        rank.linkage = 'internal'
+        b = ir.IRBuilder(rank.append_basic_block("entry"))
+        order, field = rank.args
+        key_of = lambda b, idx: b.load(b.gep(stats, [c32(0), idx, field]))
+        i, head, exit_bb = loop(rank, b, c32(n_sites), "fill")
+        b.store(i, b.gep(order, [i]))
+        i.add_incoming(b.add(i, c32(1)), b.block)
+        b.branch(head)
+        b.position_at_end(exit_bb)
+        # insertion sort: n_sites is the number of distinct call sites
+        i, head, exit_bb = loop(rank, b, c32(n_sites), "sort")
+        cur = b.load(b.gep(order, [i]))
+        cur_key = key_of(b, cur)
+        j = b.alloca(i32)
+        b.store(b.sub(i, c32(1)), j)
+        shift_head = rank.append_basic_block("shift_head")
+        shift_cmp = rank.append_basic_block("shift_cmp")
+        shift_body = rank.append_basic_block("shift_body")
+        shift_exit = rank.append_basic_block("shift_exit")
+        b.branch(shift_head)
+        b.position_at_end(shift_head)
+        jv = b.load(j)
+        b.cbranch(b.icmp_signed(">=", jv, c32(0)), shift_cmp, shift_exit)
+        b.position_at_end(shift_cmp)
+        prev = b.load(b.gep(order, [jv]))
+        b.cbranch(b.icmp_signed("<", key_of(b, prev), cur_key), shift_body, shift_exit)
+        b.position_at_end(shift_body)
+        b.store(prev, b.gep(order, [b.add(jv, c32(1))]))
+        b.store(b.sub(jv, c32(1)), j)
+        b.branch(shift_head)
+        b.position_at_end(shift_exit)
+        b.store(cur, b.gep(order, [b.add(b.load(j), c32(1))]))
+        i.add_incoming(b.add(i, c32(1)), b.block)
+        b.branch(head)
+        b.position_at_end(exit_bb)
+        b.ret_void()
 
-        b.store(new_offset, offset_ptr)
-        b.ret(res_ptr)
+        # __nexa_track_write(FILE*, i32* order, i32 limit, i1 live_only) -> i32 written
+        write = ir.Function(self.module, ir.FunctionType(i32, [void_ptr, i32.as_pointer(), i32, ir.IntType(1)]), name="__nexa_track_write")
+        write.linkage = 'internal'
+        b = ir.IRBuilder(write.append_basic_block("entry"))
+        out, order, limit, live_only = write.args
+        first_sep = cstring("__nexa_track_sep0", "\n    ")
+        next_sep = cstring("__nexa_track_sep1", ",\n    ")
+        record = cstring("__nexa_track_record", "%s{%s, \"count\": %lld, \"bytes\": %lld, \"live_count\": %lld, \"live_bytes\": %lld}")
+        written = b.alloca(i32)
+        b.store(c32(0), written)
+        i, head, exit_bb = loop(write, b, c32(n_sites), "site")
+        idx = b.load(b.gep(order, [i]))
+        values = [b.load(stat(b, idx, f)) for f in self.TRACK_FIELDS]
+        wanted = b.select(live_only, b.icmp_signed(">", values[2], c64(0)), b.icmp_signed(">", values[0], c64(0)))
+        n = b.load(written)
+        with b.if_then(b.and_(wanted, b.icmp_signed("<", n, limit))):
+            sep = b.select(b.icmp_signed("==", n, c32(0)), first_sep, next_sep)
+            label = b.load(b.gep(sites, [c32(0), idx]))
+            b.call(fprintf, [out, record, sep, label] + values)
+            b.store(b.add(n, c32(1)), written)
+        i.add_incoming(b.add(i, c32(1)), b.block)
+        b.branch(head)
+        b.position_at_end(exit_bb)
+        b.ret(b.load(written))
+
+        # __nexa_track_report(): called when main returns
+        report = self._track['report']
+        b = ir.IRBuilder(report.append_basic_block("entry"))
+        f = b.call(self.fopen, [cstring("__nexa_track_path", self.track_alloc), cstring("__nexa_track_mode", "w")])
+        with b.if_then(b.icmp_unsigned("==", f, null)):
+            b.ret_void()
+        totals_fmt = "{\n  \"totals\": {" + ", ".join(f'\"{t}\": %lld' for t in self.TRACK_TOTALS) + "},\n"
+        b.call(fprintf, [f, cstring("__nexa_track_totals_fmt", totals_fmt)] + [b.load(total(t)) for t in self.TRACK_TOTALS])
+        order = b.alloca(ir.ArrayType(i32, max(n_sites, 1)))
+        order_ptr = b.gep(order, [c32(0), c32(0)])
+        sections = (
+            ("top_by_count", 'count', self.TRACK_TOP, 0),
+            ("top_by_bytes", 'bytes', self.TRACK_TOP, 0),
+            # leak candidates: still live when main returned
+            ("leaks", 'live_bytes', n_sites, 1),
+        )
+        for k, (title, key, limit, live_only) in enumerate(sections):
+            b.call(fprintf, [f, cstring(f"__nexa_track_{title}", f'  \"{title}\": [')])
+            b.call(rank, [order_ptr, c32(self.TRACK_FIELDS.index(key))])
+            n = b.call(write, [f, order_ptr, c32(limit), ir.Constant(ir.IntType(1), live_only)])
+            tail = "]" + ("," if k + 1 < len(sections) else "") + "\n"
+            closing = b.select(b.icmp_signed(">", n, c32(0)),
+                               cstring(f"__nexa_track_{title}_end1", "\n  " + tail),
+                               cstring(f"__nexa_track_{title}_end0", tail))
+            b.call(fprintf, [f, closing])
+        b.call(fprintf, [f, cstring("__nexa_track_end", "}\n")])
+        b.call(self.fclose, [f])
+        b.ret_void()
 
-    def _declare_malloc_free(self):
-        # void* malloc(i32)
-        # void free(void*)
+    # Async runtime. An async fn lowers to a ramp that allocates its frame
+    # and a resume function that runs it up to the next suspension. Every
+    # frame starts with the header below; the result follows at TASK_RESULT.
+    #   [resume: void(i8*)*][waiter: i8*][state: i32][done: i8][detached: i8]
+    # State 0 means "not started"; state k resumes after the k-th await.
+    # `waiter` is the completion handshake: the awaiting task CASes itself
+    # in, the finishing task swaps in TASK_FINISHED and wakes what it found.
+    TASK_RESUME, TASK_WAITER, TASK_STATE, TASK_DONE, TASK_DETACHED, TASK_RESULT = range(6)
+    TASK_FINISHED = 1  # waiter sentinel: the task has completed
+    TASK_SPAWNED, TASK_BLOCKED_ON = 1, 2  # `detached` values
+
+    def _task_header_types(self):
+        void_ptr = ir.IntType(8).as_pointer()
+        return [void_ptr, void_ptr, ir.IntType(32), ir.IntType(8), ir.IntType(8)]
+
+    def _fd_wait_type(self):
+        # __nexa_wait_fd frame: header, then {revents (the result), fd, events}
+        i32 = ir.IntType(32)
+        return ir.LiteralStructType(self._task_header_types() + [i32, i32, i32])
+
+    def _declare_task_runtime(self):
+        void_ptr = ir.IntType(8).as_pointer()
+        void = ir.VoidType()
+        i1 = ir.IntType(1)
+        i32 = ir.IntType(32)
+        self.task_header = self.module.context.get_identified_type("__nexa_task")
+        self.task_header.set_body(*self._task_header_types())
+        signatures = {
+            # extern-visible (std::task)
+            '__nexa_resume': (void, [void_ptr]),
+            '__nexa_is_done': (i1, [void_ptr]),
+            '__nexa_destroy': (void, [void_ptr]),
+            '__nexa_task_spawn': (void, [void_ptr]),
+            '__nexa_task_run_ready': (i32, []),
+            '__nexa_task_pending': (i32, []),
+            '__nexa_block_on': (void, [void_ptr]),
+            '__nexa_yield_now': (void_ptr, []),
+            '__nexa_sleep': (void_ptr, [ir.IntType(64)]),
+            '__nexa_waker_new': (void_ptr, []),
+            '__nexa_waker_wake': (void, [void_ptr]),
+            '__nexa_wait_fd': (void_ptr, [i32, i32]),
+            '__nexa_executor_start': (i32, [i32]),
+            '__nexa_executor_shutdown': (void, []),
+            # used by generated code
+            '__nexa_task_wake': (void, [void_ptr]),
+            '__nexa_task_await': (i1, [void_ptr, void_ptr]),
+            '__nexa_task_complete': (void, [void_ptr]),
+        }
+        self._task_rt = {}
+        for name, (ret, args) in signatures.items():
+            func = self.module.globals.get(name)
+            if func is None:
+                func = ir.Function(self.module, ir.FunctionType(ret, args), name=name)
+            self._task_rt[name] = func
+
+    def _define_task_runtime(self):
+        # Executor: one injection queue (tasks woken outside a worker) plus a
+        # deque per worker thread. Workers take from the front of their own
+        # deque, then the injection queue, then steal from the back of the
+        # others'. Deques are short critical sections under a spinlock; idle
+        # threads sleep on a condition variable.
+        void_ptr = ir.IntType(8).as_pointer()
+        i1 = ir.IntType(1)
+        i8 = ir.IntType(8)
+        i32 = ir.IntType(32)
+        i64 = ir.IntType(64)
+        c8 = lambda v: ir.Constant(i8, v)
+        c32 = lambda v: ir.Constant(i32, v)
+        c64 = lambda v: ir.Constant(i64, v)
+        null = ir.Constant(void_ptr, None)
+        true, false = ir.Constant(i1, 1), ir.Constant(i1, 0)
+        rt = self._task_rt
+        resume_ty = ir.FunctionType(ir.VoidType(), [void_ptr])
+        free = self._track.get('free', self.free)
+        finished = ir.Constant(i64, self.TASK_FINISHED).inttoptr(void_ptr)
+
+        def field(b, task, index):
+            return b.gep(b.bitcast(task, self.task_header.as_pointer()), [c32(0), c32(index)])
+
+        def body(name):
+            func = rt[name]
+            return func, ir.IRBuilder(func.append_basic_block("entry"))
+
+        def internal(name, ret, args):
+            func = ir.Function(self.module, ir.FunctionType(ret, args), name=name)
+            func.linkage = 'internal'
+            return func, ir.IRBuilder(func.append_basic_block("entry"))
+
+        def global_var(name, ty, init=None):
+            gv = ir.GlobalVariable(self.module, ty, name=name)
+            gv.linkage = 'internal'
+            gv.initializer = ir.Constant(ty, init)
+            return gv
+
+        def loop_until(b, func, name, cond_fn, body_fn):
+            # while (cond_fn()) body_fn()
+            head = func.append_basic_block(f"{name}_head")
+            step = func.append_basic_block(f"{name}_body")
+            done = func.append_basic_block(f"{name}_done")
+            b.branch(head)
+            b.position_at_end(head)
+            b.cbranch(cond_fn(), step, done)
+            b.position_at_end(step)
+            body_fn()
+            if not b.block.is_terminated:
+                b.branch(head)
+            b.position_at_end(done)
+
+        libc = self._libc_function
+        dtor_ty = ir.FunctionType(ir.VoidType(), [void_ptr])
+        entry_ty = ir.FunctionType(void_ptr, [void_ptr])
+        init_ty = ir.FunctionType(ir.VoidType(), [])
+        pthread_create = libc("pthread_create", i32, [i64.as_pointer(), void_ptr, entry_ty.as_pointer(), void_ptr])
+        pthread_join = libc("pthread_join", i32, [i64, void_ptr.as_pointer()])
+        pthread_once = libc("pthread_once", i32, [i32.as_pointer(), init_ty.as_pointer()])
+        key_create = libc("pthread_key_create", i32, [i32.as_pointer(), dtor_ty.as_pointer()])
+        getspecific = libc("pthread_getspecific", void_ptr, [i32])
+        setspecific = libc("pthread_setspecific", i32, [i32, void_ptr])
+        mutex_lock = libc("pthread_mutex_lock", i32, [void_ptr])
+        mutex_unlock = libc("pthread_mutex_unlock", i32, [void_ptr])
+        cond_wait = libc("pthread_cond_wait", i32, [void_ptr, void_ptr])
+        cond_signal = libc("pthread_cond_signal", i32, [void_ptr])
+        cond_broadcast = libc("pthread_cond_broadcast", i32, [void_ptr])
+        sched_yield = libc("sched_yield", i32, [])
+        sysconf = libc("sysconf", i64, [i32])
+        calloc = libc("calloc", void_ptr, [i64, i64])
+
+        # Deque: {lock, buf, head, len, cap}, a growable ring of task handles
+        deque_ty = self.module.context.get_identified_type("__nexa_deque")
+        deque_ty.set_body(i32, void_ptr.as_pointer(), i64, i64, i64)
+        deque_ptr = deque_ty.as_pointer()
+        dq = lambda b, d, i: b.gep(d, [c32(0), c32(i)])
+
+        inject = global_var("__nexa_rq_inject", deque_ty)
+        workers = global_var("__nexa_rq_workers", deque_ptr)  # calloc'd [n x deque]
+        n_workers = global_var("__nexa_rq_nworkers", i32, 0)
+        threads = global_var("__nexa_rq_threads", i64.as_pointer())
+        queued = global_var("__nexa_rq_queued", i64, 0)  # tasks sitting in any queue
+        active = global_var("__nexa_rq_active", i64, 0)  # spawned tasks not yet finished
+        sleepers = global_var("__nexa_rq_sleepers", i32, 0)
+        shutdown = global_var("__nexa_rq_shutdown", i32, 0)
+        worker_key = global_var("__nexa_rq_key", i32, 0)  # this thread's worker index + 1
+        key_once = global_var("__nexa_rq_once", i32, 0)  # PTHREAD_ONCE_INIT
+        # glibc: PTHREAD_MUTEX_INITIALIZER / PTHREAD_COND_INITIALIZER are all-zero
+        idle_mutex = global_var("__nexa_rq_mutex", ir.ArrayType(i8, 64))
+        idle_mutex.align = 16
+        idle_cond = global_var("__nexa_rq_cond", ir.ArrayType(i8, 64))
+        idle_cond.align = 16
+        mutex = lambda b: b.bitcast(idle_mutex, void_ptr)
+        cond = lambda b: b.bitcast(idle_cond, void_ptr)
+
+        def spin_lock(b, func, lock):
+            loop_until(b, func, "spin", lambda: b.icmp_signed("!=", b.atomic_rmw('xchg', lock, c32(1), 'acquire'), c32(0)),
+                       lambda: b.call(sched_yield, []))
+
+        def spin_unlock(b, lock):
+            b.store_atomic(c32(0), lock, 'release', 4)
+
+        # __nexa_deque_push(deque*, task): at the back, doubling the ring when full
+        push, b = internal("__nexa_deque_push", ir.VoidType(), [deque_ptr, void_ptr])
+        d, task = push.args
+        spin_lock(b, push, dq(b, d, 0))
+        cap = b.load(dq(b, d, 4))
+        with b.if_then(b.icmp_signed("==", b.load(dq(b, d, 3)), cap)):
+            new_cap = b.select(b.icmp_signed("==", cap, c64(0)), c64(16), b.mul(cap, c64(2)))
+            grown = b.bitcast(b.call(self.malloc, [b.mul(new_cap, c64(8))]), void_ptr.as_pointer())
+            old = b.load(dq(b, d, 1))
+            head = b.load(dq(b, d, 2))
+            # unroll the ring into the new buffer, oldest first
+            i = b.alloca(i64)
+            b.store(c64(0), i)
+            def copy():
+                iv = b.load(i)
+                b.store(b.load(b.gep(old, [b.srem(b.add(head, iv), cap)])), b.gep(grown, [iv]))
+                b.store(b.add(iv, c64(1)), i)
+            loop_until(b, push, "copy", lambda: b.icmp_signed("<", b.load(i), cap), copy)
+            with b.if_then(b.icmp_unsigned("!=", old, ir.Constant(old.type, None))):
+                b.call(self.free, [b.bitcast(old, void_ptr)])
+            b.store(grown, dq(b, d, 1))
+            b.store(c64(0), dq(b, d, 2))
+            b.store(new_cap, dq(b, d, 4))
+        length = b.load(dq(b, d, 3))
+        slot = b.gep(b.load(dq(b, d, 1)), [b.srem(b.add(b.load(dq(b, d, 2)), length), b.load(dq(b, d, 4)))])
+        b.store(task, slot)
+        b.store(b.add(length, c64(1)), dq(b, d, 3))
+        spin_unlock(b, dq(b, d, 0))
+        b.ret_void()
+
+        # __nexa_deque_take(deque*, i1 from_back) -> task or null
+        take, b = internal("__nexa_deque_take", void_ptr, [deque_ptr, i1])
+        d, from_back = take.args
+        spin_lock(b, take, dq(b, d, 0))
+        length = b.load(dq(b, d, 3))
+        with b.if_then(b.icmp_signed("==", length, c64(0))):
+            spin_unlock(b, dq(b, d, 0))
+            b.ret(null)
+        head = b.load(dq(b, d, 2))
+        cap = b.load(dq(b, d, 4))
+        last = b.sub(length, c64(1))
+        index = b.select(from_back, b.srem(b.add(head, last), cap), head)
+        task = b.load(b.gep(b.load(dq(b, d, 1)), [index]))
+        b.store(b.select(from_back, head, b.srem(b.add(head, c64(1)), cap)), dq(b, d, 2))
+        b.store(last, dq(b, d, 3))
+        spin_unlock(b, dq(b, d, 0))
+        b.ret(task)
+
+        # __nexa_worker_index() -> worker index of this thread, or -1
+        current, b = internal("__nexa_worker_index", i32, [])
+        with b.if_then(b.icmp_signed("==", b.load(n_workers), c32(0))):
+            b.ret(c32(-1))
+        tag = b.ptrtoint(b.call(getspecific, [b.load(worker_key)]), i64)
+        b.ret(b.sub(b.trunc(tag, i32), c32(1)))
+
+        # Reactor: sleeping leaf tasks wait in a min-heap of deadlines, fd
+        # waits are registered with epoll. One idle thread at a time holds
+        # the poller role and blocks in epoll_wait; `kick` interrupts it
+        # through an eventfd when there is other work to do.
+        timer_ty = ir.LiteralStructType([i64, void_ptr])  # {deadline_ns, task}
+        timers = global_var("__nexa_timer_heap", timer_ty.as_pointer())
+        timers_len = global_var("__nexa_timer_len", i64, 0)
+        timers_cap = global_var("__nexa_timer_cap", i64, 0)
+        timers_lock = global_var("__nexa_timer_lock", i32, 0)
+        waiting = global_var("__nexa_reactor_waiting", i64, 0)  # timers + fd waits
+        polling = global_var("__nexa_reactor_polling", i32, 0)
+        epfd = global_var("__nexa_reactor_epfd", i32, -1)
+        kickfd = global_var("__nexa_reactor_kickfd", i32, -1)
+        reactor_once = global_var("__nexa_reactor_once", i32, 0)
+        # struct epoll_event is packed on x86-64 only
+        event_ty = ir.LiteralStructType([i32, i64], packed=platform.machine() in ('x86_64', 'AMD64'))
+        EPOLL_CTL_ADD, EPOLL_CTL_DEL, EPOLL_CTL_MOD = 1, 2, 3
+        EPOLLIN, EPOLLONESHOT = 0x1, 0x40000000
+        epoll_create1 = libc("epoll_create1", i32, [i32])
+        epoll_ctl = libc("epoll_ctl", i32, [i32, i32, i32, event_ty.as_pointer()])
+        epoll_wait = libc("epoll_wait", i32, [i32, event_ty.as_pointer(), i32, i32])
+        eventfd = libc("eventfd", i32, [i32, i32])
+        sys_read = libc("read", i64, [i32, void_ptr, i64])
+        sys_write = libc("write", i64, [i32, void_ptr, i64])
+        clock_gettime = libc("clock_gettime", i32, [i32, ir.ArrayType(i64, 2).as_pointer()])
+
+        reactor_init, b = internal("__nexa_reactor_init", ir.VoidType(), [])
+        b.store(b.call(epoll_create1, [c32(0x80000)]), epfd)  # EPOLL_CLOEXEC
+        b.store(b.call(eventfd, [c32(0), c32(0x80800)]), kickfd)  # EFD_NONBLOCK | EFD_CLOEXEC
+        ev = b.alloca(event_ty)
+        b.store(ir.Constant(event_ty, [EPOLLIN, 0]), ev)  # data 0 marks the kick fd
+        b.call(epoll_ctl, [b.load(epfd), c32(EPOLL_CTL_ADD), b.load(kickfd), ev])
+        b.ret_void()
+
+        now_ns, b = internal("__nexa_now_ns", i64, [])
+        ts = b.alloca(ir.ArrayType(i64, 2))
+        b.call(clock_gettime, [c32(1), ts])  # CLOCK_MONOTONIC
+        secs = b.load(b.gep(ts, [c32(0), c32(0)]))
+        nanos = b.load(b.gep(ts, [c32(0), c32(1)]))
+        b.ret(b.add(b.mul(secs, c64(1000000000)), nanos))
+
+        kick, b = internal("__nexa_reactor_kick", ir.VoidType(), [])
+        with b.if_then(b.icmp_signed("!=", b.load_atomic(polling, 'seq_cst', 4), c32(0))):
+            one = b.alloca(i64)
+            b.store(c64(1), one)
+            b.call(sys_write, [b.load(kickfd), b.bitcast(one, void_ptr), c64(8)])
+        b.ret_void()
+
+        def notify(b, all_waiters):
+            b.call(kick, [])
+            b.call(mutex_lock, [mutex(b)])
+            b.call(cond_broadcast if all_waiters else cond_signal, [cond(b)])
+            b.call(mutex_unlock, [mutex(b)])
+
+        # __nexa_task_wake(task): queue on this worker's deque, or the injector
+        func, b = body('__nexa_task_wake')
+        task = func.args[0]
+        me = b.call(current, [])
+        with b.if_else(b.icmp_signed(">=", me, c32(0))) as (on_worker, outside):
+            with on_worker:
+                b.call(push, [b.gep(b.load(workers), [me]), task])
+            with outside:
+                b.call(push, [inject, task])
+        b.atomic_rmw('add', queued, c64(1), 'seq_cst')
+        b.call(kick, [])
+        with b.if_then(b.icmp_signed(">", b.load_atomic(sleepers, 'seq_cst', 4), c32(0))):
+            b.call(mutex_lock, [mutex(b)])
+            b.call(cond_signal, [cond(b)])
+            b.call(mutex_unlock, [mutex(b)])
+        b.ret_void()
+
+        # __nexa_find_work(i32 me) -> task or null
+        find, b = internal("__nexa_find_work", void_ptr, [i32])
+        me = find.args[0]
+        n = b.load(n_workers)
+        found = b.alloca(void_ptr)
+        b.store(null, found)
+        with b.if_then(b.icmp_signed(">=", me, c32(0))):
+            b.store(b.call(take, [b.gep(b.load(workers), [me]), false]), found)
+        with b.if_then(b.icmp_unsigned("==", b.load(found), null)):
+            b.store(b.call(take, [inject, false]), found)
+        # steal: scan the other workers starting after our own slot
+        i = b.alloca(i32)
+        b.store(c32(1), i)
+        def steal():
+            iv = b.load(i)
+            victim = b.srem(b.add(b.add(me, iv), n), n)
+            with b.if_then(b.icmp_signed("!=", victim, me)):
+                b.store(b.call(take, [b.gep(b.load(workers), [victim]), true]), found)
+            b.store(b.add(iv, c32(1)), i)
+        loop_until(b, find, "steal",
+                   lambda: b.and_(b.icmp_unsigned("==", b.load(found), null), b.icmp_signed("<=", b.load(i), n)),
+                   steal)
+        task = b.load(found)
+        with b.if_then(b.icmp_unsigned("!=", task, null)):
+            b.atomic_rmw('sub', queued, c64(1), 'seq_cst')
+        b.ret(task)
+
+        def sleep_while(b, func, name, cond_fn):
+            # Park on the idle condition. `sleepers` goes up before the
+            # condition is checked, so a waker that bumped `queued` either
+            # is seen here or sees us and signals.
+            b.call(mutex_lock, [mutex(b)])
+            b.atomic_rmw('add', sleepers, c32(1), 'seq_cst')
+            loop_until(b, func, name, cond_fn, lambda: b.call(cond_wait, [cond(b), mutex(b)]))
+            b.atomic_rmw('sub', sleepers, c32(1), 'seq_cst')
+            b.call(mutex_unlock, [mutex(b)])
+
+        no_work = lambda b: b.icmp_signed("==", b.load_atomic(queued, 'seq_cst', 8), c64(0))
+
+        func, b = body('__nexa_task_pending')
+        b.ret(b.trunc(b.load_atomic(queued, 'seq_cst', 8), i32))
+
+        func, b = body('__nexa_resume')
+        task = func.args[0]
+        fn = b.bitcast(b.load(field(b, task, self.TASK_RESUME)), resume_ty.as_pointer())
+        b.call(fn, [task])
+        b.ret_void()
+
+        func, b = body('__nexa_is_done')
+        waiter = b.load_atomic(field(b, func.args[0], self.TASK_WAITER), 'acquire', 8)
+        b.ret(b.icmp_unsigned("==", waiter, finished))
+
+        func, b = body('__nexa_destroy')
+        b.call(free, [func.args[0]])
+        b.ret_void()
+
+        # __nexa_task_complete(task): the body returned. The swap on `waiter`
+        # is the last access to a frame someone else will free.
+        func, b = body('__nexa_task_complete')
+        task = func.args[0]
+        kind = b.load(field(b, task, self.TASK_DETACHED))
+        b.store(c8(1), field(b, task, self.TASK_DONE))
+        slot = b.bitcast(field(b, task, self.TASK_WAITER), i64.as_pointer())
+        waiter = b.inttoptr(b.atomic_rmw('xchg', slot, c64(self.TASK_FINISHED), 'acq_rel'), void_ptr)
+        with b.if_then(b.icmp_unsigned("!=", waiter, null)):
+            b.call(rt['__nexa_task_wake'], [waiter])
+        with b.if_then(b.icmp_unsigned("==", kind, c8(self.TASK_SPAWNED))):
+            b.call(rt['__nexa_destroy'], [task])
+            left = b.atomic_rmw('sub', active, c64(1), 'seq_cst')
+            with b.if_then(b.icmp_signed("==", left, c64(1))):
+                notify(b, True)
+        with b.if_then(b.icmp_unsigned("==", kind, c8(self.TASK_BLOCKED_ON))):
+            notify(b, True)
+        b.ret_void()
+
+        # __nexa_task_await(child, self) -> ready: an unstarted child runs
+        # inline first; if it is still running, `self` becomes its waiter.
+        # The caller has already saved its resume state.
+        func, b = body('__nexa_task_await')
+        child, me = func.args
+        with b.if_then(b.icmp_signed("==", b.load(field(b, child, self.TASK_STATE)), c32(0))):
+            with b.if_then(b.icmp_unsigned("==", b.load_atomic(field(b, child, self.TASK_WAITER), 'acquire', 8), null)):
+                b.call(rt['__nexa_resume'], [child])
+        res = b.cmpxchg(field(b, child, self.TASK_WAITER), null, me, 'acq_rel', 'acquire')
+        b.ret(b.not_(b.extract_value(res, 1)))
+
+        # __nexa_task_spawn(task): detach onto a queue; freed on completion
+        func, b = body('__nexa_task_spawn')
+        b.store(c8(self.TASK_SPAWNED), field(b, func.args[0], self.TASK_DETACHED))
+        b.atomic_rmw('add', active, c64(1), 'seq_cst')
+        b.call(rt['__nexa_task_wake'], [func.args[0]])
+        b.ret_void()
+
+        def timers_locked(b, func, fn):
+            spin_lock(b, func, timers_lock)
+            fn()
+            spin_unlock(b, timers_lock)
+
+        # __nexa_timer_push(deadline, task): sift up into the min-heap
+        timer_push, b = internal("__nexa_timer_push", ir.VoidType(), [i64, void_ptr])
+        deadline, task = timer_push.args
+        spin_lock(b, timer_push, timers_lock)
+        length = b.load(timers_len)
+        cap = b.load(timers_cap)
+        with b.if_then(b.icmp_signed("==", length, cap)):
+            new_cap = b.select(b.icmp_signed("==", cap, c64(0)), c64(16), b.mul(cap, c64(2)))
+            entry_size = b.ptrtoint(b.gep(ir.Constant(timer_ty.as_pointer(), None), [c32(1)]), i64)
+            grown = b.call(self.libc_realloc, [b.bitcast(b.load(timers), void_ptr), b.mul(new_cap, entry_size)])
+            b.store(b.bitcast(grown, timer_ty.as_pointer()), timers)
+            b.store(new_cap, timers_cap)
+        heap = b.load(timers)
+        pos = b.alloca(i64)
+        b.store(length, pos)
+        def sift_up():
+            child = b.load(pos)
+            parent = b.sdiv(b.sub(child, c64(1)), c64(2))
+            b.store(b.load(b.gep(heap, [parent])), b.gep(heap, [child]))
+            b.store(parent, pos)
+        def above_parent():
+            child = b.load(pos)
+            parent = b.sdiv(b.sub(child, c64(1)), c64(2))
+            parent_deadline = b.load(b.gep(heap, [b.select(b.icmp_signed(">", child, c64(0)), parent, c64(0)), c32(0)]))
+            return b.and_(b.icmp_signed(">", child, c64(0)), b.icmp_signed("<", deadline, parent_deadline))
+        loop_until(b, timer_push, "sift_up", above_parent, sift_up)
+        slot = b.gep(heap, [b.load(pos)])
+        b.store(deadline, b.gep(slot, [c32(0), c32(0)]))
+        b.store(task, b.gep(slot, [c32(0), c32(1)]))
+        b.store(b.add(length, c64(1)), timers_len)
+        spin_unlock(b, timers_lock)
+        b.ret_void()
+
+        # __nexa_timer_pop(now) -> the earliest task due by `now`, or null
+        timer_pop, b = internal("__nexa_timer_pop", void_ptr, [i64])
+        now = timer_pop.args[0]
+        spin_lock(b, timer_pop, timers_lock)
+        length = b.load(timers_len)
+        heap = b.load(timers)
+        with b.if_then(b.or_(b.icmp_signed("==", length, c64(0)),
+                             b.icmp_signed(">", b.load(b.gep(heap, [c64(0), c32(0)])), now))):
+            spin_unlock(b, timers_lock)
+            b.ret(null)
+        top = b.load(b.gep(heap, [c64(0), c32(1)]))
+        last = b.sub(length, c64(1))
+        moved = b.load(b.gep(heap, [last]))
+        b.store(last, timers_len)
+        pos = b.alloca(i64)
+        b.store(c64(0), pos)
+        smallest = b.alloca(i64)
+        # sift the former last entry down from the root
+        def smaller_child():
+            p = b.load(pos)
+            left = b.add(b.mul(p, c64(2)), c64(1))
+            right = b.add(left, c64(1))
+            left_key = b.load(b.gep(heap, [b.select(b.icmp_signed("<", left, last), left, c64(0)), c32(0)]))
+            right_key = b.load(b.gep(heap, [b.select(b.icmp_signed("<", right, last), right, c64(0)), c32(0)]))
+            pick = b.select(b.and_(b.icmp_signed("<", right, last), b.icmp_signed("<", right_key, left_key)), right, left)
+            pick_key = b.select(b.icmp_signed("==", pick, right), right_key, left_key)
+            b.store(pick, smallest)
+            return b.and_(b.icmp_signed("<", left, last), b.icmp_signed("<", pick_key, b.extract_value(moved, 0)))
+        def sift_down():
+            p = b.load(pos)
+            c = b.load(smallest)
+            b.store(b.load(b.gep(heap, [c])), b.gep(heap, [p]))
+            b.store(c, pos)
+        loop_until(b, timer_pop, "sift_down", smaller_child, sift_down)
+        with b.if_then(b.icmp_signed(">", last, c64(0))):
+            b.store(moved, b.gep(heap, [b.load(pos)]))
+        spin_unlock(b, timers_lock)
+        b.ret(top)
+
+        # __nexa_next_deadline() -> earliest deadline, or -1 with no timers
+        next_deadline, b = internal("__nexa_next_deadline", i64, [])
+        spin_lock(b, next_deadline, timers_lock)
+        soonest = b.select(b.icmp_signed(">", b.load(timers_len), c64(0)),
+                           b.load(b.gep(b.load(timers), [c64(0), c32(0)])), c64(-1))
+        spin_unlock(b, timers_lock)
+        b.ret(soonest)
+
+        def reactor_complete(b, task):
+            b.atomic_rmw('sub', waiting, c64(1), 'seq_cst')
+            b.call(rt['__nexa_task_complete'], [task])
+
+        # __nexa_reactor_poll(block) -> tasks completed: fire due timers and
+        # ready fds; with `block`, sleep until one of them (or a kick) arrives
+        reactor_poll, b = internal("__nexa_reactor_poll", i32, [i1])
+        block = reactor_poll.args[0]
+        fired = b.alloca(i32)
+        b.store(c32(0), fired)
+        def fire_timers():
+            due = b.alloca(void_ptr)
+            def next_due():
+                b.store(b.call(timer_pop, [b.call(now_ns, [])]), due)
+                return b.icmp_unsigned("!=", b.load(due), null)
+            def fire():
+                reactor_complete(b, b.load(due))
+                b.store(b.add(b.load(fired), c32(1)), fired)
+            loop_until(b, reactor_poll, "timers", next_due, fire)
+        fire_timers()
+        soonest = b.call(next_deadline, [])
+        until = b.sub(soonest, b.call(now_ns, []))
+        wait_ms = b.select(b.icmp_signed("<", soonest, c64(0)), c64(-1),
+                           b.select(b.icmp_signed("<", until, c64(0)), c64(0),
+                                    b.sdiv(b.add(until, c64(999999)), c64(1000000))))
+        sleeps = b.and_(block, b.icmp_signed("==", b.load(fired), c32(0)))
+        timeout = b.trunc(b.select(sleeps, b.select(b.icmp_signed(">", wait_ms, c64(0x7fffffff)), c64(0x7fffffff), wait_ms), c64(0)), i32)
+        events = b.alloca(event_ty, c32(16))
+        n = b.call(epoll_wait, [b.load(epfd), events, c32(16), timeout])
+        drain = b.alloca(i64)
+        i = b.alloca(i32)
+        b.store(c32(0), i)
+        def dispatch():
+            iv = b.load(i)
+            ev = b.gep(events, [iv])
+            data = b.load(b.gep(ev, [c32(0), c32(1)]))
+            with b.if_else(b.icmp_signed("==", data, c64(0))) as (kicked, ready):
+                with kicked:
+                    b.call(sys_read, [b.load(kickfd), b.bitcast(drain, void_ptr), c64(8)])
+                with ready:
+                    task = b.inttoptr(data, void_ptr)
+                    io = b.bitcast(task, self._fd_wait_type().as_pointer())
+                    b.store(b.load(b.gep(ev, [c32(0), c32(0)])), b.gep(io, [c32(0), c32(self.TASK_RESULT)]))
+                    b.call(epoll_ctl, [b.load(epfd), c32(EPOLL_CTL_DEL), b.load(b.gep(io, [c32(0), c32(self.TASK_RESULT + 1)])), ev])
+                    reactor_complete(b, task)
+                    b.store(b.add(b.load(fired), c32(1)), fired)
+            b.store(b.add(iv, c32(1)), i)
+        loop_until(b, reactor_poll, "events", lambda: b.icmp_signed("<", b.load(i), n), dispatch)
+        fire_timers()
+        b.ret(b.load(fired))
+
+        def idle(b, func, name, cond_fn):
+            # Take the poller role if the reactor has waiters and nobody
+            # holds it; otherwise sleep until work arrives or the role frees up
+            has_waiters = lambda: b.icmp_signed(">", b.load_atomic(waiting, 'seq_cst', 8), c64(0))
+            poller = b.alloca(i1)
+            b.store(false, poller)
+            with b.if_then(has_waiters()):
+                b.store(b.extract_value(b.cmpxchg(polling, c32(0), c32(1), 'seq_cst', 'seq_cst'), 1), poller)
+            with b.if_else(b.load(poller)) as (poll, park):
+                with poll:
+                    b.call(reactor_poll, [cond_fn()])
+                    b.store_atomic(c32(0), polling, 'seq_cst', 4)
+                    with b.if_then(b.and_(has_waiters(), b.icmp_signed(">", b.load_atomic(sleepers, 'seq_cst', 4), c32(0)))):
+                        notify(b, False)
+                with park:
+                    vacant = lambda: b.and_(has_waiters(), b.icmp_signed("==", b.load_atomic(polling, 'seq_cst', 4), c32(0)))
+                    sleep_while(b, func, name, lambda: b.and_(cond_fn(), b.not_(vacant())))
+
+        # __nexa_task_run_ready() -> resumed: help until spawned tasks finish
+        # (with no workers: until the queue is empty and no task waits on
+        # the reactor)
+        func, b = body('__nexa_task_run_ready')
+        count = b.alloca(i32)
+        b.store(c32(0), count)
+        loop_bb = func.append_basic_block("next")
+        idle_bb = func.append_basic_block("idle")
+        exit_bb = func.append_basic_block("finished")
+        b.branch(loop_bb)
+        b.position_at_end(loop_bb)
+        task = b.call(find, [b.call(current, [])])
+        with b.if_then(b.icmp_unsigned("!=", task, null)):
+            b.call(rt['__nexa_resume'], [task])
+            b.store(b.add(b.load(count), c32(1)), count)
+            b.branch(loop_bb)
+        live = lambda: b.icmp_signed(">", b.load_atomic(active, 'seq_cst', 8), c64(0))
+        can_progress = b.or_(b.icmp_signed(">", b.load(n_workers), c32(0)),
+                             b.icmp_signed(">", b.load_atomic(waiting, 'seq_cst', 8), c64(0)))
+        b.cbranch(b.and_(can_progress, live()), idle_bb, exit_bb)
+        b.position_at_end(idle_bb)
+        idle(b, func, "run_wait", lambda: b.and_(no_work(b), live()))
+        b.branch(loop_bb)
+        b.position_at_end(exit_bb)
+        b.ret(b.load(count))
+
+        # __nexa_block_on(task): help run tasks until `task` completes.
+        # The caller reads the result and destroys the frame.
+        func, b = body('__nexa_block_on')
+        task = func.args[0]
+        b.store(c8(self.TASK_BLOCKED_ON), field(b, task, self.TASK_DETACHED))
+        with b.if_then(b.icmp_signed("==", b.load(field(b, task, self.TASK_STATE)), c32(0))):
+            b.call(rt['__nexa_task_wake'], [task])
+        loop_bb = func.append_basic_block("poll")
+        step_bb = func.append_basic_block("step")
+        idle_bb = func.append_basic_block("idle")
+        exit_bb = func.append_basic_block("done")
+        b.branch(loop_bb)
+        b.position_at_end(loop_bb)
+        b.cbranch(b.call(rt['__nexa_is_done'], [task]), exit_bb, step_bb)
+        b.position_at_end(step_bb)
+        ready = b.call(find, [b.call(current, [])])
+        with b.if_then(b.icmp_unsigned("!=", ready, null)):
+            b.call(rt['__nexa_resume'], [ready])
+            b.branch(loop_bb)
+        stuck = b.and_(b.icmp_signed("==", b.load(n_workers), c32(0)),
+                       b.icmp_signed("==", b.load_atomic(waiting, 'seq_cst', 8), c64(0)))
+        with b.if_then(stuck):
+            # Nothing can make progress: the task waits on something never woken
+            b.call(self.printf, [self._global_cstring("__nexa_task_deadlock", "async: task blocked with an empty run queue\n")])
+            b.call(self.exit_func, [c32(1)])
+            b.unreachable()
+        b.branch(idle_bb)
+        b.position_at_end(idle_bb)
+        idle(b, func, "block_wait", lambda: b.and_(no_work(b), b.not_(b.call(rt['__nexa_is_done'], [task]))))
+        b.branch(loop_bb)
+        b.position_at_end(exit_bb)
+        b.ret_void()
+
+        # Worker thread: run tasks until shutdown, sleeping when idle
+        worker, b = internal("__nexa_worker_main", void_ptr, [void_ptr])
+        arg = worker.args[0]
+        b.call(setspecific, [b.load(worker_key), b.inttoptr(b.add(b.ptrtoint(arg, i64), c64(1)), void_ptr)])
+        me = b.trunc(b.ptrtoint(arg, i64), i32)
+        loop_bb = worker.append_basic_block("next")
+        idle_bb = worker.append_basic_block("idle")
+        exit_bb = worker.append_basic_block("exit")
+        b.branch(loop_bb)
+        b.position_at_end(loop_bb)
+        task = b.call(find, [me])
+        with b.if_then(b.icmp_unsigned("!=", task, null)):
+            b.call(rt['__nexa_resume'], [task])
+            b.branch(loop_bb)
+        stopping = lambda: b.icmp_signed("!=", b.load_atomic(shutdown, 'seq_cst', 4), c32(0))
+        b.cbranch(stopping(), exit_bb, idle_bb)
+        b.position_at_end(idle_bb)
+        idle(b, worker, "worker_wait", lambda: b.and_(no_work(b), b.not_(stopping())))
+        b.branch(loop_bb)
+        b.position_at_end(exit_bb)
+        b.ret(null)
+
+        key_init, b = internal("__nexa_rq_key_init", ir.VoidType(), [])
+        b.call(key_create, [worker_key, ir.Constant(dtor_ty.as_pointer(), None)])
+        b.ret_void()
+
+        # __nexa_executor_start(n) -> threads started (n <= 0: one per online CPU)
+        func, b = body('__nexa_executor_start')
+        req = func.args[0]
+        with b.if_then(b.icmp_signed(">", b.load(n_workers), c32(0))):
+            b.ret(b.load(n_workers))
+        online = b.trunc(b.call(sysconf, [c32(84)]), i32)  # _SC_NPROCESSORS_ONLN
+        count = b.select(b.icmp_signed(">", req, c32(0)), req, b.select(b.icmp_signed(">", online, c32(0)), online, c32(1)))
+        b.call(pthread_once, [key_once, key_init])
+        count64 = b.sext(count, i64)
+        deque_size = b.ptrtoint(b.gep(ir.Constant(deque_ptr, None), [c32(1)]), i64)
+        b.store(b.bitcast(b.call(calloc, [count64, deque_size]), deque_ptr), workers)
+        b.store(b.bitcast(b.call(calloc, [count64, c64(8)]), i64.as_pointer()), threads)
+        b.store(c32(0), shutdown)
+        b.store(count, n_workers)
+        i = b.alloca(i32)
+        b.store(c32(0), i)
+        def launch():
+            iv = b.load(i)
+            b.call(pthread_create, [b.gep(b.load(threads), [iv]), null, worker, b.inttoptr(b.sext(iv, i64), void_ptr)])
+            b.store(b.add(iv, c32(1)), i)
+        loop_until(b, func, "launch", lambda: b.icmp_signed("<", b.load(i), count), launch)
+        b.ret(count)
+
+        # __nexa_executor_shutdown(): let workers drain the queues, then join
+        func, b = body('__nexa_executor_shutdown')
+        n = b.load(n_workers)
+        with b.if_then(b.icmp_signed("==", n, c32(0))):
+            b.ret_void()
+        b.store_atomic(c32(1), shutdown, 'seq_cst', 4)
+        notify(b, True)
+        i = b.alloca(i32)
+        b.store(c32(0), i)
+        def join():
+            iv = b.load(i)
+            # std::thread may already have declared pthread_join with a *u8 result slot
+            b.call(pthread_join, [b.load(b.gep(b.load(threads), [iv])), ir.Constant(pthread_join.args[1].type, None)])
+            b.store(b.add(iv, c32(1)), i)
+        loop_until(b, func, "join", lambda: b.icmp_signed("<", b.load(i), n), join)
+        # workers are gone: whatever is left in their deques moves to the injector
+        b.store(c32(0), i)
+        def drain():
+            iv = b.load(i)
+            d = b.gep(b.load(workers), [iv])
+            def move():
+                b.call(push, [inject, b.call(take, [d, false])])
+            loop_until(b, func, "drain_one", lambda: b.icmp_signed(">", b.load(dq(b, d, 3)), c64(0)), move)
+            buf = b.load(dq(b, d, 1))
+            with b.if_then(b.icmp_unsigned("!=", buf, ir.Constant(buf.type, None))):
+                b.call(self.free, [b.bitcast(buf, void_ptr)])
+            b.store(b.add(iv, c32(1)), i)
+        loop_until(b, func, "drain", lambda: b.icmp_signed("<", b.load(i), n), drain)
+        b.store(c32(0), n_workers)
+        b.call(self.libc_free, [b.bitcast(b.load(workers), void_ptr)])
+        b.call(self.libc_free, [b.bitcast(b.load(threads), void_ptr)])
+        b.ret_void()
+
+        def new_leaf(b, leaf_ty, resume):
+            size = b.ptrtoint(b.gep(ir.Constant(leaf_ty.as_pointer(), None), [c32(1)]), i64)
+            task = b.call(self.malloc, [size])
+            b.store(b.bitcast(resume, void_ptr), field(b, task, self.TASK_RESUME))
+            b.store(null, field(b, task, self.TASK_WAITER))
+            b.store(c32(0), field(b, task, self.TASK_STATE))
+            b.store(c8(0), field(b, task, self.TASK_DONE))
+            b.store(c8(0), field(b, task, self.TASK_DETACHED))
+            return task
+
+        # __nexa_yield_now() -> task: a leaf that requeues its awaiter once
+        leaf_ty = ir.LiteralStructType(self._task_header_types() + [i8])
+        leaf_resume, b = internal("__nexa_yield_resume", ir.VoidType(), [void_ptr])
+        task = leaf_resume.args[0]
+        state = field(b, task, self.TASK_STATE)
+        with b.if_then(b.icmp_signed("==", b.load(state), c32(0))):
+            b.store(c32(1), state)
+            b.call(rt['__nexa_task_wake'], [task])
+            b.ret_void()
+        b.call(rt['__nexa_task_complete'], [task])
+        b.ret_void()
+
+        func, b = body('__nexa_yield_now')
+        b.ret(new_leaf(b, leaf_ty, leaf_resume))
+
+        # __nexa_waker_new() -> task: a parked leaf behind a std::future
+        # Waker. The first __nexa_waker_wake queues it and running it
+        # completes it, which releases a __nexa_block_on waiting on it.
+        waker_resume, b = internal("__nexa_waker_resume", ir.VoidType(), [void_ptr])
+        b.call(rt['__nexa_task_complete'], [waker_resume.args[0]])
+        b.ret_void()
+
+        func, b = body('__nexa_waker_new')
+        task = new_leaf(b, leaf_ty, waker_resume)
+        b.store(c32(1), field(b, task, self.TASK_STATE))
+        b.ret(task)
+
+        func, b = body('__nexa_waker_wake')
+        task = func.args[0]
+        first = b.cmpxchg(field(b, task, self.TASK_STATE), c32(1), c32(2), 'acq_rel', 'acquire')
+        with b.if_then(b.extract_value(first, 1)):
+            b.call(rt['__nexa_task_wake'], [task])
+        b.ret_void()
+
+        def wait_registered(b):
+            # A new reactor waiter (already in the heap or epoll set): hand
+            # the poller role to a sleeping thread if it is vacant, or make
+            # the poller recompute its timeout
+            b.atomic_rmw('add', waiting, c64(1), 'seq_cst')
+            b.call(kick, [])
+            vacant = b.icmp_signed("==", b.load_atomic(polling, 'seq_cst', 4), c32(0))
+            with b.if_then(b.and_(vacant, b.icmp_signed(">", b.load_atomic(sleepers, 'seq_cst', 4), c32(0)))):
+                notify(b, False)
+
+        # __nexa_sleep(ms) -> task: completes by the reactor once `ms`
+        # milliseconds have passed since it was first awaited
+        sleep_ty = ir.LiteralStructType(self._task_header_types() + [i64])
+        sleep_resume, b = internal("__nexa_sleep_resume", ir.VoidType(), [void_ptr])
+        task = sleep_resume.args[0]
+        b.store(c32(1), field(b, task, self.TASK_STATE))
+        ms = b.load(b.gep(b.bitcast(task, sleep_ty.as_pointer()), [c32(0), c32(self.TASK_RESULT)]))
+        b.call(pthread_once, [reactor_once, reactor_init])
+        b.call(timer_push, [b.add(b.call(now_ns, []), b.mul(ms, c64(1000000))), task])
+        wait_registered(b)
+        b.ret_void()
+
+        func, b = body('__nexa_sleep')
+        task = new_leaf(b, sleep_ty, sleep_resume)
+        b.store(func.args[0], b.gep(b.bitcast(task, sleep_ty.as_pointer()), [c32(0), c32(self.TASK_RESULT)]))
+        b.ret(task)
+
+        # __nexa_wait_fd(fd, events) -> task yielding the ready epoll events
+        # (-1 if the fd cannot be watched)
+        fd_ty = self._fd_wait_type()
+        fd_resume, b = internal("__nexa_wait_fd_resume", ir.VoidType(), [void_ptr])
+        task = fd_resume.args[0]
+        io = b.bitcast(task, fd_ty.as_pointer())
+        fd = b.load(b.gep(io, [c32(0), c32(self.TASK_RESULT + 1)]))
+        b.store(c32(1), field(b, task, self.TASK_STATE))
+        b.call(pthread_once, [reactor_once, reactor_init])
+        ev = b.alloca(event_ty)
+        wanted = b.or_(b.load(b.gep(io, [c32(0), c32(self.TASK_RESULT + 2)])), c32(EPOLLONESHOT))
+        b.store(wanted, b.gep(ev, [c32(0), c32(0)]))
+        b.store(b.ptrtoint(task, i64), b.gep(ev, [c32(0), c32(1)]))
+        with b.if_then(b.icmp_signed("!=", b.call(epoll_ctl, [b.load(epfd), c32(EPOLL_CTL_ADD), fd, ev]), c32(0))):
+            with b.if_then(b.icmp_signed("!=", b.call(epoll_ctl, [b.load(epfd), c32(EPOLL_CTL_MOD), fd, ev]), c32(0))):
+                b.store(c32(-1), b.gep(io, [c32(0), c32(self.TASK_RESULT)]))
+                b.call(rt['__nexa_task_complete'], [task])
+                b.ret_void()
+        wait_registered(b)
+        b.ret_void()
+
+        func, b = body('__nexa_wait_fd')
+        task = new_leaf(b, fd_ty, fd_resume)
+        io = b.bitcast(task, fd_ty.as_pointer())
+        b.store(c32(0), b.gep(io, [c32(0), c32(self.TASK_RESULT)]))
+        b.store(func.args[0], b.gep(io, [c32(0), c32(self.TASK_RESULT + 1)]))
+        b.store(func.args[1], b.gep(io, [c32(0), c32(self.TASK_RESULT + 2)]))
+        b.ret(task)
+
+    # Threads and channels. thread::spawn hands a closure to a new pthread;
+    # lambda environments live in the spawning frame, so the environment is
+    # copied to the heap first and freed by the trampoline when the closure
+    # returns. Channels are bounded rings of sequence-numbered slots:
+    # producers claim a slot with a CAS on `tail`, the single consumer
+    # advances `head`, and a thread only parks on the condvar when the ring
+    # is full (or empty) after CHAN_SPIN retries.
+    CHAN_TAIL, CHAN_HEAD, CHAN_MASK, CHAN_STRIDE, CHAN_BUF = 0, 2, 4, 5, 6
+    CHAN_SENDERS, CHAN_CLOSED, CHAN_WAITERS, CHAN_MUTEX, CHAN_COND = 7, 8, 9, 10, 11
+    CHAN_SPIN = 64
+
+    def _libc_function(self, name, ret, args):
+        return self.module.globals.get(name) or ir.Function(self.module, ir.FunctionType(ret, args), name=name)
+
+    def _declare_thread_runtime(self):
+        void_ptr = ir.IntType(8).as_pointer()
+        void = ir.VoidType()
+        i32 = ir.IntType(32)
+        i64 = ir.IntType(64)
+        pad = ir.ArrayType(ir.IntType(8), 56)
+        sync = ir.ArrayType(ir.IntType(8), 64)  # pthread_mutex_t / pthread_cond_t storage
+        # tail and head sit on their own cache lines
+        self.chan_type = self.module.context.get_identified_type("__nexa_chan")
+        self.chan_type.set_body(i64, pad, i64, pad, i64, i64, void_ptr, i32, i32, i32, sync, sync)
+        signatures = {
+            '__nexa_thread_start': (i64, [void_ptr, void_ptr]),
+            '__nexa_chan_new': (void_ptr, [i32, i32]),
+            '__nexa_chan_reserve': (void_ptr, [void_ptr]),
+            '__nexa_chan_commit': (void, [void_ptr, void_ptr]),
+            '__nexa_chan_peek': (void_ptr, [void_ptr]),
+            '__nexa_chan_release': (void, [void_ptr]),
+            '__nexa_chan_add_sender': (void, [void_ptr]),
+            '__nexa_chan_drop_sender': (void, [void_ptr]),
+            '__nexa_chan_len': (i32, [void_ptr]),
+            '__nexa_chan_free': (void, [void_ptr]),
+        }
+        self._thread_rt = {}
+        for name, (ret, args) in signatures.items():
+            func = self.module.globals.get(name)
+            if func is None:
+                func = ir.Function(self.module, ir.FunctionType(ret, args), name=name)
+            self._thread_rt[name] = func
+
+    def _mark_sent_captures(self, args):
+        # Captures of a closure sent to another thread belong to that
+        # thread now: don't drop them at the end of this scope
+        for arg in args:
+            lambda_name = self._lambda_of(arg)
+            lambda_def = self._function_nodes.get(lambda_name)
+            if lambda_def is None:
+                continue
+            for name in getattr(lambda_def.lambda_node, 'captures', {}):
+                self._mark_moved(VariableExpr(name))
+
+    def _emit_thread_spawn(self, node):
+        # __nexa_thread_spawn(closure) -> pthread id. Only a closure whose
+        # lambda is known here has a known environment size to copy.
+        self._uses_threads = True
+        void_ptr = ir.IntType(8).as_pointer()
+        i32 = ir.IntType(32)
+        arg = node.args[0]
+        lambda_name = self._lambda_of(arg)
+        fat = self.visit(arg)
+        self._mark_sent_captures([arg])
+        fn_ptr = self.builder.extract_value(fat, 0)
+        env = self.builder.extract_value(fat, 1)
+        env_name = f"{lambda_name}_env"
+        if lambda_name and env_name in self.struct_types:
+            env_ty = self.struct_types[env_name]
+            size = self.builder.ptrtoint(self.builder.gep(ir.Constant(env_ty.as_pointer(), None), [ir.Constant(i32, 1)]), ir.IntType(64))
+            heap = self._emit_heap_alloc(size, node)
+            self.builder.call(self.memcpy, [heap, env, self.builder.trunc(size, i32), ir.Constant(ir.IntType(1), 0)])
+            env = heap
+            fn_ptr = self._thread_entry(lambda_name, fn_ptr)
+        elif lambda_name is None:
+            # Opaque closure: only a capture-free one can be sent as is
+            with self.builder.if_then(self.builder.icmp_unsigned("!=", env, ir.Constant(void_ptr, None))):
+                msg = self.visit_StringLiteral(None, name="spawn_err", value_override="thread::spawn: closure environment is not known at the call site\n\0")
+                self.builder.call(self.printf, [msg])
+                self.builder.call(self.exit_func, [ir.Constant(i32, 1)])
+        else:
+            env = ir.Constant(void_ptr, None)
+        return self.builder.call(self._thread_rt['__nexa_thread_start'], [fn_ptr, env])
+
+    def _thread_entry(self, lambda_name, fn_ptr):
+        # The spawned closure owns its captures: when it has droppable ones,
+        # run it through a wrapper that drops them once the closure returns.
+        void_ptr = ir.IntType(8).as_pointer()
+        env_name = f"{lambda_name}_env"
+        captures = self._function_nodes[lambda_name].lambda_node.captures
+        owned = [(name, t) for name, t in sorted(captures.items()) if self._find_drop_func(t)]
+        if not owned:
+            return fn_ptr
+        entry = self.module.globals.get(f"{lambda_name}__thread")
+        if entry is None:
+            entry = ir.Function(self.module, ir.FunctionType(ir.VoidType(), [void_ptr]), name=f"{lambda_name}__thread")
+            entry.linkage = 'internal'
+            saved = self.builder
+            self.builder = ir.IRBuilder(entry.append_basic_block("entry"))
+            self.builder.call(self.module.get_global(lambda_name), [entry.args[0]])
+            env = self.builder.bitcast(entry.args[0], self.struct_types[env_name].as_pointer())
+            for name, type_name in reversed(owned):
+                idx = self.struct_fields[env_name][name]
+                self._emit_drop(self.builder.gep(env, [ir.Constant(ir.IntType(32), 0), ir.Constant(ir.IntType(32), idx)]), type_name)
+            self.builder.ret_void()
+            self.builder = saved
+        return self.builder.bitcast(entry, void_ptr)
+
+    def _define_thread_runtime(self):
+        void_ptr = ir.IntType(8).as_pointer()
+        i1 = ir.IntType(1)
+        i32 = ir.IntType(32)
+        i64 = ir.IntType(64)
+        c32 = lambda v: ir.Constant(i32, v)
+        c64 = lambda v: ir.Constant(i64, v)
+        null = ir.Constant(void_ptr, None)
+        rt = self._thread_rt
+        libc = self._libc_function
+        chan_ptr = self.chan_type.as_pointer()
+        free = self._track.get('free', self.free)
+
+        pthread_create = libc("pthread_create", i32, [i64.as_pointer(), void_ptr, ir.FunctionType(void_ptr, [void_ptr]).as_pointer(), void_ptr])
+        mutex_init = libc("pthread_mutex_init", i32, [void_ptr, void_ptr])
+        mutex_destroy = libc("pthread_mutex_destroy", i32, [void_ptr])
+        mutex_lock = libc("pthread_mutex_lock", i32, [void_ptr])
+        mutex_unlock = libc("pthread_mutex_unlock", i32, [void_ptr])
+        cond_init = libc("pthread_cond_init", i32, [void_ptr, void_ptr])
+        cond_destroy = libc("pthread_cond_destroy", i32, [void_ptr])
+        cond_wait = libc("pthread_cond_wait", i32, [void_ptr, void_ptr])
+        cond_broadcast = libc("pthread_cond_broadcast", i32, [void_ptr])
+        calloc = libc("calloc", void_ptr, [i64, i64])
+
+        def body(name):
+            func = rt[name]
+            return func, ir.IRBuilder(func.append_basic_block("entry"))
+
+        def chan(b, raw, index):
+            return b.gep(b.bitcast(raw, chan_ptr), [c32(0), c32(index)])
+
+        def sync_obj(b, raw, index):
+            return b.bitcast(chan(b, raw, index), void_ptr)
+
+        def slot_seq(b, raw, pos):
+            # sequence word of the slot for ring position `pos`; data follows it
+            index = b.and_(pos, b.load(chan(b, raw, self.CHAN_MASK)))
+            slot = b.gep(b.load(chan(b, raw, self.CHAN_BUF)), [b.mul(index, b.load(chan(b, raw, self.CHAN_STRIDE)))])
+            return b.bitcast(slot, i64.as_pointer())
+
+        def data_of(b, seq):
+            return b.gep(b.bitcast(seq, void_ptr), [c64(8)])
+
+        def notify(b, raw):
+            with b.if_then(b.icmp_signed(">", b.load_atomic(chan(b, raw, self.CHAN_WAITERS), 'seq_cst', 4), c32(0))):
+                b.call(mutex_lock, [sync_obj(b, raw, self.CHAN_MUTEX)])
+                b.call(cond_broadcast, [sync_obj(b, raw, self.CHAN_COND)])
+                b.call(mutex_unlock, [sync_obj(b, raw, self.CHAN_MUTEX)])
+
+        def wait_or_spin(b, func, raw, spins, blocked_fn):
+            # Retry a few times, then park until `blocked_fn` turns false.
+            # `waiters` goes up before the re-check, pairing with notify().
+            count = b.load(spins)
+            with b.if_else(b.icmp_signed("<", count, c32(self.CHAN_SPIN))) as (spin, park):
+                with spin:
+                    b.store(b.add(count, c32(1)), spins)
+                with park:
+                    b.store(c32(0), spins)
+                    waiters = chan(b, raw, self.CHAN_WAITERS)
+                    b.call(mutex_lock, [sync_obj(b, raw, self.CHAN_MUTEX)])
+                    b.atomic_rmw('add', waiters, c32(1), 'seq_cst')
+                    head = func.append_basic_block("park_check")
+                    wait = func.append_basic_block("park_wait")
+                    done = func.append_basic_block("park_done")
+                    b.branch(head)
+                    b.position_at_end(head)
+                    b.cbranch(blocked_fn(), wait, done)
+                    b.position_at_end(wait)
+                    b.call(cond_wait, [sync_obj(b, raw, self.CHAN_COND), sync_obj(b, raw, self.CHAN_MUTEX)])
+                    b.branch(head)
+                    b.position_at_end(done)
+                    b.atomic_rmw('sub', waiters, c32(1), 'seq_cst')
+                    b.call(mutex_unlock, [sync_obj(b, raw, self.CHAN_MUTEX)])
+
+        closed = lambda b, raw: b.icmp_signed("!=", b.load_atomic(chan(b, raw, self.CHAN_CLOSED), 'seq_cst', 4), c32(0))
+
+        # Thread entry: run the closure, then free its heap environment
+        trampoline = ir.Function(self.module, ir.FunctionType(void_ptr, [void_ptr]), name="__nexa_thread_main")
+        trampoline.linkage = 'internal'
+        b = ir.IRBuilder(trampoline.append_basic_block("entry"))
+        record = b.bitcast(trampoline.args[0], void_ptr.as_pointer())
+        fn = b.load(record)
+        env = b.load(b.gep(record, [c32(1)]))
+        b.call(self.free, [trampoline.args[0]])
+        b.call(b.bitcast(fn, ir.FunctionType(ir.VoidType(), [void_ptr]).as_pointer()), [env])
+        with b.if_then(b.icmp_unsigned("!=", env, null)):
+            b.call(free, [env])
+        b.ret(null)
+
+        func, b = body('__nexa_thread_start')
+        record = b.call(self.malloc, [c64(16)])
+        slots = b.bitcast(record, void_ptr.as_pointer())
+        b.store(func.args[0], slots)
+        b.store(func.args[1], b.gep(slots, [c32(1)]))
+        tid = b.alloca(i64)
+        with b.if_then(b.icmp_signed("!=", b.call(pthread_create, [tid, null, trampoline, record]), c32(0))):
+            b.call(self.printf, [self._global_cstring("__nexa_thread_failed", "thread::spawn: pthread_create failed\n")])
+            b.call(self.exit_func, [c32(1)])
+        b.ret(b.load(tid))
+
+        # __nexa_chan_new(capacity, elem_size): capacity rounds up to a power of two
+        func, b = body('__nexa_chan_new')
+        want, elem = [b.sext(a, i64) for a in func.args]
+        cap = b.alloca(i64)
+        b.store(c64(2), cap)
+        grow_head = func.append_basic_block("round_up")
+        grow_body = func.append_basic_block("double")
+        grown = func.append_basic_block("sized")
+        b.branch(grow_head)
+        b.position_at_end(grow_head)
+        b.cbranch(b.icmp_signed("<", b.load(cap), want), grow_body, grown)
+        b.position_at_end(grow_body)
+        b.store(b.mul(b.load(cap), c64(2)), cap)
+        b.branch(grow_head)
+        b.position_at_end(grown)
+        capacity = b.load(cap)
+        stride = b.add(c64(8), b.and_(b.add(elem, c64(7)), c64(-8)))
+        size = b.ptrtoint(b.gep(ir.Constant(chan_ptr, None), [c32(1)]), i64)
+        raw = b.call(calloc, [c64(1), size])
+        buf = b.call(calloc, [capacity, stride])
+        b.store(b.sub(capacity, c64(1)), chan(b, raw, self.CHAN_MASK))
+        b.store(stride, chan(b, raw, self.CHAN_STRIDE))
+        b.store(buf, chan(b, raw, self.CHAN_BUF))
+        # slot i starts out expecting the producer at position i
+        i = b.alloca(i64)
+        b.store(c64(0), i)
+        init_head = func.append_basic_block("init_slots")
+        init_body = func.append_basic_block("init_slot")
+        init_done = func.append_basic_block("init_done")
+        b.branch(init_head)
+        b.position_at_end(init_head)
+        b.cbranch(b.icmp_signed("<", b.load(i), capacity), init_body, init_done)
+        b.position_at_end(init_body)
+        iv = b.load(i)
+        b.store(iv, slot_seq(b, raw, iv))
+        b.store(b.add(iv, c64(1)), i)
+        b.branch(init_head)
+        b.position_at_end(init_done)
+        b.call(mutex_init, [sync_obj(b, raw, self.CHAN_MUTEX), null])
+        b.call(cond_init, [sync_obj(b, raw, self.CHAN_COND), null])
+        b.ret(raw)
+
+        # __nexa_chan_reserve(chan) -> slot data to fill, or null once closed
+        func, b = body('__nexa_chan_reserve')
+        raw = func.args[0]
+        spins = b.alloca(i32)
+        b.store(c32(0), spins)
+        loop_bb = func.append_basic_block("claim")
+        b.branch(loop_bb)
+        b.position_at_end(loop_bb)
+        with b.if_then(closed(b, raw)):
+            b.ret(null)
+        tail = chan(b, raw, self.CHAN_TAIL)
+        pos = b.load_atomic(tail, 'monotonic', 8)
+        seq = slot_seq(b, raw, pos)
+        diff = b.sub(b.load_atomic(seq, 'acquire', 8), pos)
+        with b.if_then(b.icmp_signed("==", diff, c64(0))):
+            claimed = b.cmpxchg(tail, pos, b.add(pos, c64(1)), 'acq_rel', 'monotonic')
+            with b.if_then(b.extract_value(claimed, 1)):
+                b.ret(data_of(b, seq))
+            b.branch(loop_bb)
+        with b.if_then(b.icmp_signed("<", diff, c64(0))):
+            # full: the consumer has not released this slot's previous lap
+            full = lambda: b.and_(b.icmp_signed("<", b.sub(b.load_atomic(seq, 'seq_cst', 8), pos), c64(0)), b.not_(closed(b, raw)))
+            wait_or_spin(b, func, raw, spins, full)
+        b.branch(loop_bb)
+
+        # __nexa_chan_commit(chan, data): publish a filled slot
+        func, b = body('__nexa_chan_commit')
+        raw, data = func.args
+        seq = b.bitcast(b.gep(data, [c64(-8)]), i64.as_pointer())
+        b.store_atomic(b.add(b.load(seq), c64(1)), seq, 'seq_cst', 8)
+        notify(b, raw)
+        b.ret_void()
+
+        # __nexa_chan_peek(chan) -> next item, or null once closed and drained
+        func, b = body('__nexa_chan_peek')
+        raw = func.args[0]
+        spins = b.alloca(i32)
+        b.store(c32(0), spins)
+        loop_bb = func.append_basic_block("poll")
+        b.branch(loop_bb)
+        b.position_at_end(loop_bb)
+        pos = b.load_atomic(chan(b, raw, self.CHAN_HEAD), 'monotonic', 8)
+        seq = slot_seq(b, raw, pos)
+        ready = lambda: b.icmp_signed("==", b.load_atomic(seq, 'seq_cst', 8), b.add(pos, c64(1)))
+        with b.if_then(ready()):
+            b.ret(data_of(b, seq))
+        # closed with no claimed slot left behind: nothing more will arrive
+        drained = lambda: b.and_(closed(b, raw), b.icmp_signed("==", b.load_atomic(chan(b, raw, self.CHAN_TAIL), 'seq_cst', 8), pos))
+        with b.if_then(drained()):
+            b.ret(null)
+        wait_or_spin(b, func, raw, spins, lambda: b.and_(b.not_(ready()), b.not_(drained())))
+        b.branch(loop_bb)
+
+        # __nexa_chan_release(chan): the consumer is done with the peeked slot
+        func, b = body('__nexa_chan_release')
+        raw = func.args[0]
+        head = chan(b, raw, self.CHAN_HEAD)
+        pos = b.load(head)
+        seq = slot_seq(b, raw, pos)
+        b.store_atomic(b.add(pos, c64(1)), head, 'release', 8)
+        b.store_atomic(b.add(pos, b.add(b.load(chan(b, raw, self.CHAN_MASK)), c64(1))), seq, 'seq_cst', 8)
+        notify(b, raw)
+        b.ret_void()
+
+        func, b = body('__nexa_chan_add_sender')
+        b.atomic_rmw('add', chan(b, func.args[0], self.CHAN_SENDERS), c32(1), 'seq_cst')
+        b.ret_void()
+
+        # The last sender closes the channel
+        func, b = body('__nexa_chan_drop_sender')
+        raw = func.args[0]
+        left = b.atomic_rmw('sub', chan(b, raw, self.CHAN_SENDERS), c32(1), 'seq_cst')
+        with b.if_then(b.icmp_signed("<=", left, c32(1))):
+            b.store_atomic(c32(1), chan(b, raw, self.CHAN_CLOSED), 'seq_cst', 4)
+            notify(b, raw)
+        b.ret_void()
+
+        func, b = body('__nexa_chan_len')
+        raw = func.args[0]
+        tail = b.load_atomic(chan(b, raw, self.CHAN_TAIL), 'acquire', 8)
+        head = b.load_atomic(chan(b, raw, self.CHAN_HEAD), 'acquire', 8)
+        b.ret(b.trunc(b.sub(tail, head), i32))
+
+        func, b = body('__nexa_chan_free')
+        raw = func.args[0]
+        b.call(mutex_destroy, [sync_obj(b, raw, self.CHAN_MUTEX)])
+        b.call(cond_destroy, [sync_obj(b, raw, self.CHAN_COND)])
+        b.call(self.libc_free, [b.load(chan(b, raw, self.CHAN_BUF))])
+        b.call(self.libc_free, [raw])
+        b.ret_void()
+
+    # Data-parallel loops (std::par): one lazily started pool of
+    # (online CPUs - 1) detached workers, with the calling thread as
+    # participant 0. __nexa_par_for(n, grain, body) runs body(lo, hi) over
+    # disjoint ranges covering [0, n). Each participant starts with an even
+    # slice of the range and takes chunks off its front, sized to an eighth
+    # of what is left (never below `grain`), so chunks shrink as the slice
+    # empties; a participant that runs dry steals the back half of another's
+    # slice. Calls made from inside a parallel loop run inline.
+    PAR_RANGE_LOCK, PAR_RANGE_LO, PAR_RANGE_HI = 0, 1, 2
+    PAR_CHUNK_DIV = 8
+
+    def _declare_par_runtime(self):
+        void_ptr = ir.IntType(8).as_pointer()
+        i64 = ir.IntType(64)
+        closure = ir.LiteralStructType([void_ptr, void_ptr])
+        # {lock, lo, hi}, padded to a cache line
+        self.par_range_type = self.module.context.get_identified_type("__nexa_par_range")
+        self.par_range_type.set_body(ir.IntType(32), i64, i64, ir.ArrayType(ir.IntType(8), 40))
+        signatures = {
+            '__nexa_par_for': (ir.VoidType(), [i64, i64, closure]),
+            '__nexa_par_threads': (ir.IntType(32), []),
+            # gpu::dispatch CPU backend
+            '__nexa_gpu_launch': (ir.VoidType(), [void_ptr, i64, i64, void_ptr]),
+            '__nexa_gpu_run': (ir.VoidType(), [void_ptr, void_ptr, i64, i64]),
+            '__nexa_gpu_set_id': (ir.VoidType(), [ir.IntType(32)]),
+            '__nexa_gpu_global_id': (ir.IntType(32), []),
+        }
+        self._par_rt = {}
+        for name, (ret, args) in signatures.items():
+            func = self.module.globals.get(name)
+            if func is None:
+                func = ir.Function(self.module, ir.FunctionType(ret, args), name=name)
+            self._par_rt[name] = func
+
+    def _define_par_runtime(self):
+        void_ptr = ir.IntType(8).as_pointer()
+        i32 = ir.IntType(32)
+        i64 = ir.IntType(64)
+        c32 = lambda v: ir.Constant(i32, v)
+        c64 = lambda v: ir.Constant(i64, v)
+        null = ir.Constant(void_ptr, None)
+        rt = self._par_rt
+        libc = self._libc_function
+        range_ptr = self.par_range_type.as_pointer()
+        body_ty = ir.FunctionType(ir.VoidType(), [void_ptr, i64, i64])
+        entry_ty = ir.FunctionType(void_ptr, [void_ptr])
+        init_ty = ir.FunctionType(ir.VoidType(), [])
+
+        pthread_create = libc("pthread_create", i32, [i64.as_pointer(), void_ptr, entry_ty.as_pointer(), void_ptr])
+        pthread_detach = libc("pthread_detach", i32, [i64])
+        pthread_once = libc("pthread_once", i32, [i32.as_pointer(), init_ty.as_pointer()])
+        key_create = libc("pthread_key_create", i32, [i32.as_pointer(), ir.FunctionType(ir.VoidType(), [void_ptr]).as_pointer()])
+        getspecific = libc("pthread_getspecific", void_ptr, [i32])
+        setspecific = libc("pthread_setspecific", i32, [i32, void_ptr])
+        mutex_lock = libc("pthread_mutex_lock", i32, [void_ptr])
+        mutex_unlock = libc("pthread_mutex_unlock", i32, [void_ptr])
+        cond_wait = libc("pthread_cond_wait", i32, [void_ptr, void_ptr])
+        cond_broadcast = libc("pthread_cond_broadcast", i32, [void_ptr])
+        sched_yield = libc("sched_yield", i32, [])
+        sysconf = libc("sysconf", i64, [i32])
+        calloc = libc("calloc", void_ptr, [i64, i64])
+
+        def body(name):
+            func = rt[name]
+            return func, ir.IRBuilder(func.append_basic_block("entry"))
+
+        def internal(name, ret, args):
+            func = ir.Function(self.module, ir.FunctionType(ret, args), name=name)
+            func.linkage = 'internal'
+            return func, ir.IRBuilder(func.append_basic_block("entry"))
+
+        def global_var(name, ty, init=None):
+            gv = ir.GlobalVariable(self.module, ty, name=name)
+            gv.linkage = 'internal'
+            gv.initializer = ir.Constant(ty, init)
+            return gv
+
+        def sync_var(name):
+            # glibc: PTHREAD_MUTEX_INITIALIZER / PTHREAD_COND_INITIALIZER are all-zero
+            gv = global_var(name, ir.ArrayType(ir.IntType(8), 64))
+            gv.align = 16
+            return lambda b: b.bitcast(gv, void_ptr)
+
+        def loop_until(b, func, name, cond_fn, body_fn):
+            # while (cond_fn()) body_fn()
+            head = func.append_basic_block(f"{name}_head")
+            step = func.append_basic_block(f"{name}_body")
+            done = func.append_basic_block(f"{name}_done")
+            b.branch(head)
+            b.position_at_end(head)
+            b.cbranch(cond_fn(), step, done)
+            b.position_at_end(step)
+            body_fn()
+            if not b.block.is_terminated:
+                b.branch(head)
+            b.position_at_end(done)
+
+        def spin_lock(b, func, lock):
+            loop_until(b, func, "spin", lambda: b.icmp_signed("!=", b.atomic_rmw('xchg', lock, c32(1), 'acquire'), c32(0)),
+                       lambda: b.call(sched_yield, []))
+
+        def spin_unlock(b, lock):
+            b.store_atomic(c32(0), lock, 'release', 4)
+
+        once = global_var("__nexa_par_once", i32, 0)  # PTHREAD_ONCE_INIT
+        in_loop_key = global_var("__nexa_par_key", i32, 0)  # set while running loop bodies
+        n_threads = global_var("__nexa_par_nthreads", i32, 1)  # participants, caller included
+        ranges = global_var("__nexa_par_ranges", range_ptr)  # calloc'd [n_threads x range]
+        job_mutex = sync_var("__nexa_par_job_mutex")  # one loop on the pool at a time
+        mutex = sync_var("__nexa_par_mutex")
+        start_cond = sync_var("__nexa_par_start")  # workers: a new loop is open
+        done_cond = sync_var("__nexa_par_done")  # caller: every worker checked in
+        generation = global_var("__nexa_par_gen", i64, 0)
+        is_open = global_var("__nexa_par_open", i32, 0)
+        checked_in = global_var("__nexa_par_checked_in", i32, 0)  # workers done with this loop
+        job_fn = global_var("__nexa_par_fn", void_ptr)
+        job_env = global_var("__nexa_par_env", void_ptr)
+        job_grain = global_var("__nexa_par_grain", i64, 1)
+
+        def slot(b, k, index):
+            return b.gep(b.load(ranges), [k, c32(index)])
+
+        # __nexa_par_claim(k, &lo, &hi) -> 0 when participant k's slice is empty
+        claim, b = internal("__nexa_par_claim", i32, [i32, i64.as_pointer(), i64.as_pointer()])
+        k, out_lo, out_hi = claim.args
+        lock = slot(b, k, self.PAR_RANGE_LOCK)
+        spin_lock(b, claim, lock)
+        lo = b.load(slot(b, k, self.PAR_RANGE_LO))
+        hi = b.load(slot(b, k, self.PAR_RANGE_HI))
+        left = b.sub(hi, lo)
+        with b.if_then(b.icmp_signed("<=", left, c64(0))):
+            spin_unlock(b, lock)
+            b.ret(c32(0))
+        chunk = b.sdiv(left, c64(self.PAR_CHUNK_DIV))
+        grain = b.load(job_grain)
+        chunk = b.select(b.icmp_signed("<", chunk, grain), grain, chunk)
+        chunk = b.select(b.icmp_signed(">", chunk, left), left, chunk)
+        end = b.add(lo, chunk)
+        b.store(end, slot(b, k, self.PAR_RANGE_LO))
+        spin_unlock(b, lock)
+        b.store(lo, out_lo)
+        b.store(end, out_hi)
+        b.ret(c32(1))
+
+        # __nexa_par_steal(k) -> 0 when no other slice had work. The victim
+        # is unlocked before our own (empty) slice is refilled, so two
+        # thieves never hold each other's locks.
+        steal, b = internal("__nexa_par_steal", i32, [i32])
+        k = steal.args[0]
+        n = b.load(n_threads)
+        i = b.alloca(i32)
+        b.store(c32(1), i)
+        def try_victim():
+            iv = b.load(i)
+            b.store(b.add(iv, c32(1)), i)
+            victim = b.srem(b.add(k, iv), n)
+            vlock = slot(b, victim, self.PAR_RANGE_LOCK)
+            spin_lock(b, steal, vlock)
+            lo = b.load(slot(b, victim, self.PAR_RANGE_LO))
+            hi = b.load(slot(b, victim, self.PAR_RANGE_HI))
+            left = b.sub(hi, lo)
+            with b.if_then(b.icmp_signed(">", left, c64(0))):
+                mid = b.sub(hi, b.sdiv(b.add(left, c64(1)), c64(2)))
+                b.store(mid, slot(b, victim, self.PAR_RANGE_HI))
+                spin_unlock(b, vlock)
+                own = slot(b, k, self.PAR_RANGE_LOCK)
+                spin_lock(b, steal, own)
+                b.store(mid, slot(b, k, self.PAR_RANGE_LO))
+                b.store(hi, slot(b, k, self.PAR_RANGE_HI))
+                spin_unlock(b, own)
+                b.ret(c32(1))
+            spin_unlock(b, vlock)
+        loop_until(b, steal, "victims", lambda: b.icmp_signed("<", b.load(i), n), try_victim)
+        b.ret(c32(0))
+
+        # __nexa_par_run(k): claim and run chunks until every slice is empty
+        run, b = internal("__nexa_par_run", ir.VoidType(), [i32])
+        k = run.args[0]
+        lo = b.alloca(i64)
+        hi = b.alloca(i64)
+        fn = b.bitcast(b.load(job_fn), body_ty.as_pointer())
+        env = b.load(job_env)
+        head = run.append_basic_block("claim")
+        take = run.append_basic_block("run_chunk")
+        dry = run.append_basic_block("dry")
+        done = run.append_basic_block("done")
+        b.branch(head)
+        b.position_at_end(head)
+        b.cbranch(b.icmp_signed("!=", b.call(claim, [k, lo, hi]), c32(0)), take, dry)
+        b.position_at_end(take)
+        b.call(fn, [env, b.load(lo), b.load(hi)])
+        b.branch(head)
+        b.position_at_end(dry)
+        b.cbranch(b.icmp_signed("!=", b.call(steal, [k]), c32(0)), head, done)
+        b.position_at_end(done)
+        b.ret_void()
+
+        # Pool worker: wake for each new loop, help while it is open, then
+        # check in. The pool mutex is held from check-in until the next
+        # cond_wait, so once all workers have checked in none of them is
+        # touching the loop (or running anything) any more.
+        worker, b = internal("__nexa_par_worker", void_ptr, [void_ptr])
+        k = b.trunc(b.ptrtoint(worker.args[0], i64), i32)
+        b.call(setspecific, [b.load(in_loop_key), ir.Constant(i64, 1).inttoptr(void_ptr)])
+        seen = b.alloca(i64)
+        b.store(c64(0), seen)
+        b.call(mutex_lock, [mutex(b)])
+        forever = worker.append_basic_block("serve")
+        b.branch(forever)
+        b.position_at_end(forever)
+        loop_until(b, worker, "idle", lambda: b.icmp_signed("==", b.load(generation), b.load(seen)),
+                   lambda: b.call(cond_wait, [start_cond(b), mutex(b)]))
+        b.store(b.load(generation), seen)
+        with b.if_then(b.icmp_signed("!=", b.load(is_open), c32(0))):
+            b.call(mutex_unlock, [mutex(b)])
+            b.call(run, [k])
+            b.call(mutex_lock, [mutex(b)])
+        arrived = b.add(b.load(checked_in), c32(1))
+        b.store(arrived, checked_in)
+        with b.if_then(b.icmp_signed("==", arrived, b.sub(b.load(n_threads), c32(1)))):
+            b.call(cond_broadcast, [done_cond(b)])
+        b.branch(forever)
+
+        # pthread_once: size the pool and start its workers
+        init, b = internal("__nexa_par_init", ir.VoidType(), [])
+        b.call(key_create, [in_loop_key, ir.Constant(ir.FunctionType(ir.VoidType(), [void_ptr]).as_pointer(), None)])
+        online = b.trunc(b.call(sysconf, [c32(84)]), i32)  # _SC_NPROCESSORS_ONLN
+        count = b.select(b.icmp_signed(">", online, c32(0)), online, c32(1))
+        range_size = b.ptrtoint(b.gep(ir.Constant(range_ptr, None), [c32(1)]), i64)
+        b.store(b.bitcast(b.call(calloc, [b.sext(count, i64), range_size]), range_ptr), ranges)
+        # workers are numbered from 1 as they start; the pool is whatever started
+        tid = b.alloca(i64)
+        started = b.alloca(i32)
+        b.store(c32(1), started)
+        i = b.alloca(i32)
+        b.store(c32(1), i)
+        def launch():
+            k = b.load(started)
+            with b.if_then(b.icmp_signed("==", b.call(pthread_create, [tid, null, worker, b.inttoptr(b.sext(k, i64), void_ptr)]), c32(0))):
+                b.call(pthread_detach, [b.load(tid)])
+                b.store(b.add(k, c32(1)), started)
+            b.store(b.add(b.load(i), c32(1)), i)
+        loop_until(b, init, "launch", lambda: b.icmp_signed("<", b.load(i), count), launch)
+        b.store(b.load(started), n_threads)
+        b.ret_void()
+
+        func, b = body('__nexa_par_threads')
+        b.call(pthread_once, [once, init])
+        b.ret(b.load(n_threads))
+
+        # __nexa_par_for(n, grain, body)
+        func, b = body('__nexa_par_for')
+        n, grain, closure = func.args
+        fn = b.extract_value(closure, 0)
+        env = b.extract_value(closure, 1)
+        with b.if_then(b.icmp_signed("<=", n, c64(0))):
+            b.ret_void()
+        grain = b.select(b.icmp_signed("<", grain, c64(1)), c64(1), grain)
+        b.call(pthread_once, [once, init])
+        p = b.load(n_threads)
+        nested = b.icmp_unsigned("!=", b.call(getspecific, [b.load(in_loop_key)]), null)
+        small = b.icmp_signed("<=", n, grain)
+        with b.if_then(b.or_(b.or_(nested, small), b.icmp_signed("==", p, c32(1)))):
+            b.call(b.bitcast(fn, body_ty.as_pointer()), [env, c64(0), n])
+            b.ret_void()
+        b.call(mutex_lock, [job_mutex(b)])
+        b.store(fn, job_fn)
+        b.store(env, job_env)
+        b.store(grain, job_grain)
+        p64 = b.sext(p, i64)
+        i = b.alloca(i32)
+        b.store(c32(0), i)
+        def split():
+            iv = b.load(i)
+            k64 = b.sext(iv, i64)
+            b.store(c32(0), slot(b, iv, self.PAR_RANGE_LOCK))
+            b.store(b.sdiv(b.mul(k64, n), p64), slot(b, iv, self.PAR_RANGE_LO))
+            b.store(b.sdiv(b.mul(b.add(k64, c64(1)), n), p64), slot(b, iv, self.PAR_RANGE_HI))
+            b.store(b.add(iv, c32(1)), i)
+        loop_until(b, func, "split", lambda: b.icmp_signed("<", b.load(i), p), split)
+        b.call(mutex_lock, [mutex(b)])
+        b.store(b.add(b.load(generation), c64(1)), generation)
+        b.store(c32(1), is_open)
+        b.store(c32(0), checked_in)
+        b.call(cond_broadcast, [start_cond(b)])
+        b.call(mutex_unlock, [mutex(b)])
+        b.call(setspecific, [b.load(in_loop_key), ir.Constant(i64, 1).inttoptr(void_ptr)])
+        b.call(run, [c32(0)])
+        b.call(setspecific, [b.load(in_loop_key), null])
+        # our slices are empty: close the loop (late wakers skip it) and
+        # wait for workers still running chunks before the slices are reused
+        b.call(mutex_lock, [mutex(b)])
+        b.store(c32(0), is_open)
+        loop_until(b, func, "finish", lambda: b.icmp_signed("<", b.load(checked_in), b.sub(p, c32(1))),
+                   lambda: b.call(cond_wait, [done_cond(b), mutex(b)]))
+        b.call(mutex_unlock, [mutex(b)])
+        b.call(mutex_unlock, [job_mutex(b)])
+        b.ret_void()
+
+        # gpu::dispatch on the CPU: __nexa_gpu_launch(launcher, threads, grain,
+        # args) runs the kernel's launcher over [0, threads) as a parallel loop.
+        # Global ids live in a pthread key (MCJIT has no TLS); a kernel
+        # called outside a dispatch sees id 0.
+        gpu_once = global_var("__nexa_gpu_once", i32, 0)
+        gpu_key = global_var("__nexa_gpu_key", i32, 0)
+        gpu_init, b = internal("__nexa_gpu_key_init", ir.VoidType(), [])
+        b.call(key_create, [gpu_key, ir.Constant(ir.FunctionType(ir.VoidType(), [void_ptr]).as_pointer(), None)])
+        b.ret_void()
 
-        # malloc
+        func, b = body('__nexa_gpu_global_id')
+        b.call(pthread_once, [gpu_once, gpu_init])
+        b.ret(b.trunc(b.ptrtoint(b.call(getspecific, [b.load(gpu_key)]), i64), i32))
+
+        func, b = body('__nexa_gpu_set_id')
+        b.call(setspecific, [b.load(gpu_key), b.inttoptr(b.zext(func.args[0], i64), void_ptr)])
+        b.ret_void()
+
+        func, b = body('__nexa_gpu_launch')
+        launcher, threads, grain, args = func.args
+        b.call(pthread_once, [gpu_once, gpu_init])
+        closure = ir.Constant(rt['__nexa_par_for'].function_type.args[2], ir.Undefined)
+        closure = b.insert_value(b.insert_value(closure, launcher, 0), args, 1)
+        b.call(rt['__nexa_par_for'], [threads, grain, closure])
+        b.call(setspecific, [b.load(gpu_key), null])
+        b.ret_void()
+
+        # One chunk of a std::gpu batch: launcher(args, lo, hi) on this thread
+        func, b = body('__nexa_gpu_run')
+        launcher, args, lo, hi = func.args
+        b.call(pthread_once, [gpu_once, gpu_init])
+        b.call(b.bitcast(launcher, body_ty.as_pointer()), [args, lo, hi])
+        b.call(setspecific, [b.load(gpu_key), null])
+        b.ret_void()
+
+    # Decimal to double (std::json::parse_f64). __nexa_eisel_lemire(w, q, out)
+    # rounds w * 10^q to the nearest double with one or two 64x128-bit
+    # products against a table of 5^q, as in Lemire, "Number Parsing at a
+    # Gigabyte per Second". It returns false, leaving *out alone, for the few
+    # inputs it can't decide (halfway cases, subnormals, q outside the
+    # table); the caller falls back to strtod for those.
+    POW5_MIN, POW5_MAX = -342, 308
+
+    @staticmethod
+    def _pow5_128(q):
+        # 5^q as a 128-bit fraction with its top bit set: truncated for
+        # q >= 0, rounded up for q < 0
+        if q >= 0:
+            v = 5 ** q
+            while v < (1 << 127): v <<= 1
+            while v >= (1 << 128): v >>= 1
+            return v
+        p = 5 ** -q
+        z = p.bit_length()
+        v = (1 << (z + 127 if q >= -27 else 2 * z + 128)) // p + 1
+        while v >= (1 << 128): v >>= 1
+        return v
+
+    def _declare_number_runtime(self):
+        i64 = ir.IntType(64)
+        name = '__nexa_eisel_lemire'
+        self._number_rt = {name: self.module.globals.get(name) or ir.Function(
+            self.module, ir.FunctionType(ir.IntType(1), [i64, ir.IntType(32), ir.DoubleType().as_pointer()]), name=name)}
+
+    def _define_number_runtime(self):
+        i1 = ir.IntType(1)
+        i64 = ir.IntType(64)
+        i128 = ir.IntType(128)
+        c64 = lambda v: ir.Constant(i64, v - (1 << 64) if v >= (1 << 63) else v)
+        pair = ir.ArrayType(i64, 2)
+        count = self.POW5_MAX - self.POW5_MIN + 1
+        table = ir.GlobalVariable(self.module, ir.ArrayType(pair, count), name="__nexa_pow5_128")
+        table.linkage = 'internal'
+        table.global_constant = True
+        entries = []
+        for q in range(self.POW5_MIN, self.POW5_MAX + 1):
+            v = self._pow5_128(q)
+            entries.append(ir.Constant(pair, [c64(v >> 64), c64(v & ((1 << 64) - 1))]))
+        table.initializer = ir.Constant(table.type.pointee, entries)
+        ctlz = self._llvm_intrinsic("llvm.ctlz.i64", i64, [i64, i1])
+
+        func = self._number_rt['__nexa_eisel_lemire']
+        w, q, out = func.args
+        b = ir.IRBuilder(func.append_basic_block("entry"))
+        compute_bb = func.append_basic_block("compute")
+        store_bb = func.append_basic_block("store")
+        fail_bb = func.append_basic_block("fail")
+        in_table = b.and_(b.icmp_signed(">=", q, q.type(self.POW5_MIN)), b.icmp_signed("<=", q, q.type(self.POW5_MAX)))
+        b.cbranch(b.and_(in_table, b.icmp_unsigned("!=", w, c64(0))), compute_bb, fail_bb)
+
+        def mul128(x, y):
+            p = b.mul(b.zext(x, i128), b.zext(y, i128))
+            return b.trunc(b.lshr(p, ir.Constant(i128, 64)), i64), b.trunc(p, i64)
+
+        b.position_at_end(compute_bb)
+        q64 = b.sext(q, i64)
+        entry = b.gep(table, [c64(0), b.sub(q64, c64(self.POW5_MIN))])
+        pow_hi = b.load(b.gep(entry, [ir.Constant(ir.IntType(32), 0), ir.Constant(ir.IntType(32), 0)]))
+        pow_lo = b.load(b.gep(entry, [ir.Constant(ir.IntType(32), 0), ir.Constant(ir.IntType(32), 1)]))
+        # floor(q * log2(10)) + 1024 + 63
+        exponent = b.add(b.ashr(b.mul(q64, c64(152170 + 65536)), c64(16)), c64(1024 + 63))
+        lz = b.call(ctlz, [w, ir.Constant(i1, 1)])
+        w = b.shl(w, lz)
+        upper, lower = mul128(w, pow_hi)
+        # The low bits may carry into the result: take the next 64 bits of 5^q too
+        low9 = c64(0x1FF)
+        unsure = b.and_(b.icmp_unsigned("==", b.and_(upper, low9), low9), b.icmp_unsigned("<", b.add(lower, w), lower))
+        mid2, low = mul128(w, pow_lo)
+        mid = b.add(lower, mid2)
+        high = b.add(upper, b.zext(b.icmp_unsigned("<", mid, lower), i64))
+        still_unsure = b.and_(b.and_(b.icmp_unsigned("==", b.add(mid, c64(1)), c64(0)),
+                                     b.icmp_unsigned("==", b.and_(high, low9), low9)),
+                              b.icmp_unsigned("<", b.add(low, w), low))
+        failed = b.and_(unsure, still_unsure)
+        upper = b.select(unsure, high, upper)
+        lower = b.select(unsure, mid, lower)
+
+        upperbit = b.lshr(upper, c64(63))
+        mantissa = b.lshr(upper, b.add(upperbit, c64(9)))
+        lz = b.add(lz, b.xor(upperbit, c64(1)))
+        # Exactly halfway between two doubles: leave the tie to strtod
+        halfway = b.and_(b.and_(b.icmp_unsigned("==", lower, c64(0)), b.icmp_unsigned("==", b.and_(upper, low9), c64(0))),
+                         b.icmp_unsigned("==", b.and_(mantissa, c64(3)), c64(1)))
+        failed = b.or_(failed, halfway)
+        mantissa = b.lshr(b.add(mantissa, b.and_(mantissa, c64(1))), c64(1))
+        overflow = b.icmp_unsigned(">=", mantissa, c64(1 << 53))
+        mantissa = b.select(overflow, c64(1 << 52), mantissa)
+        lz = b.select(overflow, b.sub(lz, c64(1)), lz)
+        mantissa = b.and_(mantissa, c64(~(1 << 52) & ((1 << 64) - 1)))
+        biased = b.sub(exponent, lz)
+        # Subnormal or infinite results
+        failed = b.or_(failed, b.or_(b.icmp_signed("<", biased, c64(1)), b.icmp_signed(">", biased, c64(2046))))
+        b.cbranch(failed, fail_bb, store_bb)
+
+        b.position_at_end(store_bb)
+        bits = b.or_(mantissa, b.shl(biased, c64(52)))
+        b.store(b.bitcast(bits, ir.DoubleType()), out)
+        b.ret(ir.Constant(i1, 1))
+
+        b.position_at_end(fail_bb)
+        b.ret(ir.Constant(i1, 0))
+
+    # Process-wide buffered stdout behind print and std::io's write*: one
+    # OUT_CAP buffer under a lock, written out when it fills, when main
+    # returns and at exit (panic, exit()). When stdout is a terminal a
+    # write containing a newline goes out at once, like a line-buffered C
+    # stdout. __nexa_out_<kind>(fmt, value) formats one value in place.
+    OUT_CAP = 65536
+    OUT_KINDS = ('i32', 'i64', 'f64', 'ptr')
+
+    def _declare_stdout_runtime(self):
+        void = ir.VoidType()
         void_ptr = ir.IntType(8).as_pointer()
-        malloc_ty = ir.FunctionType(void_ptr, [ir.IntType(32)])
-        self.malloc = ir.Function(self.module, malloc_ty, name="malloc")
+        kinds = {'i32': ir.IntType(32), 'i64': ir.IntType(64), 'f64': ir.DoubleType(), 'ptr': void_ptr}
+        signatures = {
+            '__nexa_out_write': (void, [void_ptr, ir.IntType(64)]),
+            '__nexa_out_flush': (void, []),
+        }
+        for kind in self.OUT_KINDS:
+            signatures[f'__nexa_out_{kind}'] = (void, [void_ptr, kinds[kind]])
+        self._out_rt = {}
+        for name, (ret, args) in signatures.items():
+            func = self.module.globals.get(name)
+            if func is None:
+                func = ir.Function(self.module, ir.FunctionType(ret, args), name=name)
+            self._out_rt[name] = func
+
+    def _emit_out_flush(self):
+        if not hasattr(self, '_out_rt'):
+            return
+        self._uses_stdout = True
+        self.builder.call(self._out_rt['__nexa_out_flush'], [])
+
+    def _define_stdout_runtime(self):
+        void = ir.VoidType()
+        void_ptr = ir.IntType(8).as_pointer()
+        i1 = ir.IntType(1)
+        i32 = ir.IntType(32)
+        i64 = ir.IntType(64)
+        c32 = lambda v: ir.Constant(i32, v)
+        c64 = lambda v: ir.Constant(i64, v)
+        null = ir.Constant(void_ptr, None)
+        rt = self._out_rt
+        libc = self._libc_function
+        write = libc("write", i64, [i32, void_ptr, i64])
+        isatty = libc("isatty", i32, [i32])
+        memchr = libc("memchr", void_ptr, [void_ptr, i32, i64])
+        exit_hook_ty = ir.FunctionType(void, [void_ptr])
+        cxa_atexit = libc("__cxa_atexit", i32, [exit_hook_ty.as_pointer(), void_ptr, void_ptr])
+        snprintf = self.module.globals.get("snprintf") or ir.Function(
+            self.module, ir.FunctionType(i32, [void_ptr, i64, void_ptr], var_arg=True), name="snprintf")
+        dprintf = self.module.globals.get("dprintf") or ir.Function(
+            self.module, ir.FunctionType(i32, [i32, void_ptr], var_arg=True), name="dprintf")
+        mutex_lock = libc("pthread_mutex_lock", i32, [void_ptr])
+        mutex_unlock = libc("pthread_mutex_unlock", i32, [void_ptr])
+
+        def state(name, ty, align=None):
+            g = ir.GlobalVariable(self.module, ty, name=name)
+            g.linkage = 'internal'
+            g.initializer = ir.Constant(ty, None)
+            if align: g.align = align
+            return g
+        buf = state("__nexa_out_buf", ir.ArrayType(ir.IntType(8), self.OUT_CAP), 16)
+        length = state("__nexa_out_len", i64)
+        # 0 before the first write, then 1 for a file or pipe, 2 for a terminal
+        mode = state("__nexa_out_mode", i32)
+        lock = state("__nexa_out_lock", ir.ArrayType(ir.IntType(8), 64), 16)  # PTHREAD_MUTEX_INITIALIZER
+        lock_ptr = lock.gep([c32(0), c32(0)])
+        buf_at = lambda b, offset: b.gep(buf, [c32(0), offset])
+
+        def internal(name, ret, args):
+            func = ir.Function(self.module, ir.FunctionType(ret, args), name=name)
+            func.linkage = 'internal'
+            return func, ir.IRBuilder(func.append_basic_block("entry"))
+
+        # write(2) until all n bytes are out (or the fd fails)
+        write_all, b = internal("__nexa_out_write_all", void, [void_ptr, i64])
+        loop_bb = write_all.append_basic_block("loop")
+        more_bb = write_all.append_basic_block("more")
+        done_bb = write_all.append_basic_block("done")
+        entry_bb = b.block
+        b.branch(loop_bb)
+        b.position_at_end(loop_bb)
+        p = b.phi(void_ptr)
+        n = b.phi(i64)
+        p.add_incoming(write_all.args[0], entry_bb)
+        n.add_incoming(write_all.args[1], entry_bb)
+        b.cbranch(b.icmp_signed(">", n, c64(0)), more_bb, done_bb)
+        b.position_at_end(more_bb)
+        wrote = b.call(write, [c32(1), p, n])
+        p.add_incoming(b.gep(p, [wrote]), more_bb)
+        n.add_incoming(b.sub(n, wrote), more_bb)
+        b.cbranch(b.icmp_signed(">", wrote, c64(0)), loop_bb, done_bb)
+        b.position_at_end(done_bb)
+        b.ret_void()
+
+        # Lock held: write the buffer out and empty it
+        drain, b = internal("__nexa_out_drain", void, [])
+        b.call(write_all, [buf_at(b, c32(0)), b.load(length)])
+        b.store(c64(0), length)
+        b.ret_void()
+
+        exit_hook, b = internal("__nexa_out_at_exit", void, [void_ptr])
+        b.call(rt['__nexa_out_flush'], [])
+        b.ret_void()
+
+        # Take the lock; the first writer also sets up the exit flush
+        begin, b = internal("__nexa_out_begin", void, [])
+        b.call(mutex_lock, [lock_ptr])
+        with b.if_then(b.icmp_signed("==", b.load(mode), c32(0))):
+            tty = b.icmp_signed("!=", b.call(isatty, [c32(1)]), c32(0))
+            b.store(b.select(tty, c32(2), c32(1)), mode)
+            b.call(cxa_atexit, [exit_hook, null, null])
+        b.ret_void()
 
-        # free
-        free_ty = ir.FunctionType(ir.VoidType(), [void_ptr])
-        self.free = ir.Function(self.module, free_ty, name="free")
+        # Release the lock, first writing out a terminal line that ended
+        # in buf[start:len]
+        end, b = internal("__nexa_out_end", void, [i64])
+        start = end.args[0]
+        with b.if_then(b.icmp_signed("==", b.load(mode), c32(2))):
+            nl = b.call(memchr, [buf_at(b, start), c32(10), b.sub(b.load(length), start)])
+            with b.if_then(b.icmp_unsigned("!=", nl, null)):
+                b.call(drain, [])
+        b.call(mutex_unlock, [lock_ptr])
+        b.ret_void()
 
-        # realloc
-        realloc_ty = ir.FunctionType(void_ptr, [void_ptr, ir.IntType(32)])
-        self.realloc = ir.Function(self.module, realloc_ty, name="realloc")
+        func = rt['__nexa_out_flush']
+        b = ir.IRBuilder(func.append_basic_block("entry"))
+        b.call(mutex_lock, [lock_ptr])
+        b.call(drain, [])
+        b.call(mutex_unlock, [lock_ptr])
+        b.ret_void()
+
+        # __nexa_out_write(p, n): bytes too big for the buffer go straight out
+        func = rt['__nexa_out_write']
+        src, n = func.args
+        b = ir.IRBuilder(func.append_basic_block("entry"))
+        b.call(begin, [])
+        with b.if_then(b.icmp_signed(">", b.add(b.load(length), n), c64(self.OUT_CAP))):
+            b.call(drain, [])
+        with b.if_else(b.icmp_signed(">=", n, c64(self.OUT_CAP))) as (direct, buffered):
+            with direct:
+                b.call(write_all, [src, n])
+            with buffered:
+                at = b.load(length)
+                b.call(self.memcpy, [buf_at(b, at), src, b.trunc(n, i32), ir.Constant(i1, 0)])
+                b.store(b.add(at, n), length)
+        b.call(end, [c64(0)])
+        b.ret_void()
+
+        # __nexa_out_<kind>(fmt, value): snprintf into the free space; if it
+        # doesn't fit, write the buffer out and try again, and if it doesn't
+        # fit an empty buffer either, dprintf it straight to the fd
+        for kind in self.OUT_KINDS:
+            func = rt[f'__nexa_out_{kind}']
+            fmt, value = func.args
+            b = ir.IRBuilder(func.append_basic_block("entry"))
+            b.call(begin, [])
+            start = b.alloca(i64)
+            b.store(b.load(length), start)
+            room = b.sub(c64(self.OUT_CAP), b.load(start))
+            written = b.alloca(i64)
+            b.store(b.sext(b.call(snprintf, [buf_at(b, b.load(start)), room, fmt, value]), i64), written)
+            with b.if_then(b.icmp_signed(">=", b.load(written), room)):
+                b.call(drain, [])
+                b.store(c64(0), start)
+                b.store(b.sext(b.call(snprintf, [buf_at(b, c32(0)), c64(self.OUT_CAP), fmt, value]), i64), written)
+                with b.if_then(b.icmp_signed(">=", b.load(written), c64(self.OUT_CAP))):
+                    b.call(dprintf, [c32(1), fmt, value])
+                    b.store(c64(0), written)
+            with b.if_then(b.icmp_signed("<", b.load(written), c64(0))):
+                b.store(c64(0), written)
+            b.store(b.add(b.load(start), b.load(written)), length)
+            b.call(end, [b.load(start)])
+            b.ret_void()
+
+    # Atomic intrinsics: atomic_load/atomic_store/fetch_add/fetch_sub/
+    # atomic_swap/compare_exchange::<T>(ptr, ..., ordering) and
+    # fence(ordering). Orderings are std::sync::atomic::Ordering values: a
+    # tag-only enum, so an i32 whose values follow ATOMIC_ORDERINGS. A
+    # literal path (Ordering::Acquire) is lowered directly; any other
+    # ordering value switches on that i32 at run time, and an ordering the
+    # operation can't use becomes seq_cst.
+    ATOMIC_ORDERINGS = ('monotonic', 'release', 'acquire', 'acq_rel', 'seq_cst')
+    ATOMIC_ORDERING_NAMES = ('Relaxed', 'Release', 'Acquire', 'AcqRel', 'SeqCst')
+    ATOMIC_LOAD_ORDERINGS = ('monotonic', 'acquire', 'seq_cst')
+    ATOMIC_STORE_ORDERINGS = ('monotonic', 'release', 'seq_cst')
+    ATOMIC_FENCE_ORDERINGS = ('release', 'acquire', 'acq_rel', 'seq_cst')
+    ATOMIC_INTRINSICS = ('atomic_load', 'atomic_store', 'fetch_add', 'fetch_sub', 'atomic_swap', 'compare_exchange')
+
+    def _atomic_ordering(self, arg):
+        # Ordering::X -> its LLVM name; anything else -> the runtime tag (i32)
+        if isinstance(arg, VariableExpr) and '::' in arg.name:
+            variant = arg.name.rsplit('::', 1)[1]
+            if variant in self.ATOMIC_ORDERING_NAMES:
+                return self.ATOMIC_ORDERINGS[self.ATOMIC_ORDERING_NAMES.index(variant)]
+        val = self.visit(arg)
+        if val.type != ir.IntType(32):
+            val = self.builder.trunc(val, ir.IntType(32)) if val.type.width > 32 else self.builder.zext(val, ir.IntType(32))
+        return val
+
+    def _with_ordering(self, order, valid, emit):
+        # emit(ordering) under a constant ordering, or under each valid one
+        if isinstance(order, str):
+            return emit(order if order in valid else 'seq_cst')
+        b = self.builder
+        done = b.append_basic_block("atomic.done")
+        fallback = b.append_basic_block("atomic.seq_cst")
+        switch = b.switch(order, fallback)
+        results = []
+        for tag, name in enumerate(self.ATOMIC_ORDERINGS):
+            if name == 'seq_cst' or name not in valid:
+                continue
+            block = b.append_basic_block(f"atomic.{name}")
+            switch.add_case(ir.Constant(ir.IntType(32), tag), block)
+            b.position_at_end(block)
+            results.append((emit(name), b.block))
+            b.branch(done)
+        b.position_at_end(fallback)
+        results.append((emit('seq_cst'), b.block))
+        b.branch(done)
+        b.position_at_end(done)
+        if isinstance(results[0][0].type, ir.VoidType):
+            return None
+        phi = b.phi(results[0][0].type)
+        for val, block in results:
+            phi.add_incoming(val, block)
+        return phi
+
+    def _emit_atomic(self, op, type_name, node):
+        b = self.builder
+        ty = self.get_llvm_type(type_name)
+        # Pointers go through i64 (atomicrmw needs an integer operand)
+        word = ir.IntType(64) if isinstance(ty, ir.PointerType) else ty
+        align = 8 if isinstance(ty, ir.PointerType) else ({ir.FloatType(): 4, ir.DoubleType(): 8}.get(ty) or max(1, ty.width // 8))
+        ptr = self.visit(node.args[0])
+        if ptr.type != word.as_pointer():
+            ptr = b.bitcast(ptr, word.as_pointer())
+
+        def operand(arg):
+            val = self.visit(arg)
+            if isinstance(val.type, ir.PointerType):
+                return b.ptrtoint(val, word)
+            if isinstance(val.type, ir.IntType) and val.type.width != word.width:
+                if val.type.width > word.width:
+                    return b.trunc(val, word)
+                return b.zext(val, word) if val.type.width <= 8 else b.sext(val, word)
+            return val
+
+        def result(val):
+            return b.inttoptr(val, ty) if isinstance(ty, ir.PointerType) else val
+
+        if op == 'atomic_load':
+            order = self._atomic_ordering(node.args[1])
+            return result(self._with_ordering(order, self.ATOMIC_LOAD_ORDERINGS, lambda o: b.load_atomic(ptr, o, align)))
+        if op == 'atomic_store':
+            val = operand(node.args[1])
+            order = self._atomic_ordering(node.args[2])
+            self._with_ordering(order, self.ATOMIC_STORE_ORDERINGS, lambda o: b.store_atomic(val, ptr, o, align))
+            return None
+        if op == 'compare_exchange':
+            expected = operand(node.args[1])
+            new = operand(node.args[2])
+            success = self._atomic_ordering(node.args[3])
+            failure = self._atomic_ordering(node.args[4])
+            # Returns the value seen: the exchange happened iff it equals `expected`
+            emit = lambda s: self._with_ordering(failure, self.ATOMIC_LOAD_ORDERINGS,
+                                                 lambda f: b.extract_value(b.cmpxchg(ptr, expected, new, s, f), 0))
+            return result(self._with_ordering(success, self.ATOMIC_ORDERINGS, emit))
+        rmw = {'fetch_add': 'add', 'fetch_sub': 'sub', 'atomic_swap': 'xchg'}[op]
+        val = operand(node.args[1])
+        order = self._atomic_ordering(node.args[2])
+        return result(self._with_ordering(order, self.ATOMIC_ORDERINGS, lambda o: b.atomic_rmw(rmw, ptr, val, o)))
+
+    def _gpu_launcher(self, kernel):
+        # {kernel}__cpu(args, lo, hi): one chunk of a CPU dispatch, paired
+        # with the smallest chunk worth handing it. The kernel's arguments
+        # are loaded from the args array once; the ids in [lo, hi) then run
+        # kernel_lanes at a time (_emit_spmd_launcher) or, when the kernel
+        # can't be vectorized, one kernel call each.
+        if kernel.name in self._gpu_launchers:
+            return self._gpu_launchers[kernel.name]
+        void_ptr = ir.IntType(8).as_pointer()
+        i32 = ir.IntType(32)
+        i64 = ir.IntType(64)
+        launcher = ir.Function(self.module, ir.FunctionType(ir.VoidType(), [void_ptr, i64, i64]), name=f"{kernel.name}__cpu")
+        launcher.linkage = 'internal'
+        node = self._function_nodes.get(kernel.name)
+        if self.kernel_lanes > 1 and node is not None:
+            try:
+                self._emit_spmd_launcher(launcher, kernel, node)
+                self._gpu_launchers[kernel.name] = (launcher, self.kernel_lanes)
+                return self._gpu_launchers[kernel.name]
+            except _Divergent:
+                launcher.blocks = []
+            finally:
+                self._spmd = None
+        b = ir.IRBuilder(launcher.append_basic_block("entry"))
+        _, lo, hi = launcher.args
+        args = self._launcher_args(b, launcher, kernel)
+        gid = b.alloca(i64)
+        b.store(lo, gid)
+        head = launcher.append_basic_block("ids")
+        step = launcher.append_basic_block("invoke")
+        done = launcher.append_basic_block("done")
+        b.branch(head)
+        b.position_at_end(head)
+        b.cbranch(b.icmp_signed("<", b.load(gid), hi), step, done)
+        b.position_at_end(step)
+        g = b.load(gid)
+        b.call(self._par_rt['__nexa_gpu_set_id'], [b.trunc(g, i32)])
+        b.call(kernel, args)
+        b.store(b.add(g, ir.Constant(i64, 1)), gid)
+        b.branch(head)
+        b.position_at_end(done)
+        b.ret_void()
+        self._gpu_launchers[kernel.name] = (launcher, 1)
+        return self._gpu_launchers[kernel.name]
+
+    def _store_gpu_args(self, kernel, values, args_array, slot_of):
+        # args_array[i] = address of the i-th kernel argument, stored in slot_of(i, type)
+        i32 = ir.IntType(32)
+        void_ptr = ir.IntType(8).as_pointer()
+        for i, (arg, ty) in enumerate(zip(values, kernel.function_type.args)):
+            arg_ptr = slot_of(i, ty)
+            arg = self._coerce_scalar(arg, ty)
+            if arg.type != ty:
+                self.builder.store(arg, self.builder.bitcast(arg_ptr, arg.type.as_pointer()))
+            else:
+                self.builder.store(arg, arg_ptr)
+            self.builder.store(self.builder.bitcast(arg_ptr, void_ptr),
+                               self.builder.gep(args_array, [ir.Constant(i32, 0), ir.Constant(i32, i)]))
+
+    def _emit_gpu_bind(self, node):
+        # gpu::bind(kernel, args...) -> std::gpu::Dispatch {launcher, args,
+        # grain}. The arguments go to one heap block: the pointer array the
+        # launcher reads (as for gpu::dispatch), then the values themselves.
+        dispatch_ty = self.struct_types['std_gpu_Dispatch']
+        gpu_args = [self.visit(a) for a in node.args[1:]]
+        if self.target != "native":
+            return ir.Constant(dispatch_ty, None)
+        self._uses_par = True
+        i32 = ir.IntType(32)
+        void_ptr = ir.IntType(8).as_pointer()
+        kernel = self.module.get_global(node.args[0].name)
+        params = kernel.function_type.args
+        block_ty = ir.LiteralStructType([ir.ArrayType(void_ptr, max(1, len(params))), ir.LiteralStructType(params)])
+        size = self.builder.ptrtoint(self.builder.gep(ir.Constant(block_ty.as_pointer(), None), [ir.Constant(i32, 1)]), ir.IntType(64))
+        raw = self._emit_heap_alloc(size, node)
+        block = self.builder.bitcast(raw, block_ty.as_pointer())
+        args_array = self.builder.gep(block, [ir.Constant(i32, 0), ir.Constant(i32, 0)])
+        self._store_gpu_args(kernel, gpu_args, args_array,
+                             lambda i, ty: self.builder.gep(block, [ir.Constant(i32, 0), ir.Constant(i32, 1), ir.Constant(i32, i)]))
+        launcher, grain = self._gpu_launcher(kernel)
+        result = ir.Constant(dispatch_ty, ir.Undefined)
+        result = self.builder.insert_value(result, self.builder.bitcast(launcher, void_ptr), 0)
+        result = self.builder.insert_value(result, raw, 1)
+        return self.builder.insert_value(result, ir.Constant(ir.IntType(64), grain), 2)
+
+    def _launcher_args(self, b, launcher, kernel):
+        void_ptr = ir.IntType(8).as_pointer()
+        slots = b.bitcast(launcher.args[0], void_ptr.as_pointer())
+        return [b.load(b.bitcast(b.load(b.gep(slots, [ir.Constant(ir.IntType(32), i)])), ty.as_pointer()))
+                for i, ty in enumerate(kernel.function_type.args)]
+
+    # SPMD lowering of a kernel for the CPU backend, ISPC-style: a launcher
+    # step runs kernel_lanes consecutive global ids at once. Values derived
+    # from gpu::global_id() are varying and live in <lanes x T> vectors;
+    # parameters, literals and arithmetic on them stay uniform scalars. An
+    # `if` runs both branches under a lane mask: stores are masked,
+    # assignments select per lane, and `return` retires the lanes taking it.
+    # Accesses at the id plus a uniform offset are whole-vector loads and
+    # stores; other varying indices gather/scatter. Loops, calls and other
+    # control flow that can diverge raise _Divergent, and the kernel keeps
+    # the one-id-per-call launcher.
+    LANE_ARITH = {'PLUS': ('fadd', 'add'), 'MINUS': ('fsub', 'sub'), 'STAR': ('fmul', 'mul'),
+                  'SLASH': ('fdiv', 'sdiv'), 'PERCENT': ('frem', 'srem')}
+    LANE_COMPARE = {'EQEQ': '==', 'NEQ': '!=', 'LT': '<', 'GT': '>', 'LTE': '<=', 'GTE': '>='}
+
+    def _emit_spmd_launcher(self, launcher, kernel, node):
+        i64 = ir.IntType(64)
+        lanes = self.kernel_lanes
+        b = ir.IRBuilder(launcher.append_basic_block("entry"))
+        _, lo, hi = launcher.args
+        if any(isinstance(ty, ir.VectorType) for ty in kernel.function_type.args):
+            raise _Divergent()
+        params = {pname: arg for (pname, _), arg in zip(node.params, self._launcher_args(b, launcher, kernel))}
+        step = b.alloca(i64, name="step")
+        b.store(lo, step)
+        head = launcher.append_basic_block("steps")
+        full = launcher.append_basic_block("full_step")
+        tail = launcher.append_basic_block("tail")
+        partial = launcher.append_basic_block("partial_step")
+        done = launcher.append_basic_block("done")
+        b.branch(head)
+        b.position_at_end(head)
+        first = b.load(step)
+        b.cbranch(b.icmp_signed(">=", b.sub(hi, first), ir.Constant(i64, lanes)), full, tail)
+        b.position_at_end(full)
+        self._emit_spmd_step(b, node, params, first, None)
+        b.store(b.add(first, ir.Constant(i64, lanes)), step)
+        b.branch(head)
+        # Fewer than `lanes` ids left: one more step with the rest masked off
+        b.position_at_end(tail)
+        b.cbranch(b.icmp_signed("<", first, hi), partial, done)
+        b.position_at_end(partial)
+        self._emit_spmd_step(b, node, params, first, hi)
+        b.branch(done)
+        b.position_at_end(done)
+        b.ret_void()
+
+    def _emit_spmd_step(self, b, node, params, first, end):
+        # Ids first.. (first + lanes); with `end` set, only those below it run
+        i32, i64 = ir.IntType(32), ir.IntType(64)
+        lanes = self.kernel_lanes
+        base = b.trunc(first, i32)
+        self._spmd = {'b': b, 'mask': None, 'guarded': False, 'returned': 0,
+                      'scopes': [dict(params)], 'linear': {}}
+        if end is not None:
+            lane = ir.Constant(ir.VectorType(i64, lanes), list(range(lanes)))
+            self._spmd['mask'] = b.icmp_signed("<", lane, self._spmd_vec(b.sub(end, first)))
+        gid = b.add(self._spmd_vec(base), ir.Constant(ir.VectorType(i32, lanes), list(range(lanes))), name="global_id")
+        self._spmd['gid'] = gid
+        self._spmd['linear'][id(gid)] = base
+        self._spmd_block(node.body)
+
+    def _spmd_block(self, stmts):
+        st = self._spmd
+        st['scopes'].append({})
+        for stmt in stmts:
+            if isinstance(stmt, ReturnStmt):
+                if stmt.value is not None:
+                    raise _Divergent()
+                st['mask'] = self._spmd_vec(ir.Constant(ir.IntType(1), 0))
+                st['returned'] += 1
+                break
+            if isinstance(stmt, VarDecl) and stmt.initializer is not None:
+                val = self._spmd_expr(stmt.initializer)
+                if isinstance(val.type, (ir.LiteralStructType, ir.IdentifiedStructType)):
+                    raise _Divergent()
+                if stmt.type_name:
+                    val = self._spmd_convert(val, self.get_llvm_type(stmt.type_name))
+                st['scopes'][-1][stmt.name] = val
+            elif isinstance(stmt, Assignment):
+                self._spmd_assign(stmt)
+            elif isinstance(stmt, IfStmt):
+                self._spmd_if(stmt)
+            elif isinstance(stmt, BlockStmt):
+                self._spmd_block(stmt.stmts)
+            else:
+                raise _Divergent()
+        st['scopes'].pop()
+
+    def _spmd_if(self, node):
+        st = self._spmd
+        b = st['b']
+        cond = self._spmd_expr(node.condition)
+        if not isinstance(self._lane_type(cond), ir.IntType):
+            raise _Divergent()
+        if self._lane_type(cond).width != 1:
+            cond = b.icmp_signed('!=', cond, ir.Constant(cond.type, None))
+        cond = self._spmd_vec(cond)
+        outer, guarded, returned = st['mask'], st['guarded'], st['returned']
+        st['guarded'] = True
+        st['mask'] = cond if outer is None else b.and_(outer, cond)
+        self._spmd_block(node.then_branch)
+        live = st['mask']
+        if node.else_branch or st['returned'] != returned:
+            skip = b.not_(cond)
+            st['mask'] = skip if outer is None else b.and_(outer, skip)
+            self._spmd_block(node.else_branch or [])
+        if st['returned'] == returned:
+            st['mask'], st['guarded'] = outer, guarded
+        else:
+            st['mask'] = b.or_(live, st['mask'])
+
+    def _spmd_assign(self, node):
+        st = self._spmd
+        b = st['b']
+        target = node.target.name if isinstance(node.target, VariableExpr) else node.target
+        if isinstance(target, IndexAccess):
+            ptr, index = self._spmd_address(target)
+            val = self._spmd_convert(self._spmd_expr(node.value), ptr.type.pointee)
+            if isinstance(index.type, ir.VectorType) or isinstance(val.type, ir.VectorType) or st['guarded']:
+                self._spmd_access(ptr, index, self._spmd_vec(val))
+            else:
+                b.store(val, b.gep(ptr, [index]))
+            return
+        # Locals only: kernel parameters are uniform for the whole dispatch
+        for scope in reversed(st['scopes'][1:]):
+            if isinstance(target, str) and target in scope:
+                old = scope[target]
+                val = self._spmd_convert(self._spmd_expr(node.value), self._lane_type(old))
+                if st['guarded']:
+                    val = b.select(st['mask'], self._spmd_vec(val), self._spmd_vec(old))
+                scope[target] = val
+                return
+        raise _Divergent()
+
+    def _spmd_expr(self, node):
+        st = self._spmd
+        b = st['b']
+        if isinstance(node, (IntegerLiteral, FloatLiteral, BooleanLiteral, CharLiteral)):
+            return self.visit(node)
+        if isinstance(node, VariableExpr):
+            for scope in reversed(st['scopes']):
+                if node.name in scope:
+                    return scope[node.name]
+            raise _Divergent()
+        if isinstance(node, BinaryExpr):
+            return self._spmd_binary(node)
+        if isinstance(node, UnaryExpr) and node.op in ('-', '!'):
+            val = self._spmd_expr(node.operand)
+            if node.op == '!':
+                return b.not_(val)
+            if isinstance(self._lane_type(val), (ir.FloatType, ir.DoubleType)):
+                return b.fneg(val)
+            return b.neg(val)
+        if isinstance(node, CallExpr):
+            callee = node.callee.name if isinstance(node.callee, VariableExpr) else node.callee
+            if callee == 'gpu::global_id' and not node.args:
+                return st['gid']
+            if isinstance(callee, str) and callee.startswith('cast<') and len(node.args) == 1:
+                return self._spmd_convert(self._spmd_expr(node.args[0]), self.get_llvm_type(callee[5:-1]))
+            raise _Divergent()
+        if isinstance(node, MemberAccess):
+            obj = self._spmd_expr(node.object)
+            fields = self.struct_fields.get(getattr(node, 'struct_type', None))
+            if fields is None or not isinstance(obj.type, (ir.LiteralStructType, ir.IdentifiedStructType)):
+                raise _Divergent()
+            return b.extract_value(obj, fields[node.member])
+        if isinstance(node, IndexAccess):
+            ptr, index = self._spmd_address(node)
+            if isinstance(index.type, ir.VectorType) or st['guarded']:
+                return self._spmd_access(ptr, index)
+            return b.load(b.gep(ptr, [index]))
+        raise _Divergent()
+
+    def _spmd_binary(self, node):
+        st = self._spmd
+        b = st['b']
+        left = self._spmd_expr(node.left)
+        right = self._spmd_expr(node.right)
+        lt, rt = self._lane_type(left), self._lane_type(right)
+        if not all(isinstance(t, (ir.IntType, ir.FloatType, ir.DoubleType)) for t in (lt, rt)):
+            raise _Divergent()
+        # The widening rules of visit_BinaryExpr
+        if isinstance(lt, ir.IntType) and isinstance(rt, ir.IntType):
+            if lt.width != rt.width and min(lt.width, rt.width) > 1:
+                if lt.width < rt.width:
+                    left = self._spmd_convert(left, rt)
+                else:
+                    right = self._spmd_convert(right, lt)
+        elif isinstance(lt, ir.DoubleType) or isinstance(rt, ir.DoubleType):
+            left, right = self._spmd_convert(left, ir.DoubleType()), self._spmd_convert(right, ir.DoubleType())
+        elif lt != rt:
+            raise _Divergent()
+        is_float = isinstance(self._lane_type(left), (ir.FloatType, ir.DoubleType))
+        varying = isinstance(left.type, ir.VectorType) or isinstance(right.type, ir.VectorType)
+        if node.op in ('SLASH', 'PERCENT') and not is_float and (varying or st['guarded']):
+            # Lanes that don't run must not trap on their divisor
+            one = self._spmd_vec(ir.Constant(self._lane_type(right), 1))
+            right = self._spmd_vec(right)
+            if st['mask'] is not None:
+                right = b.select(st['mask'], right, one)
+            varying = True
+        if varying:
+            bases = [st['linear'].get(id(v)) for v in (left, right)]
+            uniform = [None if isinstance(v.type, ir.VectorType) else v for v in (left, right)]
+            left, right = self._spmd_vec(left), self._spmd_vec(right)
+        result = self._emit_lane_op(b, node.op, left, right)
+        if result is None:
+            raise _Divergent()
+        # The id plus or minus a uniform value stays contiguous across lanes
+        if varying and not is_float and node.op in ('PLUS', 'MINUS'):
+            if bases[0] is not None and uniform[1] is not None:
+                st['linear'][id(result)] = getattr(b, self.LANE_ARITH[node.op][1])(bases[0], uniform[1])
+            elif node.op == 'PLUS' and bases[1] is not None and uniform[0] is not None:
+                st['linear'][id(result)] = b.add(uniform[0], bases[1])
+        return result
+
+    def _emit_lane_op(self, b, op, left, right):
+        # Binary operator on two scalars or two vectors of the same type;
+        # None if `op` isn't arithmetic, a comparison, AND or OR
+        is_float = isinstance(self._lane_type(left), (ir.FloatType, ir.DoubleType))
+        if op in self.LANE_COMPARE:
+            pred = self.LANE_COMPARE[op]
+            return b.fcmp_ordered(pred, left, right) if is_float else b.icmp_signed(pred, left, right)
+        if op == 'AND':
+            return b.and_(left, right)
+        if op == 'OR':
+            return b.or_(left, right)
+        if op in self.LANE_ARITH:
+            return getattr(b, self.LANE_ARITH[op][0 if is_float else 1])(left, right)
+        return None
+
+    def _lane_type(self, val):
+        return val.type.element if isinstance(val.type, ir.VectorType) else val.type
+
+    def _splat(self, b, val, lanes):
+        # <lanes x T> with `val` in every lane
+        vec_ty = ir.VectorType(val.type, lanes)
+        if isinstance(val, ir.Constant) and isinstance(val.type, (ir.IntType, ir.FloatType, ir.DoubleType)):
+            return ir.Constant(vec_ty, [val.constant] * lanes)
+        one = b.insert_element(ir.Constant(vec_ty, ir.Undefined), val, ir.Constant(ir.IntType(32), 0))
+        return b.shuffle_vector(one, ir.Constant(vec_ty, ir.Undefined), ir.Constant(ir.VectorType(ir.IntType(32), lanes), [0] * lanes))
+
+    def _spmd_vec(self, val):
+        # A uniform value broadcast to every lane
+        if isinstance(val.type, ir.VectorType):
+            return val
+        if isinstance(val, ir.Constant):
+            return self._splat(self._spmd['b'], val, self.kernel_lanes)
+        splats = self._spmd.setdefault('splats', {})
+        if id(val) not in splats:
+            splats[id(val)] = (val, self._splat(self._spmd['b'], val, self.kernel_lanes))
+        return splats[id(val)][1]
+
+    def _spmd_convert(self, val, ty):
+        # cast::<T> semantics, lane by lane
+        src = self._lane_type(val)
+        if src == ty:
+            return val
+        b = self._spmd['b']
+        out = self._convert_lanes(b, val, ty)
+        if out is None:
+            raise _Divergent()
+        base = self._spmd['linear'].get(id(val))
+        if base is not None and isinstance(src, ir.IntType) and isinstance(ty, ir.IntType) and src.width < ty.width:
+            self._spmd['linear'][id(out)] = self._convert_lanes(b, base, ty)
+        return out
+
+    def _convert_lanes(self, b, val, ty):
+        # Numeric cast::<T> of a scalar or of every lane of a vector; None
+        # when there is no such conversion
+        src = self._lane_type(val)
+        if src == ty:
+            return val
+        dst = ir.VectorType(ty, val.type.count) if isinstance(val.type, ir.VectorType) else ty
+        if isinstance(src, ir.IntType) and isinstance(ty, ir.IntType):
+            if src.width > ty.width:
+                return b.trunc(val, dst)
+            # u8 (the only 8-bit integer) widens unsigned
+            return b.zext(val, dst) if src.width <= 8 else b.sext(val, dst)
+        if isinstance(src, ir.IntType) and isinstance(ty, (ir.FloatType, ir.DoubleType)):
+            return b.uitofp(val, dst) if src.width == 8 else b.sitofp(val, dst)
+        if isinstance(src, (ir.FloatType, ir.DoubleType)) and isinstance(ty, ir.IntType):
+            return b.fptosi(val, dst)
+        if isinstance(src, ir.FloatType) and isinstance(ty, ir.DoubleType):
+            if isinstance(val, ir.Constant) and dst == ty:
+                # Literal: re-emit at full precision rather than widening the f32
+                return ir.Constant(ty, val.constant)
+            return b.fpext(val, dst)
+        if isinstance(src, ir.DoubleType) and isinstance(ty, ir.FloatType):
+            return b.fptrunc(val, dst)
+        return None
+
+    def _spmd_address(self, node):
+        # (pointer, index) of ptr[index]; the pointer has to be uniform
+        ptr = self._spmd_expr(node.object)
+        index = self._spmd_expr(node.index)
+        if not isinstance(ptr.type, ir.PointerType) or not isinstance(self._lane_type(index), ir.IntType):
+            raise _Divergent()
+        return ptr, index
+
+    def _spmd_access(self, ptr, index, value=None):
+        # Load (value None) or store of ptr[index] in every running lane
+        st = self._spmd
+        b = st['b']
+        i32, i64 = ir.IntType(32), ir.IntType(64)
+        lanes = self.kernel_lanes
+        elem = ptr.type.pointee
+        if isinstance(elem, ir.IntType) and elem.width in (8, 16, 32, 64):
+            size = elem.width // 8
+        elif isinstance(elem, (ir.FloatType, ir.DoubleType)):
+            size = 4 if isinstance(elem, ir.FloatType) else 8
+        else:
+            raise _Divergent()
+        vec_ty = ir.VectorType(elem, lanes)
+        mask = st['mask']
+        align = ir.Constant(i32, size)
+        base = st['linear'].get(id(index))
+        if base is not None:
+            vec_ptr = b.bitcast(b.gep(ptr, [base]), vec_ty.as_pointer())
+            suffix = f"{self._type_suffix(vec_ty)}.p0{self._type_suffix(vec_ty)}"
+            if mask is None and value is None:
+                return b.load(vec_ptr, align=size)
+            if mask is None:
+                b.store(value, vec_ptr, align=size)
+            elif value is None:
+                load = self._llvm_intrinsic(f"llvm.masked.load.{suffix}", vec_ty, [vec_ty.as_pointer(), i32, mask.type, vec_ty])
+                return b.call(load, [vec_ptr, align, mask, ir.Constant(vec_ty, None)])
+            else:
+                store = self._llvm_intrinsic(f"llvm.masked.store.{suffix}", ir.VoidType(), [vec_ty, vec_ty.as_pointer(), i32, mask.type])
+                b.call(store, [value, vec_ptr, align, mask])
+            return None
+        # One address per lane
+        offsets = b.mul(self._spmd_convert(self._spmd_vec(index), i64), self._spmd_vec(ir.Constant(i64, size)))
+        ptrs_ty = ir.VectorType(elem.as_pointer(), lanes)
+        ptrs = b.inttoptr(b.add(self._spmd_vec(b.ptrtoint(ptr, i64)), offsets), ptrs_ty)
+        if mask is None:
+            mask = self._spmd_vec(ir.Constant(ir.IntType(1), 1))
+        suffix = f"{self._type_suffix(vec_ty)}.v{lanes}p0{self._type_suffix(elem)}"
+        if value is None:
+            gather = self._llvm_intrinsic(f"llvm.masked.gather.{suffix}", vec_ty, [ptrs_ty, i32, mask.type, vec_ty])
+            return b.call(gather, [ptrs, align, mask, ir.Constant(vec_ty, None)])
+        scatter = self._llvm_intrinsic(f"llvm.masked.scatter.{suffix}", ir.VoidType(), [vec_ty, ptrs_ty, i32, mask.type])
+        b.call(scatter, [value, ptrs, align, mask])
+        return None
+
+    def _type_suffix(self, ty):
+        # Overload suffix of an LLVM intrinsic name (f32, i64, v8f32, ...)
+        if isinstance(ty, ir.VectorType):
+            return f"v{ty.count}{self._type_suffix(ty.element)}"
+        if isinstance(ty, ir.IntType):
+            return f"i{ty.width}"
+        return 'f32' if isinstance(ty, ir.FloatType) else 'f64'
+
+    def _llvm_intrinsic(self, name, ret, args):
+        func = self.module.globals.get(name)
+        if func is None:
+            func = ir.Function(self.module, ir.FunctionType(ret, args), name=name)
+        return func
+
+    # Built-in SIMD vectors (f32x8, i32x4, boolx8, ...) are LLVM <N x T>
+    # values. Operators go through _emit_lane_op, with a scalar operand
+    # splatted first; loads and stores move N consecutive elements of a
+    # slice, Buffer or pointer in one access. Reductions and any/all fold
+    # the vector in halves, so float sums are summed pairwise.
+    SIMD_ELEMS = ('i32', 'i64', 'f32', 'f64', 'bool')
+
+    def _simd_type(self, type_name):
+        elem, x, lanes = type_name.rpartition('x')
+        if x and elem in self.SIMD_ELEMS and lanes.isdigit():
+            return elem, int(lanes)
+        return None
+
+    def _emit_vector_binary(self, op, left, right):
+        vec_ty = left.type if isinstance(left.type, ir.VectorType) else right.type
+        if not isinstance(left.type, ir.VectorType):
+            left = self._splat(self.builder, self._coerce_scalar(left, vec_ty.element), vec_ty.count)
+        if not isinstance(right.type, ir.VectorType):
+            right = self._splat(self.builder, self._coerce_scalar(right, vec_ty.element), vec_ty.count)
+        result = self._emit_lane_op(self.builder, op, left, right)
+        if result is None:
+            raise Exception(f"Unknown operator: {op}")
+        return result
+
+    def _vector_address(self, vec_ty, src, index):
+        # (address, alignment) of the N elements starting at src[index]
+        if not isinstance(src.type, ir.PointerType):
+            src = self.builder.extract_value(src, 0, name="slice_ptr")
+        elem = vec_ty.element
+        align = elem.width // 8 if isinstance(elem, ir.IntType) else 4 if isinstance(elem, ir.FloatType) else 8
+        elem_ptr = self.builder.gep(src, [index])
+        return self.builder.bitcast(elem_ptr, vec_ty.as_pointer()), align
+
+    def _emit_vector_call(self, node):
+        type_name, _, func = node.callee.partition('::')
+        vec_ty = self.get_llvm_type(type_name)
+        if func == 'load':
+            ptr, align = self._vector_address(vec_ty, self.visit(node.args[0]), self.visit(node.args[1]))
+            return self.builder.load(ptr, align=align)
+        lanes = [self._coerce_scalar(self.visit(a), vec_ty.element) for a in node.args]
+        if func == 'splat':
+            return self._splat(self.builder, lanes[0], vec_ty.count)
+        vec = ir.Constant(vec_ty, ir.Undefined)
+        for i, lane in enumerate(lanes):
+            vec = self.builder.insert_element(vec, lane, ir.Constant(ir.IntType(32), i))
+        return vec
+
+    def _fold_halves(self, vec, combine):
+        # combine(lower half, upper half) until one lane is left
+        b = self.builder
+        i32 = ir.IntType(32)
+        while vec.type.count > 1:
+            half = vec.type.count // 2
+            undef = ir.Constant(vec.type, ir.Undefined)
+            lo = b.shuffle_vector(vec, undef, ir.Constant(ir.VectorType(i32, half), list(range(half))))
+            hi = b.shuffle_vector(vec, undef, ir.Constant(ir.VectorType(i32, half), list(range(half, 2 * half))))
+            vec = combine(lo, hi)
+        return b.extract_element(vec, ir.Constant(i32, 0))
+
+    def _lane_min_max(self, pred, left, right):
+        is_float = isinstance(self._lane_type(left), (ir.FloatType, ir.DoubleType))
+        picked = self.builder.fcmp_ordered(pred, left, right) if is_float else self.builder.icmp_signed(pred, left, right)
+        return self.builder.select(picked, left, right)
+
+    def _vector_slot(self, expr):
+        # Stack slot of a vector variable, else None
+        if not isinstance(expr, VariableExpr):
+            return None
+        for scope in reversed(self.scopes):
+            if expr.name in scope:
+                entry = scope[expr.name]
+                if len(entry) == 2 and isinstance(entry[0].type.pointee, ir.VectorType):
+                    return entry[0]
+                return None
+        return None
+
+    def _emit_vector_method(self, node, vec):
+        b = self.builder
+        name = node.method_name
+        elem = vec.type.element
+        if name == 'shuffle':
+            other = self.visit(node.args[0])
+            indices = [a.value for a in node.args[1:]]
+            return b.shuffle_vector(vec, other, ir.Constant(ir.VectorType(ir.IntType(32), len(indices)), indices))
+        args = [self.visit(a) for a in node.args]
+        if name == 'replace':
+            return b.insert_element(vec, self._coerce_scalar(args[1], elem), args[0])
+        if name == 'select':
+            return b.select(vec, args[0], args[1])
+        if name == 'any':
+            return self._fold_halves(vec, b.or_)
+        if name == 'all':
+            return self._fold_halves(vec, b.and_)
+        if name == 'store':
+            ptr, align = self._vector_address(vec.type, args[0], args[1])
+            b.store(vec, ptr, align=align)
+            return None
+        if name in ('min', 'max'):
+            return self._lane_min_max('<' if name == 'min' else '>', vec, args[0])
+        if name in ('reduce_min', 'reduce_max'):
+            pred = '<' if name == 'reduce_min' else '>'
+            return self._fold_halves(vec, lambda lo, hi: self._lane_min_max(pred, lo, hi))
+        op = 'PLUS' if name == 'reduce_sum' else 'STAR'
+        return self._fold_halves(vec, lambda lo, hi: self._emit_lane_op(b, op, lo, hi))
+
+    def _emit_fence(self, node):
+        order = self._atomic_ordering(node.args[0])
+        self._with_ordering(order, self.ATOMIC_FENCE_ORDERINGS, lambda o: self.builder.fence(o))
+        return None
 
     def _declare_memcpy(self):
         # Declare llvm.memcpy.p0i8.p0i8.i32
@@ -373,10 +3470,14 @@ class CodeGen:
             return ir.VoidType()
         elif type_name == 'string':
             return ir.IntType(8).as_pointer()
+        elif type_name.startswith('Task<'):
+            # Handle to an async fn frame (see _emit_async_function)
+            return ir.IntType(8).as_pointer()
         elif type_name.startswith('&'):
             inner = type_name[1:]
-            if inner.startswith("mut "):
-                inner = inner[4:]
+            # Semantic normalizes `&mut T` to `&mutT`
+            if inner.startswith("mut") and inner not in self.struct_types:
+                inner = inner[3:].lstrip()
             return self.get_llvm_type(inner).as_pointer()
         elif type_name.endswith('*'):
             inner_type = type_name[:-1]
@@ -390,6 +3491,10 @@ class CodeGen:
         elif type_name in self.struct_types:
             return self.struct_types[type_name]
 
+        simd = self._simd_type(type_name)
+        if simd:
+            return ir.VectorType(self.get_llvm_type(simd[0]), simd[1])
+
         # Handle generic parameters as placeholders (e.g. 'T')
         if type_name in self._current_generics:
              return ir.IntType(8) # Placeholder
@@ -403,6 +3508,10 @@ class CodeGen:
                 return enum_ty
             print(f"DEBUG ERASURE: {type_name} -> i8")
                 
+        if type_name.startswith('__lambda_'):
+            # Type of one closure (see _closure_function): a fat pointer too
+            return ir.LiteralStructType([ir.IntType(8).as_pointer(), ir.IntType(8).as_pointer()])
+
         if type_name.startswith('fn('):
             # Parse fn(i32, bool)->void
             # Use rpartition for robust splitting of return type
@@ -532,11 +3641,17 @@ class CodeGen:
         if max_size > final_size:
             print(f"WARNING: Enum {node.name} payload size {max_size} exceeds fixed limit {final_size}")
         enum_ty = ir.LiteralStructType([ir.IntType(32), padding_ty])
+        if self._is_tag_only(node):
+            # No variant carries data: the value is just its tag
+            enum_ty = ir.IntType(32)
 
         self.enum_types[node.name] = variant_tags
         self.enum_payloads[node.name] = variant_payload_types
         self.enum_definitions[node.name] = (enum_ty, max_size)
 
+    def _is_tag_only(self, node):
+        return not node.generics and all(not payloads for _, payloads in node.variants)
+
     def visit_TraitDef(self, node):
         pass # Traits are compile-time only for now (static dispatch)
 
@@ -555,11 +3670,11 @@ class CodeGen:
 
         for node in ast:
             if isinstance(node, EnumDef):
-                self.enum_definitions[node.name] = (placeholder_enum, {})
-            elif isinstance(node, StructDef):
-                 if '<' not in node.name:
-                     # Use IdentifiedStructType to support recursive/out-of-order types
-                     self.struct_types[node.name] = self.module.context.get_identified_type(node.name)
+                self.enum_definitions[node.name] = (ir.IntType(32), 0) if self._is_tag_only(node) else (placeholder_enum, {})
+            elif isinstance(node, StructDef) and not node.generics:
+                 # Use IdentifiedStructType to support recursive/out-of-order types
+                 # (instances such as Vec<i32> can hold later instances by value)
+                 self.struct_types[node.name] = self.module.context.get_identified_type(node.name)
 
         # Pass 1: Types (Structs, Enums)
         for node in ast:
@@ -577,11 +3692,15 @@ class CodeGen:
             elif isinstance(node, ExternBlock):
                 for func in node.functions:
                     self._declare_function(func)
-            elif isinstance(node, ImplDef):
-                self._current_generics = [g[0] for g in node.generics]
+            elif isinstance(node, ImplDef) and not node.generics:
+                # Generic impls are templates; semantic appends their instances
                 for method in node.methods:
                     self._declare_function(method)
-                self._current_generics = []
+
+        # Runtime allocation hooks (needs the allocator's headers from Pass 2)
+        self._global_allocator = self._find_global_allocator(ast)
+        if "__nexa_alloc" in self.module.globals and not self.malloc.blocks:
+            self._define_alloc_hooks(self._global_allocator)
 
         # Pass 3: Bodies
         for node in ast:
@@ -590,6 +3709,26 @@ class CodeGen:
                     continue
                 self.visit(node)
 
+        # Pass 4: Closure-specialized clones requested while emitting bodies
+        while self._pending_specializations:
+            func_node, spec_name, bindings = self._pending_specializations.pop(0)
+            self.visit_FunctionDef(func_node, name=spec_name, closure_bindings=bindings)
+
+        if self._uses_tasks:
+            self._define_task_runtime()
+        if self._uses_threads:
+            self._define_thread_runtime()
+        if self._uses_par:
+            self._define_par_runtime()
+        if self._uses_numbers:
+            self._define_number_runtime()
+        if self._uses_stdout:
+            self._define_stdout_runtime()
+
+        # Site table is complete once every body is emitted
+        if self._track:
+            self._define_alloc_tracking()
+
         llvm_ir = str(self.module)
         if self.target == "spirv" and self.spirv_env == "vulkan":
             llvm_ir = self._postprocess_spirv_vulkan_kernel_attributes(llvm_ir)
@@ -615,41 +3754,257 @@ class CodeGen:
         raise Exception(f"Macro {node.name}! was not expanded during semantic analysis")
 
     def visit_AwaitExpr(self, node):
-        # 1. Evaluate the expression (returns handle/pointer to state)
+        # Suspend until the task completes: store the resume point in the
+        # frame and return to the executor; the dispatch switch re-enters here.
+        # The state is saved before registering as the waiter, since another
+        # thread may resume this frame as soon as the child finishes.
+        if self._coro is None:
+            raise Exception("CodeGen Error: await outside an async fn")
         h = self.visit(node.value)
-        
-        # 2. Polling Loop
-        res_type_name = getattr(node, 'type_name', 'void')
-        res_ty = self.get_llvm_type(res_type_name)
-        # struct { i1 done, T result }
-        state_ty = ir.LiteralStructType([ir.IntType(1), res_ty])
-        state = self.builder.bitcast(h, state_ty.as_pointer())
-        
-        cond_bb = self.builder.append_basic_block("await_cond")
-        body_bb = self.builder.append_basic_block("await_poll")
-        cont_bb = self.builder.append_basic_block("await_cont")
-        
-        self.builder.branch(cond_bb)
-        self.builder.position_at_end(cond_bb)
-        
-        done_ptr = self.builder.gep(state, [ir.Constant(ir.IntType(32), 0), ir.Constant(ir.IntType(32), 0)])
-        done = self.builder.load(done_ptr)
-        self.builder.cbranch(done, cont_bb, body_bb)
-        
-        self.builder.position_at_end(body_bb)
-        # Here we could yield to executor. For bootstrap, we just loop (busy wait).
-        self.builder.branch(cond_bb)
-        
+        i32 = ir.IntType(32)
+        k = len(self._coro['resume_points']) + 1
+        suspend_bb = self.builder.append_basic_block(f"await{k}_suspend")
+        resume_bb = self.builder.append_basic_block(f"await{k}_resume")
+        cont_bb = self.builder.append_basic_block(f"await{k}_cont")
+        self.builder.store(ir.Constant(i32, k), self._task_field(self._coro['frame'], self.TASK_STATE))
+        ready = self.builder.call(self._task_rt['__nexa_task_await'], [h, self._coro['raw']])
+        self.builder.cbranch(ready, cont_bb, suspend_bb)
+
+        self.builder.position_at_end(suspend_bb)
+        self.builder.ret_void()
+
+        self.builder.position_at_end(resume_bb)
+        self._coro['dispatch'].add_case(ir.Constant(i32, k), resume_bb)
+        self._coro['resume_points'].append(resume_bb)
+        self.builder.branch(cont_bb)
+
+        # The child is done: take its result and free its frame
         self.builder.position_at_end(cont_bb)
-        # 3. Load result
-        if res_type_name == 'void':
-            return ir.Constant(ir.IntType(32), 0)
-            
-        res_ptr = self.builder.gep(state, [ir.Constant(ir.IntType(32), 0), ir.Constant(ir.IntType(32), 1)])
-        return self.builder.load(res_ptr)
+        res_type_name = getattr(node, 'type_name', 'void')
+        result = ir.Constant(i32, 0)
+        if res_type_name != 'void':
+            res_ty = self.get_llvm_type(res_type_name)
+            child_ty = ir.LiteralStructType(self._task_header_types() + [res_ty])
+            child = self.builder.bitcast(h, child_ty.as_pointer())
+            result = self.builder.load(self._task_field(child, self.TASK_RESULT))
+        self.builder.call(self._task_rt['__nexa_destroy'], [h])
+        return result
+
+    def _task_field(self, frame, index):
+        i32 = ir.IntType(32)
+        return self.builder.gep(frame, [ir.Constant(i32, 0), ir.Constant(i32, index)])
+
+    def _emit_task_return(self, ret_val):
+        # Store the result, mark the frame done and wake the awaiting task
+        if ret_val is not None and self._coro['has_result']:
+            slot = self._task_field(self._coro['frame'], self.TASK_RESULT)
+            self.builder.store(self._coerce_scalar(ret_val, slot.type.pointee), slot)
+        self.builder.call(self._task_rt['__nexa_task_complete'], [self._coro['raw']])
+        self.builder.ret_void()
+
+    def _emit_async_function(self, node):
+        # Lower `async fn f(args) -> T` to:
+        #   f(args) -> i8*          ramp: allocate the frame, store the args
+        #   f.resume(i8* frame)     body, entered through a switch on state
+        # Locals live in the frame, so they survive suspension
+        # (_lower_coroutine_frame).
+        void_ptr = ir.IntType(8).as_pointer()
+        i8 = ir.IntType(8)
+        i32 = ir.IntType(32)
+        is_main = node.name == 'main'
+        ramp = self.module.get_global("__nexa_main_task" if is_main else node.name)
+        resume = ir.Function(self.module, ir.FunctionType(ir.VoidType(), [void_ptr]), name=f"{ramp.name}.resume")
+        resume.linkage = 'internal'
+        frame_ty = self.module.context.get_identified_type(f"{ramp.name}.frame")
+        has_result = node.return_type not in (None, 'void')
+        result_ty = self.get_llvm_type(node.return_type) if has_result else i8
+        # The body only touches the header and result; the full frame layout
+        # is known after lowering
+        header = self._task_header_types() + [result_ty]
+        head_ty = ir.LiteralStructType(header)
+        self._uses_tasks = True
+
+        self._current_function_name = node.name
+        self._current_function_node = node
+        self._current_function_is_kernel = False
+        self.current_lambda_node = None
+
+        self.builder = ir.IRBuilder(resume.append_basic_block("entry"))
+        raw = resume.args[0]
+        raw.name = "task"
+        frame = self.builder.bitcast(raw, head_ty.as_pointer(), name="frame")
+        state = self.builder.load(self._task_field(frame, self.TASK_STATE), name="state")
+        start = resume.append_basic_block("start")
+        dispatch = self.builder.switch(state, start)
+        self._coro = {'frame': frame, 'raw': raw, 'dispatch': dispatch, 'resume_points': [], 'has_result': has_result}
+        self.builder.position_at_end(start)
+
+        # Parameters: plain slots, filled by the ramp
+        self.scopes.append({})
+        param_slots = []
+        for pname, ptype in node.params:
+            slot = self.builder.alloca(self.get_llvm_type(ptype), name=pname)
+            self._unowned_slots.add(slot)
+            self.scopes[-1][pname] = (slot, ptype)
+            param_slots.append(slot)
+
+        for stmt in node.body:
+            if self.builder.block.is_terminated:
+                break
+            self.visit_stmt(stmt)
+        if not self.builder.block.is_terminated:
+            self.emit_scope_drops(self.scopes[-1])
+            self._emit_task_return(None)
+        self.scopes.pop()
+        self._coro = None
+
+        slots = self._lower_coroutine_frame(resume, raw, frame_ty, header)
+
+        # Ramp: fresh frame in state 0, not yet running
+        self.builder = ir.IRBuilder(ramp.append_basic_block("entry"))
+        size = self.builder.ptrtoint(self.builder.gep(ir.Constant(frame_ty.as_pointer(), None), [ir.Constant(i32, 1)]), ir.IntType(64))
+        task = self._emit_heap_alloc(size, node)
+        new_frame = self.builder.bitcast(task, frame_ty.as_pointer())
+        self.builder.store(self.builder.bitcast(resume, void_ptr), self._task_field(new_frame, self.TASK_RESUME))
+        self.builder.store(ir.Constant(void_ptr, None), self._task_field(new_frame, self.TASK_WAITER))
+        self.builder.store(ir.Constant(i32, 0), self._task_field(new_frame, self.TASK_STATE))
+        self.builder.store(ir.Constant(i8, 0), self._task_field(new_frame, self.TASK_DONE))
+        self.builder.store(ir.Constant(i8, 0), self._task_field(new_frame, self.TASK_DETACHED))
+        for arg, slot in zip(ramp.args, param_slots):
+            field = slots[slot]
+            self.builder.store(arg, self.builder.gep(new_frame, [ir.Constant(i32, 0), ir.Constant(i32, field)]))
+        self.builder.ret(task)
+
+        if is_main:
+            # main(): run the task on the executor, then return its result
+            main = self.module.get_global("main")
+            self.builder = ir.IRBuilder(main.append_basic_block("entry"))
+            task = self.builder.call(ramp, [])
+            self.builder.call(self._task_rt['__nexa_block_on'], [task])
+            result = None
+            if has_result:
+                typed = self.builder.bitcast(task, frame_ty.as_pointer())
+                result = self.builder.load(self._task_field(typed, self.TASK_RESULT))
+            self.builder.call(self._task_rt['__nexa_destroy'], [task])
+            self._emit_main_exit()
+            if result is not None:
+                self.builder.ret(result)
+            else:
+                self.builder.ret_void()
+
+    def _lower_coroutine_frame(self, func, raw, frame_ty, header):
+        # Every alloca of the resume function becomes a frame field, and any
+        # SSA value whose definition does not dominate a use (the use is
+        # reachable from a resume point) is spilled to a field as well.
+        # Returns {alloca: field index}.
+        i32 = ir.IntType(32)
+        Alloca = ir.instructions.AllocaInstr
+        Phi = ir.instructions.PhiInstr
+        entry = func.blocks[0]
+        fields = list(header)
+        slots = {}
+        for block in func.blocks:
+            for instr in block.instructions:
+                if isinstance(instr, Alloca):
+                    ty = instr.type.pointee
+                    if instr.operands:
+                        ty = ir.ArrayType(ty, instr.operands[0].constant)
+                    slots[instr] = len(fields)
+                    fields.append(ty)
+
+        # Dominators over the reachable CFG
+        def successors(block):
+            term = block.terminator
+            if isinstance(term, ir.instructions.SwitchInstr):
+                return [term.default] + [blk for _, blk in term.cases]
+            return [op for op in getattr(term, 'operands', []) if isinstance(op, ir.Block)]
+        reachable, stack = [], [entry]
+        while stack:
+            block = stack.pop()
+            if block in reachable:
+                continue
+            reachable.append(block)
+            stack.extend(successors(block))
+        preds = {block: [] for block in reachable}
+        for block in reachable:
+            for succ in successors(block):
+                preds[succ].append(block)
+        dom = {block: set(reachable) for block in reachable}
+        dom[entry] = {entry}
+        changed = True
+        while changed:
+            changed = False
+            for block in reachable[1:]:
+                new = set.intersection(*[dom[p] for p in preds[block]]) | {block}
+                if new != dom[block]:
+                    dom[block], changed = new, True
+
+        spills = {}  # value -> [(user, block of the use)]
+        for block in reachable:
+            for instr in block.instructions:
+                uses = instr.incomings if isinstance(instr, Phi) else [(op, block) for op in instr.operands]
+                for value, use_block in uses:
+                    if not isinstance(value, ir.instructions.Instruction) or isinstance(value, Alloca):
+                        continue
+                    def_block = value.parent
+                    if def_block is use_block or def_block not in dom or use_block not in dom:
+                        continue
+                    if def_block not in dom[use_block]:
+                        spills.setdefault(value, []).append((instr, use_block))
+        for value in spills:
+            slots[value] = len(fields)
+            fields.append(value.type)
+        frame_ty.set_body(*fields)
+
+        # Field addresses are computed once, in the entry block
+        b = ir.IRBuilder(entry)
+        b.position_before(entry.terminator)
+        frame = b.bitcast(raw, frame_ty.as_pointer(), name="locals")
+        addr = {}
+        for value, index in slots.items():
+            ptr = b.gep(frame, [ir.Constant(i32, 0), ir.Constant(i32, index)])
+            if isinstance(value, Alloca) and value.operands:
+                ptr = b.gep(ptr, [ir.Constant(i32, 0), ir.Constant(i32, 0)])
+            addr[value] = ptr
+
+        for alloca in [v for v in slots if isinstance(v, Alloca)]:
+            alloca.parent.instructions.remove(alloca)
+            for block in func.blocks:
+                for instr in block.instructions:
+                    self._replace_operand(instr, alloca, addr[alloca])
+
+        for value, uses in spills.items():
+            block = value.parent
+            after = value
+            if isinstance(value, Phi):
+                after = [i for i in block.instructions if isinstance(i, Phi)][-1]
+            b.position_after(after)
+            b.store(value, addr[value])
+            for user, use_block in uses:
+                if isinstance(user, Phi):
+                    b.position_before(use_block.terminator)
+                    reload = b.load(addr[value])
+                    user.incomings = [(reload if v is value and blk is use_block else v, blk) for v, blk in user.incomings]
+                else:
+                    b.position_before(user)
+                    self._replace_operand(user, value, b.load(addr[value]))
+        return slots
+
+    def _replace_operand(self, instr, old, new):
+        instr.replace_usage(old, new)
+        # Some instructions keep their operands in extra attributes for printing
+        if getattr(instr, 'pointer', None) is old:
+            instr.pointer = new
+        if hasattr(instr, 'indices') and isinstance(instr, ir.instructions.GEPInstr):
+            instr.indices = [new if i is old else i for i in instr.indices]
+        if getattr(instr, 'aggregate', None) is old:
+            instr.aggregate = new
+        if isinstance(instr, ir.instructions.InsertValue) and instr.value is old:
+            instr.value = new
+        instr._clear_string_cache()
 
     def visit_UnaryExpr(self, node):
-        if node.op == '&':
+        if node.op in ('&', '&mut'):
             # Address Of: We need the address of the operand.
             # visit(operand) usually returns a value (load).
             # We need a method to get address.
@@ -660,8 +4015,23 @@ class CodeGen:
                             ptr, _ = scope[node.operand.name]
                             return ptr
                 raise Exception(f"Undefined variable for address of: {node.operand.name}")
+            elif isinstance(node.operand, MemberAccess):
+                # &obj.field, for an obj that lives in memory
+                addr = self._member_address(node.operand)
+                if addr is None:
+                    raise Exception(f"Address of (&) needs '{node.operand.member}' to live in memory")
+                return addr
+            elif isinstance(node.operand, (CallExpr, MethodCall)):
+                # &f(x): the result lives in a temporary until the statement ends
+                val = self.visit(node.operand)
+                temp = self._entry_alloca(val.type, name="ref_tmp")
+                self.builder.store(val, temp)
+                type_name = getattr(node, 'type_name', '')
+                if type_name.endswith('*'):
+                    self._stmt_temps.append((temp, type_name[:-1]))
+                return temp
             else:
-                raise Exception("Address of (&) only supported for variables currently")
+                raise Exception("Address of (&) only supported for variables and calls currently")
 
         elif node.op == '*':
             # Dereference
@@ -672,6 +4042,8 @@ class CodeGen:
             return self.builder.not_(val)
         elif node.op == '-':
             val = self.visit(node.operand)
+            if isinstance(self._lane_type(val), (ir.FloatType, ir.DoubleType)):
+                return self.builder.fneg(val)
             return self.builder.neg(val)
         else:
             raise Exception(f"Unsupported unary operator: {node.op}")
@@ -727,7 +4099,7 @@ class CodeGen:
             if isinstance(struct_val.type, ir.IntType):
                  # Typeless load or erasure: Spill to stack to bitcast and access fields
                  actual_struct_ty = self.get_llvm_type(struct_name)
-                 temp_mem = self.builder.alloca(struct_val.type)
+                 temp_mem = self._entry_alloca(struct_val.type)
                  self.builder.store(struct_val, temp_mem)
                  # Bitcast to actual struct pointer
                  casted_ptr = self.builder.bitcast(temp_mem, actual_struct_ty.as_pointer())
@@ -738,9 +4110,36 @@ class CodeGen:
             field_index = self.struct_fields[struct_name][node.member]
             return self.builder.extract_value(struct_val, field_index)
 
+    def _member_address(self, node):
+        # Address of obj.field when obj lives in memory (a local slot or a
+        # pointer such as self); None if it is only an SSA value.
+        struct_name = getattr(node, 'struct_type', None)
+        if struct_name not in self.struct_fields:
+            return None
+        base = None
+        if isinstance(node.object, MemberAccess):
+            base = self._member_address(node.object)
+        elif isinstance(node.object, VariableExpr):
+            for scope in reversed(self.scopes):
+                if node.object.name in scope:
+                    entry = scope[node.object.name]
+                    if isinstance(entry, tuple) and (len(entry) == 2 or entry[2] != "value"):
+                        slot = entry[0]
+                        base = self.builder.load(slot) if isinstance(slot.type.pointee, ir.PointerType) else slot
+                    break
+        if base is None or not isinstance(base.type, ir.PointerType):
+            return None
+        actual_struct_ty = self.get_llvm_type(struct_name)
+        if base.type.pointee != actual_struct_ty:
+            base = self.builder.bitcast(base, actual_struct_ty.as_pointer())
+        field_idx = self.struct_fields[struct_name][node.member]
+        return self.builder.gep(base, [ir.Constant(ir.IntType(32), 0), ir.Constant(ir.IntType(32), field_idx)])
+
     def visit_MethodCall(self, node):
         # Desugar obj.method(args) -> Type_method(obj, args)
         receiver_val = self.visit(node.receiver)
+        if getattr(node, 'simd_type', None):
+            return self._emit_vector_method(node, receiver_val)
         
         # In modern semantic pass, node.method_name is already fully mangled
         func_name = node.method_name
@@ -754,7 +4153,7 @@ class CodeGen:
             else:
                 raise Exception(f"CodeGen Error: Method '{func_name}' not found in module")
 
-        func = self.module.globals[func_name]
+        func = self._specialize_for_closures(self.module.globals[func_name], [node.receiver] + list(node.args))
         expected_param_type = func.function_type.args[0]
 
         receiver_arg = None
@@ -770,15 +4169,28 @@ class CodeGen:
                             receiver_arg = entry[0] # The alloca
                         break
 
+            elif isinstance(node.receiver, MemberAccess):
+                # self.field.method(): mutate the field in place, not a copy
+                receiver_arg = self._member_address(node.receiver)
+
             if receiver_arg is None:
                 # Fallback: create temporary
-                temp = self.builder.alloca(receiver_val.type, name="method_self_tmp")
+                temp = self._entry_alloca(receiver_val.type, name="method_self_tmp")
                 self.builder.store(receiver_val, temp)
                 receiver_arg = temp
+                receiver_type = getattr(node, 'receiver_type', None)
+                if isinstance(node.receiver, (CallExpr, MethodCall)) and isinstance(receiver_type, str):
+                    # A fresh value only borrowed by the call: it lives until the statement ends
+                    self._stmt_temps.append((temp, receiver_type))
         else:
             receiver_arg = receiver_val
 
         args = [receiver_arg] + [self.visit(arg) for arg in node.args]
+
+        # By-value receiver/arguments move into the callee
+        for expr, expected_type in zip([node.receiver] + list(node.args), func.function_type.args):
+            if not isinstance(expected_type, ir.PointerType):
+                self._mark_moved(expr)
         
         # Auto-cast arguments to match function signature (for type erasure)
         for i in range(len(args)):
@@ -790,12 +4202,16 @@ class CodeGen:
                 elif isinstance(actual_val.type, ir.IntType) and isinstance(expected_type, ir.IntType):
                     if actual_val.type.width > expected_type.width:
                         args[i] = self.builder.trunc(actual_val, expected_type)
-                    else:
+                    elif actual_val.type.width <= 8:
                         args[i] = self.builder.zext(actual_val, expected_type)
+                    else:
+                        args[i] = self.builder.sext(actual_val, expected_type)
+                elif isinstance(expected_type, (ir.FloatType, ir.DoubleType)):
+                    args[i] = self._coerce_scalar(actual_val, expected_type)
                 elif isinstance(actual_val.type, ir.LiteralStructType) and isinstance(expected_type, ir.LiteralStructType):
                     # We can't bitcast aggregate values directly. 
                     # Same hack as visit_VarDecl: store to temp, bitcast pointer, load.
-                    tmp = self.builder.alloca(actual_val.type)
+                    tmp = self._entry_alloca(actual_val.type)
                     self.builder.store(actual_val, tmp)
                     tmp_cast = self.builder.bitcast(tmp, expected_type.as_pointer())
                     args[i] = self.builder.load(tmp_cast)
@@ -806,6 +4222,10 @@ class CodeGen:
                     except:
                         pass # Let it fail in call() if it must
 
+        if self._track and func.name in ("Arena_alloc", "Arena_alloc_aligned"):
+            size = self.builder.sext(args[1], ir.IntType(64))
+            self.builder.call(self._track['arena'], [size, self._alloc_site(node, 'arena')])
+
         return self.builder.call(func, args)
 
     def visit_ArrayLiteral(self, node):
@@ -887,6 +4307,9 @@ class CodeGen:
                 elem_ptr = self.builder.gep(obj_val, [index_val])
             return self.builder.load(elem_ptr)
 
+        if isinstance(obj_val.type, ir.VectorType):
+            return self.builder.extract_element(obj_val, index_val)
+
         # If index_val is Constant, we can use extract_value
         if isinstance(index_val, ir.Constant):
             # extract_value index must be python int
@@ -894,22 +4317,22 @@ class CodeGen:
             return self.builder.extract_value(obj_val, idx)
 
         # Runtime index on SSA value: Spill to stack
-        temp_ptr = self.builder.alloca(obj_val.type)
+        temp_ptr = self._entry_alloca(obj_val.type)
         self.builder.store(obj_val, temp_ptr)
         zero = ir.Constant(ir.IntType(32), 0)
         try:
-            if isinstance(obj_val.type, (ir.ArrayType, ir.LiteralStructType, ir.StructureType)):
+            if isinstance(obj_val.type, (ir.ArrayType, ir.BaseStructType)):
                 ptr = self.builder.gep(temp_ptr, [zero, index_val])
             else:
                 ptr = self.builder.gep(temp_ptr, [index_val])
         except Exception as e:
-            print(f"DEBUG GEP FAILED: type={obj_val.type} agg={isinstance(obj_val.type, (ir.ArrayType, ir.LiteralStructType, ir.StructureType))}")
+            print(f"DEBUG GEP FAILED: type={obj_val.type} agg={isinstance(obj_val.type, (ir.ArrayType, ir.BaseStructType))}")
             raise e
         return self.builder.load(ptr)
 
         func = ir.Function(self.module, func_ty, name=node.name)
 
-        if node.is_kernel:
+        if node.is_kernel and self.target == "spirv":
             func.calling_convention = 'spir_kernel'
 
         block = func.append_basic_block(name="entry")
@@ -923,34 +4346,158 @@ class CodeGen:
 
         self.builder.ret_void()
 
+    def _coerce_scalar(self, val, ty):
+        # Literals default to i32/f32: convert to the declared scalar width
+        # instead of storing through a bitcast slot.
+        if isinstance(val.type, ir.IntType) and isinstance(ty, ir.IntType):
+            if val.type.width == ty.width or val.type.width == 1 or ty.width == 1:
+                return val
+            if val.type.width > ty.width:
+                return self.builder.trunc(val, ty)
+            if val.type.width == 8:
+                return self.builder.zext(val, ty)
+            return self.builder.sext(val, ty)
+        if isinstance(val.type, ir.IntType) and val.type.width > 1 and isinstance(ty, (ir.FloatType, ir.DoubleType)):
+            return self.builder.sitofp(val, ty)
+        if isinstance(val.type, ir.FloatType) and isinstance(ty, ir.DoubleType):
+            if isinstance(val, ir.Constant):
+                # Literal: re-emit at full precision rather than widening the f32
+                return ir.Constant(ty, val.constant)
+            return self.builder.fpext(val, ty)
+        if isinstance(val.type, ir.DoubleType) and isinstance(ty, ir.FloatType):
+            return self.builder.fptrunc(val, ty)
+        return val
+
+    def _entry_alloca(self, ty, name=""):
+        # Stack slots always live in the entry block so that locals declared
+        # inside loops are allocated once, not once per iteration.
+        entry_block = self.builder.function.entry_basic_block
+        with self.builder.goto_block(entry_block):
+            if entry_block.instructions:
+                self.builder.position_before(entry_block.instructions[0])
+            return self.builder.alloca(ty, name=name)
+
+    def _find_drop_func(self, type_name):
+        # Look for destructor: {TypeName}_drop(T) or {TypeName}_drop(&T)
+        # Modern mangled name: {TypeName}_drop__args__SELF_PTR
+        # Generic instances are type-erased, so Vec<i32> uses Vec's drop.
+        bases = [type_name]
+        if '<' in type_name:
+            bases.append(type_name.split('<')[0])
+        for base in bases:
+            # Free-function destructors mangle their parameter type: String_drop__args__String
+            by_value = type_name.replace('<', '_L_').replace('>', '_R_').replace(' ', '_').replace(',', '_')
+            for name in (f"{base}_drop__args__SELF_PTR", f"{base}_drop__args__{by_value}", f"{base}_drop"):
+                if name in self.module.globals:
+                    return self.module.get_global(name)
+        return None
+
+    def _mark_moved(self, expr):
+        # A local passed/returned/assigned by value hands over ownership.
+        if not isinstance(expr, VariableExpr):
+            return
+        for scope in reversed(self.scopes):
+            if expr.name in scope:
+                entry = scope[expr.name]
+                if isinstance(entry, tuple) and len(entry) == 2:
+                    self._set_owned(entry[0], False)
+                return
+
+    def _track_drop_flag(self, slot, type_name):
+        # Give a local with a destructor a drop flag, starting out as
+        # whatever ownership was decided when it was initialized
+        if not isinstance(type_name, str) or not self._find_drop_func(type_name):
+            return
+        self._drop_flags[slot] = self._entry_alloca(ir.IntType(1), name="drop_flag")
+        self._set_owned(slot, slot not in self._unowned_slots)
+
+    def _set_owned(self, slot, owned):
+        flag = self._drop_flags.get(slot)
+        if flag is not None:
+            # Decided at run time: this point may be on only one branch
+            self.builder.store(ir.Constant(ir.IntType(1), int(owned)), flag)
+            self._unowned_slots.discard(slot)
+        elif owned:
+            self._unowned_slots.discard(slot)
+        else:
+            self._unowned_slots.add(slot)
+
+    def _drop_slot(self, slot, type_name):
+        # Drop the value of a local unless it was moved out or never owned
+        if slot in self._unowned_slots or not isinstance(type_name, str):
+            return
+        flag = self._drop_flags.get(slot)
+        if flag is None:
+            self._emit_drop(slot, type_name)
+            return
+        with self.builder.if_then(self.builder.load(flag)):
+            self._emit_drop(slot, type_name)
+
     def emit_scope_drops(self, scope):
+        # A block left through return/break already ran its drops
+        if self.builder.block.is_terminated:
+            return
         # Iterate in reverse order of declaration (LIFO)
         # Scope is dict, assuming insertion order preserved (Python 3.7+)
         for var_name, entry in reversed(list(scope.items())):
-            if var_name.startswith('$') or not isinstance(entry, tuple) or len(entry) < 2:
+            if var_name.startswith('$') or not isinstance(entry, tuple) or len(entry) != 2:
                 continue
-            ptr, type_name = entry[0], entry[1]
-            # Look for destructor: {TypeName}_drop(T) or {TypeName}_drop(&T)
-            # Modern mangled name: {TypeName}_drop__args__SELF_PTR
-            drop_func_name = f"{type_name}_drop"
-            mangled_drop = f"{type_name}_drop__args__SELF_PTR"
-            
-            drop_func = None
-            if mangled_drop in self.module.globals:
-                drop_func = self.module.get_global(mangled_drop)
-            elif drop_func_name in self.module.globals:
-                drop_func = self.module.get_global(drop_func_name)
-                
-            if drop_func:
-                # Load value
-                val = self.builder.load(ptr)
-                # Call drop
-                self.builder.call(drop_func, [val])
+            self._drop_slot(*entry)
+
+    def _emit_drop(self, ptr, type_name):
+        # Run the destructor of the `type_name` value stored at `ptr`, if any
+        drop_func = self._find_drop_func(type_name)
+        if drop_func:
+            expected = drop_func.function_type.args[0]
+            if isinstance(expected, ir.PointerType) and expected.pointee == ptr.type.pointee:
+                # drop(&mut self): pass the slot itself
+                arg = ptr
+            elif isinstance(expected, ir.PointerType) and isinstance(ptr.type.pointee, ir.LiteralStructType):
+                arg = self.builder.bitcast(ptr, expected)
+            else:
+                # drop(self): load value (through a cast slot for erased generics)
+                if ptr.type.pointee != expected:
+                    ptr = self.builder.bitcast(ptr, expected.as_pointer())
+                arg = self.builder.load(ptr)
+            self.builder.call(drop_func, [arg])
+
+    def visit_stmt(self, stmt):
+        # Temporaries a statement creates without binding them (the guard in
+        # `m.lock().set(x)`, the value of a discarded `m.lock();`) are
+        # dropped when it ends, not when the enclosing scope does
+        prev, self._stmt_temps = self._stmt_temps, []
+        value = self.visit(stmt)
+        if isinstance(stmt, VarDecl) and isinstance(stmt.initializer, UnaryExpr) and self._stmt_temps:
+            # `let r = &f();` keeps the temporary for as long as `r`
+            slot, type_name = self._stmt_temps.pop()
+            self.scopes[-1][f"&{stmt.name}"] = (slot, type_name)
+        discarded = getattr(stmt, 'discarded_type', None)
+        if discarded and isinstance(value, ir.Value) and not self.builder.block.is_terminated \
+                and not isinstance(value.type, (ir.VoidType, ir.PointerType)) and self._find_drop_func(discarded):
+            slot = self._entry_alloca(value.type, name="discarded_tmp")
+            self.builder.store(value, slot)
+            self._stmt_temps.append((slot, discarded))
+        self._drop_stmt_temps()
+        self._stmt_temps = prev
+
+    def visit_condition(self, expr):
+        # if/while conditions end before the branch they pick runs
+        prev, self._stmt_temps = self._stmt_temps, []
+        value = self.visit(expr)
+        self._drop_stmt_temps()
+        self._stmt_temps = prev
+        return value
+
+    def _drop_stmt_temps(self):
+        if not self.builder.block.is_terminated:
+            for slot, type_name in reversed(self._stmt_temps):
+                self._emit_drop(slot, type_name)
+        self._stmt_temps = []
 
     def visit_Block(self, node):
         self.scopes.append({})
         for stmt in node.statements:
-            self.visit(stmt)
+            self.visit_stmt(stmt)
 
         # Auto-drop variables in this scope
         self.emit_scope_drops(self.scopes[-1])
@@ -986,8 +4533,10 @@ class CodeGen:
             self.builder.position_at_end(cond_block)
             
             # Call {Type}_next(&mut iter)
-            base_type = node.iterator_type.split('<')[0]
-            func_name = f"{base_type}_next"
+            func_name = getattr(node, 'next_func', None)
+            if func_name not in self.module.globals:
+                 base_type = node.iterator_type.split('<')[0]
+                 func_name = f"{base_type}_next__args__SELF_PTR"
             if func_name not in self.module.globals:
                  raise Exception(f"CodeGen: Method '{func_name}' not found")
                  
@@ -1005,12 +4554,12 @@ class CodeGen:
             
             # 4. Debox Option
             # Store option to stack to access fields
-            opt_mem = self.builder.alloca(option_ret.type)
+            opt_mem = self._entry_alloca(option_ret.type)
             self.builder.store(option_ret, opt_mem)
             
             # Extract Tag (field 0)
             # Ensure opt_mem points to a struct even if type was erased to i8
-            if not isinstance(opt_mem.type.pointee, (ir.ArrayType, ir.LiteralStructType, ir.StructureType)):
+            if not isinstance(opt_mem.type.pointee, (ir.ArrayType, ir.BaseStructType)):
                  # Deduce return type name (e.g. Option<T>)
                  opt_type_name = getattr(node, 'option_type', f"Option<{node.item_type}>")
                  actual_ty = self.get_llvm_type(opt_type_name)
@@ -1046,9 +4595,15 @@ class CodeGen:
                  
             self.builder.store(item_val, var_ptr)
             self.scopes[-1][node.var_name] = (var_ptr, node.item_type)
+            if node.items_borrowed:
+                # Items alias storage owned by the collection (VecIterator copies elements)
+                self._unowned_slots.add(var_ptr)
+            else:
+                # Each item belongs to the loop variable until its iteration ends
+                self._track_drop_flag(var_ptr, node.item_type)
             
             for stmt in node.body:
-                self.visit(stmt)
+                self.visit_stmt(stmt)
                 
             self.emit_scope_drops(self.scopes[-1])
             self.scopes.pop()
@@ -1107,7 +4662,7 @@ class CodeGen:
         self.scopes[-1][node.var_name] = (loop_var_ptr, 'i32') # i32, no tag needed for primitives
         
         for stmt in node.body:
-             self.visit(stmt)
+             self.visit_stmt(stmt)
              
         # Auto-drop (if we supported break/continue, we would need to handle drops there too)
         self.emit_scope_drops(self.scopes[-1])
@@ -1180,7 +4735,7 @@ class CodeGen:
     def visit_BlockStmt(self, node):
         self.scopes.append({})
         for stmt in node.stmts:
-             self.visit(stmt)
+             self.visit_stmt(stmt)
         # Auto-drop variables in this scope
         self.emit_scope_drops(self.scopes[-1])
         self.scopes.pop()
@@ -1226,8 +4781,10 @@ class CodeGen:
             self.scopes[-1][node.name] = (init_val, node.type_name, "value")
             return
 
+        init_val = self._coerce_scalar(init_val, llvm_type)
+
         # Alloca
-        ptr = self.builder.alloca(llvm_type, name=node.name)
+        ptr = self._entry_alloca(llvm_type, name=node.name)
         # No debug print
         if init_val.type != llvm_type:
             # Struct erasure bitcast hack for bootstrap
@@ -1235,7 +4792,7 @@ class CodeGen:
                 if len(init_val.type.elements) == len(llvm_type.elements):
                     # For aggregate values, we can't bitcast directly in LLVM without a pointer.
                     # We store to a temp and load as target type.
-                    tmp = self.builder.alloca(init_val.type)
+                    tmp = self._entry_alloca(init_val.type)
                     # Auto-bitcast for type erasure
                     if init_val.type != tmp.type.pointee:
                         tmp = self.builder.bitcast(tmp, init_val.type.as_pointer())
@@ -1252,8 +4809,21 @@ class CodeGen:
         # Store in scope: (Pointer, TypeName)
         self.scopes[-1][node.name] = (ptr, node.type_name)
 
+        init = node.initializer
+        if isinstance(init, LambdaExpr) and not node.is_mut:
+            self._closure_targets[ptr] = init.lambda_name
+        elif isinstance(init, VariableExpr):
+            self._mark_moved(init)
+        elif isinstance(init, (MemberAccess, IndexAccess)) or (isinstance(init, UnaryExpr) and init.op == '*'):
+            # Bitwise copy of a value owned elsewhere
+            self._unowned_slots.add(ptr)
+        self._track_drop_flag(ptr, node.type_name)
+
     def visit_Assignment(self, node):
         val = self.visit(node.value)
+        if not isinstance(node.target, VariableExpr):
+            # Stored into a field, element or pointee, which owns it now
+            self._mark_moved(node.value)
 
         if isinstance(node.target, VariableExpr):
             # Find stack allocation
@@ -1269,12 +4839,23 @@ class CodeGen:
                         ptr, _ = entry
                         break
             if not ptr: raise Exception(f"Undefined var {node.target.name}")
+            slot = ptr
+            # The old value is dropped before it is overwritten, unless it
+            # was moved out or is a copy of a value owned elsewhere
+            self._drop_slot(slot, entry[1])
+            val = self._coerce_scalar(val, ptr.type.pointee)
             if val.type != ptr.type.pointee:
                 ptr = self.builder.bitcast(ptr, val.type.as_pointer())
             # Auto-bitcast for type erasure
             if val.type != ptr.type.pointee:
                 ptr = self.builder.bitcast(ptr, val.type.as_pointer())
             self.builder.store(val, ptr)
+            value = node.value
+            if isinstance(value, VariableExpr):
+                self._mark_moved(value)
+            # The slot owns its new value, even if the old one had moved,
+            # unless it is a copy of a value owned elsewhere
+            self._set_owned(slot, not (isinstance(value, (MemberAccess, IndexAccess)) or (isinstance(value, UnaryExpr) and value.op == '*')))
 
         elif isinstance(node.target, MemberAccess):
             struct_val = self.visit(node.target.object)
@@ -1287,6 +4868,7 @@ class CodeGen:
             field_idx = self.struct_fields[struct_name][node.target.member]
             if isinstance(struct_val.type, ir.PointerType):
                 ptr = self.builder.gep(struct_val, [ir.Constant(ir.IntType(32), 0), ir.Constant(ir.IntType(32), field_idx)])
+                val = self._coerce_scalar(val, ptr.type.pointee)
                 if val.type != ptr.type.pointee:
                     ptr = self.builder.bitcast(ptr, val.type.as_pointer())
                 # Auto-bitcast for type erasure
@@ -1301,6 +4883,7 @@ class CodeGen:
                 # *ptr = val
                 # Evaluate 'ptr' (the operand of *)
                 ptr_val = self.visit(node.target.operand)
+                val = self._coerce_scalar(val, ptr_val.type.pointee)
                 if val.type != ptr_val.type.pointee:
                     ptr_val = self.builder.bitcast(ptr_val, val.type.as_pointer())
                 # Auto-bitcast for type erasure
@@ -1313,9 +4896,19 @@ class CodeGen:
         elif isinstance(node.target, IndexAccess):
             # ptr[i] = val  OR  arr[i] = val
             index_val = self.visit(node.target.index)
+            slot = self._vector_slot(node.target.object)
+            if slot is not None:
+                # v[i] = x on a vector variable: replace the lane in place
+                vec = self.builder.load(slot)
+                self.builder.store(self.builder.insert_element(vec, self._coerce_scalar(val, vec.type.element), index_val), slot)
+                return
             # Evaluate base (e.g. self.ptr)
             ptr_val = self.visit(node.target.object)
-            
+            # Slice<T> sugar: slice[i] = v -> *(slice.ptr + i) = v
+            is_slice = not isinstance(ptr_val.type, ir.PointerType)
+            if is_slice:
+                ptr_val = self.builder.extract_value(ptr_val, 0, name="slice_ptr")
+
             # For bootstrap, always treat as pointer indexing if not an array.
             # If it's a pointer to array, GEP needs [0, i]. If it's a pointer to T, GEP needs [i].
             if isinstance(ptr_val.type.pointee, ir.ArrayType):
@@ -1329,6 +4922,8 @@ class CodeGen:
             if val.type != ptr.type.pointee:
                 ptr = self.builder.bitcast(ptr, val.type.as_pointer())
             self.builder.store(val, ptr)
+            if is_slice:
+                return
 
             # If object is a variable, prefer addressable access.
             if isinstance(node.target.object, VariableExpr):
@@ -1448,6 +5043,23 @@ class CodeGen:
     def visit_BinaryExpr(self, node):
         left = self.visit(node.left)
         right = self.visit(node.right)
+        if isinstance(left.type, ir.VectorType) or isinstance(right.type, ir.VectorType):
+            return self._emit_vector_binary(node.op, left, right)
+
+        # Mixed integer widths (e.g. i64 var vs i32 literal): widen the narrower
+        # operand; u8 (i8) zero-extends, wider signed ints sign-extend.
+        if isinstance(left.type, ir.IntType) and isinstance(right.type, ir.IntType) \
+                and left.type.width != right.type.width and min(left.type.width, right.type.width) > 1:
+            if left.type.width < right.type.width:
+                left = self.builder.zext(left, right.type) if left.type.width == 8 else self.builder.sext(left, right.type)
+            else:
+                right = self.builder.zext(right, left.type) if right.type.width == 8 else self.builder.sext(right, left.type)
+
+        # f32 literal mixed with f64: promote to double
+        if isinstance(left.type, ir.DoubleType) and isinstance(right.type, ir.FloatType):
+            right = self._coerce_scalar(right, left.type)
+        elif isinstance(left.type, ir.FloatType) and isinstance(right.type, ir.DoubleType):
+            left = self._coerce_scalar(left, right.type)
 
         # Mapping token types to operations
         if node.op == 'PLUS':
@@ -1455,7 +5067,7 @@ class CodeGen:
                 return self.builder.gep(left, [right], name="ptr_add")
             if isinstance(right.type, ir.PointerType):
                 return self.builder.gep(right, [left], name="ptr_add")
-            if left.type == ir.FloatType():
+            if isinstance(left.type, (ir.FloatType, ir.DoubleType)):
                 return self.builder.fadd(left, right, name="faddtmp")
             return self.builder.add(left, right, name="addtmp")
         elif node.op == 'MINUS':
@@ -1463,19 +5075,19 @@ class CodeGen:
                 # pointer - offset: gep with neg offset
                 neg_right = self.builder.neg(right, name="neg_offset")
                 return self.builder.gep(left, [neg_right], name="ptr_sub")
-            if left.type == ir.FloatType():
+            if isinstance(left.type, (ir.FloatType, ir.DoubleType)):
                 return self.builder.fsub(left, right, name="fsubtmp")
             return self.builder.sub(left, right, name="subtmp")
         elif node.op == 'STAR':
-            if left.type == ir.FloatType():
+            if isinstance(left.type, (ir.FloatType, ir.DoubleType)):
                 return self.builder.fmul(left, right, name="fmultmp")
             return self.builder.mul(left, right, name="multmp")
         elif node.op == 'SLASH':
-            if left.type == ir.FloatType():
+            if isinstance(left.type, (ir.FloatType, ir.DoubleType)):
                 return self.builder.fdiv(left, right, name="fdivtmp")
             return self.builder.sdiv(left, right, name="divtmp")
         elif node.op == 'PERCENT':
-            if left.type == ir.FloatType():
+            if isinstance(left.type, (ir.FloatType, ir.DoubleType)):
                 return self.builder.frem(left, right, name="fremtmp")
             return self.builder.srem(left, right, name="remtmp")
         elif node.op == 'AND':
@@ -1483,40 +5095,40 @@ class CodeGen:
         elif node.op == 'OR':
             return self.builder.or_(left, right, name="ortmp")
         elif node.op == 'EQEQ':
-            if left.type == ir.FloatType():
+            if isinstance(left.type, (ir.FloatType, ir.DoubleType)):
                 return self.builder.fcmp_ordered('==', left, right, name="feqtmp")
             # Handle pointer == 0 comparison
             if isinstance(left.type, ir.PointerType) and isinstance(right.type, ir.IntType):
                 right = ir.Constant(left.type, None) # Convert 0 to null pointer
             return self.builder.icmp_signed('==', left, right, name="eqtmp")
         elif node.op == 'NEQ':
-            if left.type == ir.FloatType():
+            if isinstance(left.type, (ir.FloatType, ir.DoubleType)):
                 return self.builder.fcmp_ordered('!=', left, right, name="fneqtmp")
             # Handle pointer != 0 comparison
             if isinstance(left.type, ir.PointerType) and isinstance(right.type, ir.IntType):
                 right = ir.Constant(left.type, None) # Convert 0 to null pointer
             return self.builder.icmp_signed('!=', left, right, name="neqtmp")
         elif node.op == 'LT':
-            if left.type == ir.FloatType():
+            if isinstance(left.type, (ir.FloatType, ir.DoubleType)):
                 return self.builder.fcmp_ordered('<', left, right, name="flttmp")
             return self.builder.icmp_signed('<', left, right, name="lttmp")
         elif node.op == 'GT':
-            if left.type == ir.FloatType():
+            if isinstance(left.type, (ir.FloatType, ir.DoubleType)):
                 return self.builder.fcmp_ordered('>', left, right, name="fgttmp")
             return self.builder.icmp_signed('>', left, right, name="gttmp")
         elif node.op == 'LTE':
-            if left.type == ir.FloatType():
+            if isinstance(left.type, (ir.FloatType, ir.DoubleType)):
                 return self.builder.fcmp_ordered('<=', left, right, name="fltettmp")
             return self.builder.icmp_signed('<=', left, right, name="ltetmp")
         elif node.op == 'GTE':
-            if left.type == ir.FloatType():
+            if isinstance(left.type, (ir.FloatType, ir.DoubleType)):
                 return self.builder.fcmp_ordered('>=', left, right, name="fgtetmp")
             return self.builder.icmp_signed('>=', left, right, name="gtetmp")
         else:
             raise Exception(f"Unknown operator: {node.op}")
 
     def visit_IfStmt(self, node):
-        cond_val = self.visit(node.condition)
+        cond_val = self.visit_condition(node.condition)
 
         # Ensure condition is a boolean (i1)
         # If it's not (e.g. i32), compare it to 0
@@ -1531,22 +5143,79 @@ class CodeGen:
 
         # Generate 'then' block
         self.builder.position_at_end(then_bb)
+        self.scopes.append({})
         for stmt in node.then_branch:
-            self.visit(stmt)
+            self.visit_stmt(stmt)
         if not self.builder.block.is_terminated:
+            self.emit_scope_drops(self.scopes[-1])
             self.builder.branch(merge_bb)
+        self.scopes.pop()
 
         # Generate 'else' block
         self.builder.position_at_end(else_bb)
+        self.scopes.append({})
         if node.else_branch:
             for stmt in node.else_branch:
-                self.visit(stmt)
+                self.visit_stmt(stmt)
         if not self.builder.block.is_terminated:
+            self.emit_scope_drops(self.scopes[-1])
             self.builder.branch(merge_bb)
+        self.scopes.pop()
 
         # Continue
         self.builder.position_at_end(merge_bb)
 
+    def visit_MatchExpr(self, node):
+        # switch on the tag; each arm binds its payload out of the data bytes
+        # the same way for-in unpacks Option::Some
+        enum_name = node.enum_name
+        val = self.visit(node.value)
+        if node.by_ref:
+            slot = self.builder.bitcast(val, self.get_llvm_type(enum_name).as_pointer())
+        else:
+            self._mark_moved(node.value)
+            slot = self._entry_alloca(val.type, name="match_val")
+            self.builder.store(val, slot)
+        zero = ir.Constant(ir.IntType(32), 0)
+        if isinstance(slot.type.pointee, ir.IntType):
+            # tag-only enum: no payload to bind
+            tag, data = self.builder.load(slot), None
+        else:
+            tag = self.builder.load(self.builder.gep(slot, [zero, zero]))
+            data = self.builder.gep(slot, [zero, ir.Constant(ir.IntType(32), 1)])
+
+        end_bb = self.builder.append_basic_block(name="match_end")
+        switch = self.builder.switch(tag, end_bb)
+        payload_names = dict(node.payload_types)
+        for case in node.cases:
+            if case.variant_name == '_':
+                arm_bb = self.builder.append_basic_block(name="match_default")
+                switch.default = arm_bb
+            else:
+                arm_bb = self.builder.append_basic_block(name=f"match_{case.variant_name}")
+                switch.add_case(ir.Constant(ir.IntType(32), self.enum_types[enum_name][case.variant_name]), arm_bb)
+            self.builder.position_at_end(arm_bb)
+            self.scopes.append({})
+            if case.var_names:
+                payload_ty = self.enum_payloads[enum_name][case.variant_name]
+                payload_ptr = self.builder.bitcast(data, payload_ty.as_pointer())
+                fields = [payload_ptr] if len(case.var_names) == 1 else \
+                    [self.builder.gep(payload_ptr, [zero, ir.Constant(ir.IntType(32), i)]) for i in range(len(case.var_names))]
+                for name, ptype, field in zip(case.var_names, payload_names[case.variant_name], fields):
+                    var = self._entry_alloca(field.type.pointee, name=name)
+                    self.builder.store(self.builder.load(field), var)
+                    self.scopes[-1][name] = (var, ptype)
+                    if node.by_ref or name.startswith('_'):
+                        # `_` only looks at the payload, which stays with the value
+                        self._unowned_slots.add(var)
+                    self._track_drop_flag(var, ptype)
+            self.visit_stmt(case.body)
+            if not self.builder.block.is_terminated:
+                self.emit_scope_drops(self.scopes[-1])
+                self.builder.branch(end_bb)
+            self.scopes.pop()
+        self.builder.position_at_end(end_bb)
+
     def visit_WhileStmt(self, node):
         cond_bb = self.builder.append_basic_block(name="whilecond")
         loop_bb = self.builder.append_basic_block(name="whileloop")
@@ -1557,7 +5226,7 @@ class CodeGen:
 
         # Condition Block
         self.builder.position_at_end(cond_bb)
-        cond_val = self.visit(node.condition)
+        cond_val = self.visit_condition(node.condition)
         if cond_val.type != ir.IntType(1):
             cond_val = self.builder.icmp_signed('!=', cond_val, ir.Constant(cond_val.type, 0), name="loopcond")
         self.builder.cbranch(cond_val, loop_bb, end_bb)
@@ -1569,7 +5238,7 @@ class CodeGen:
         self.loop_stack.append((cond_bb, end_bb, len(self.scopes) - 1, node.label))
         
         for stmt in node.body:
-            self.visit(stmt)
+            self.visit_stmt(stmt)
             
         self.emit_scope_drops(self.scopes[-1])
         self.scopes.pop()
@@ -1599,7 +5268,7 @@ class CodeGen:
 
         # 5. Visit Body
         for stmt in node.body:
-            self.visit(stmt)
+            self.visit_stmt(stmt)
 
         # 6. Auto-Drop
         self.emit_scope_drops(self.scopes[-1])
@@ -1635,9 +5304,10 @@ class CodeGen:
         return self._get_or_create_string(val, name=name)
 
     def visit_IntegerLiteral(self, node):
-        # Infer i32 for simplicity or u8/i64 if context?
-        # For now return i32 constant
-        return ir.Constant(ir.IntType(32), node.value)
+        # i32 unless the value does not fit (then i64)
+        if -2**31 <= node.value < 2**31:
+            return ir.Constant(ir.IntType(32), node.value)
+        return ir.Constant(ir.IntType(64), node.value)
 
     def visit_FloatLiteral(self, node):
         return ir.Constant(ir.FloatType(), node.value)
@@ -1700,11 +5370,14 @@ class CodeGen:
         if '::' in node.name:
              parts = node.name.rsplit('::', 1)
              lhs = parts[0]; rhs = parts[1]
-             base_lhs = lhs.split('<')[0]
-             if base_lhs in self.enum_definitions:
+             # Prefer the instantiated enum (Option<T>) over the generic base
+             base_lhs = lhs if lhs in self.enum_types else lhs.split('<')[0]
+             if base_lhs in self.enum_definitions and base_lhs in self.enum_types:
                   enum_ty, max_size = self.enum_definitions[base_lhs]
                   if rhs in self.enum_types[base_lhs]:
                       tag = self.enum_types[base_lhs][rhs]
+                      if isinstance(enum_ty, ir.IntType):
+                          return ir.Constant(enum_ty, tag)
                       
                       # Create Enum Value
                       enum_val = ir.Constant(enum_ty, ir.Undefined)
@@ -1745,9 +5418,13 @@ class CodeGen:
         fat_ptr = self.builder.insert_value(fat_ptr, env_ptr_raw, 1)
         return fat_ptr
 
-    def _emit_closure_call(self, fat_ptr, callee_type_name, args):
+    def _emit_closure_call(self, fat_ptr, callee_type_name, args, target=None):
         func_ptr_raw = self.builder.extract_value(fat_ptr, 0)
         env_ptr_raw = self.builder.extract_value(fat_ptr, 1)
+
+        if target is not None:
+            # Statically known lambda: direct call, so LLVM can inline it
+            return self.builder.call(target, [env_ptr_raw] + [self.visit(arg) for arg in args])
         
         main_part, _, ret_str = callee_type_name.rpartition(')->')
         ret_type = self.get_llvm_type(ret_str.strip())
@@ -1763,18 +5440,68 @@ class CodeGen:
         
         processed_args = [env_ptr_raw] + [self.visit(arg) for arg in args]
         return self.builder.call(func_ptr, processed_args)
+
+    def _closure_function(self, type_name):
+        # Values of a closure type (__lambda_3, bound to an fn-bounded type
+        # parameter) only ever hold that lambda: call it directly
+        if isinstance(type_name, str) and type_name.startswith('__lambda_'):
+            return self.module.get_global(type_name)
+        return None
+
+    def _lambda_of(self, expr):
+        # Name of the lambda function an argument statically refers to, if any
+        if isinstance(expr, LambdaExpr):
+            return expr.lambda_name
+        if isinstance(expr, VariableExpr):
+            for scope in reversed(self.scopes):
+                if expr.name in scope:
+                    entry = scope[expr.name]
+                    if isinstance(entry, tuple) and len(entry) == 2:
+                        return self._closure_targets.get(entry[0])
+                    return None
+        return None
+
+    def _specialize_for_closures(self, func, arg_nodes):
+        # Monomorphize `func` over lambda arguments: the clone calls each bound
+        # closure parameter directly instead of through its fat pointer.
+        func_node = self._function_nodes.get(func.name)
+        if func_node is None or getattr(func_node, 'is_async', False) or func_node.is_kernel:
+            return func
+        bindings = {}
+        for (pname, ptype), arg in zip(func_node.params, arg_nodes):
+            if isinstance(ptype, str) and ptype.startswith('fn('):
+                lambda_name = self._lambda_of(arg)
+                if lambda_name:
+                    bindings[pname] = lambda_name
+        if not bindings:
+            return func
+
+        key = (func.name, tuple(sorted(bindings.items())))
+        if key not in self._specializations:
+            spec_name = f"{func.name}__spec__{'_'.join(bindings[p] for p in sorted(bindings))}"
+            spec = ir.Function(self.module, func.function_type, name=spec_name)
+            spec.linkage = 'internal'
+            self._specializations[key] = spec
+            self._pending_specializations.append((func_node, spec_name, bindings))
+        return self._specializations[key]
+
     def visit_CallExpr(self, node):
         callee = node.callee
         if isinstance(callee, VariableExpr):
             callee = callee.name
             
         callee_name = callee
+
+        if callee_name == '__nexa_thread_spawn':
+            return self._emit_thread_spawn(node)
         
         # 1. Built-in generic functions (Intrinsics)
         if isinstance(callee_name, str) and callee_name.startswith('cast<'):
-            target_ty_name = callee_name[5:].rstrip('>')
+            target_ty_name = callee_name[5:-1]
             target_ty = self.get_llvm_type(target_ty_name)
             val = self.visit(node.args[0])
+            if isinstance(target_ty, ir.VectorType):
+                return self._convert_lanes(self.builder, val, target_ty.element)
             
             # Pointer to pointer
             if isinstance(val.type, ir.PointerType) and isinstance(target_ty, ir.PointerType):
@@ -1788,11 +5515,21 @@ class CodeGen:
             # Int to int
             if isinstance(val.type, ir.IntType) and isinstance(target_ty, ir.IntType):
                 if val.type.width < target_ty.width:
+                    # u8 (the only 8-bit integer) widens unsigned
+                    if val.type.width <= 8:
+                        return self.builder.zext(val, target_ty)
                     return self.builder.sext(val, target_ty)
                 elif val.type.width > target_ty.width:
                     return self.builder.trunc(val, target_ty)
                 return val
             
+            # Int <-> Float
+            if isinstance(val.type, ir.IntType) and isinstance(target_ty, (ir.FloatType, ir.DoubleType)):
+                if val.type.width == 8:
+                    return self.builder.uitofp(val, target_ty)
+                return self.builder.sitofp(val, target_ty)
+            if isinstance(val.type, (ir.FloatType, ir.DoubleType)) and isinstance(target_ty, ir.IntType):
+                return self.builder.fptosi(val, target_ty)
             # Float to Float
             if isinstance(val.type, (ir.FloatType, ir.DoubleType)) and isinstance(target_ty, (ir.FloatType, ir.DoubleType)):
                 if isinstance(val.type, ir.FloatType) and isinstance(target_ty, ir.DoubleType):
@@ -1803,8 +5540,11 @@ class CodeGen:
                 
             return self.builder.bitcast(val, target_ty)
 
+        elif isinstance(callee_name, str) and self._simd_type(callee_name.split('::')[0]):
+            return self._emit_vector_call(node)
+
         elif isinstance(callee_name, str) and callee_name.startswith('sizeof<'):
-            type_name = callee_name[7:].rstrip('>')
+            type_name = callee_name[7:-1]
             llvm_ty = self.get_llvm_type(type_name)
             null_ptr = ir.Constant(llvm_ty.as_pointer(), None)
             gep = self.builder.gep(null_ptr, [ir.Constant(ir.IntType(32), 1)])
@@ -1815,6 +5555,18 @@ class CodeGen:
             idx_val = self.visit(node.args[1])
             return self.builder.gep(ptr_val, [idx_val])
 
+        elif isinstance(callee_name, str) and '<' in callee_name and callee_name.split('<')[0] in self.ATOMIC_INTRINSICS:
+            op = callee_name.split('<')[0]
+            return self._emit_atomic(op, callee_name[len(op) + 1:-1], node)
+
+        elif callee_name == 'fence':
+            return self._emit_fence(node)
+
+        elif isinstance(callee_name, str) and callee_name.startswith('drop_in_place<'):
+            # Run T's destructor on the value behind a raw pointer (no-op if T has none)
+            self._emit_drop(self.visit(node.args[0]), callee_name[14:-1])
+            return None
+
         # 2. Local variables / Function pointers
         if isinstance(callee_name, str):
             for scope in reversed(self.scopes):
@@ -1822,9 +5574,24 @@ class CodeGen:
                     entry = scope[callee_name]
                     if isinstance(entry, tuple) and len(entry) >= 2:
                         ptr, ptype_name = entry
+                        target = self._closure_function(ptype_name)
+                        if target is not None:
+                            return self._emit_closure_call(self.builder.load(ptr), ptype_name, node.args, target=target)
                         if isinstance(ptype_name, str) and ptype_name.startswith('fn('):
                             fat_ptr = self.builder.load(ptr)
-                            return self._emit_closure_call(fat_ptr, ptype_name, node.args)
+                            target = None
+                            if ptr in self._closure_targets:
+                                target = self.module.get_global(self._closure_targets[ptr])
+                            return self._emit_closure_call(fat_ptr, ptype_name, node.args, target=target)
+            # A closure captured by the enclosing lambda
+            for scope in reversed(self.scopes):
+                if '$env' in scope:
+                    lambda_node = scope.get('$env_lambda')
+                    ctype = getattr(lambda_node, 'captures', {}).get(callee_name)
+                    if isinstance(ctype, str) and (ctype.startswith('fn(') or ctype.startswith('__lambda_')):
+                        return self._emit_closure_call(self.visit(VariableExpr(callee_name)), ctype, node.args,
+                                                       target=self._closure_function(ctype))
+                    break
 
         # 3. Specific Intrinsics
         if callee_name == "print":
@@ -1841,18 +5608,75 @@ class CodeGen:
                 fmt_str = self.visit_StringLiteral(None, name="fmt_d", value_override="%d\n\0")
                 if val.type != ir.IntType(32): val = self.builder.zext(val, ir.IntType(32))
                 int_like = True
-            elif val.type == ir.FloatType():
+            elif val.type in (ir.FloatType(), ir.DoubleType()):
                 fmt_str = self.visit_StringLiteral(None, name="fmt_f", value_override="%f\n\0")
+            elif isinstance(val.type, ir.IntType) and val.type.width == 64:
+                fmt_str = self.visit_StringLiteral(None, name="fmt_ld", value_override="%lld\n\0")
+                int_like = True
+            elif isinstance(val.type, ir.IntType):
+                # Untyped expression (e.g. a variable): fall back to the LLVM type
+                fmt_str = self.visit_StringLiteral(None, name="fmt_d", value_override="%d\n\0")
+                if val.type != ir.IntType(32): val = self.builder.zext(val, ir.IntType(32))
+                int_like = True
             else:
                 fmt_str = self.visit_StringLiteral(None, name="fmt_s", value_override="%s\n\0")
             
             fmt_arg = self.builder.bitcast(fmt_str, voidptr_ty)
-            if int_like: self.builder.call(self.printf, [fmt_arg, val])
-            elif val.type == ir.FloatType(): self.builder.call(self.printf, [fmt_arg, self.builder.fpext(val, ir.DoubleType())])
+            if val.type == ir.FloatType(): val = self.builder.fpext(val, ir.DoubleType())
+            elif isinstance(val.type, ir.PointerType): val = self.builder.bitcast(val, voidptr_ty)
+            kind = {'i32': 'i32', 'i64': 'i64', 'double': 'f64', 'i8*': 'ptr'}.get(str(val.type))
+            if kind and hasattr(self, '_out_rt'):
+                # through the buffered stdout shared with std::io
+                self._uses_stdout = True
+                self.builder.call(self._out_rt[f'__nexa_out_{kind}'], [fmt_arg, val])
             else:
-                if isinstance(val.type, ir.PointerType): val_arg = self.builder.bitcast(val, voidptr_ty)
-                else: val_arg = val
-                self.builder.call(self.printf, [fmt_arg, val_arg])
+                self.builder.call(self.printf, [fmt_arg, val])
+            return None
+
+        elif callee_name == "slice_from_array":
+            arr_ptr = self.visit(node.args[0])
+            slice_ty = self.get_llvm_type(node.type_name)
+            zero = ir.Constant(ir.IntType(32), 0)
+            data = self.builder.gep(arr_ptr, [zero, zero])
+            data = self.builder.bitcast(data, slice_ty.elements[0])
+            length = ir.Constant(ir.IntType(32), arr_ptr.type.pointee.count)
+            return self.builder.insert_value(self.builder.insert_value(ir.Constant(slice_ty, ir.Undefined), data, 0), length, 1)
+
+        elif callee_name in ("panic", "assert", "__nexa_panic", "__nexa_assert"):
+            # panic(msg) / panic!(msg) print the message (with the call site
+            # for the macro forms) and exit(101); assert only when cond is false
+            voidptr_ty = ir.IntType(8).as_pointer()
+            args = list(node.args)
+            is_assert = callee_name in ("assert", "__nexa_assert")
+            if is_assert:
+                cond = self.visit(args.pop(0))
+                fail_bb = self.builder.append_basic_block("assert_fail")
+                ok_bb = self.builder.append_basic_block("assert_ok")
+                self.builder.cbranch(cond, ok_bb, fail_bb)
+                self.builder.position_at_end(fail_bb)
+            vals = [self.builder.bitcast(self.visit(a), voidptr_ty) for a in args[:2]]
+            # Output printed so far comes out before the message
+            self._emit_out_flush()
+            if len(args) == 3:
+                line = self.visit(args[2])
+                if is_assert:
+                    fmt = self.visit_StringLiteral(None, name="fmt_assert", value_override="assertion failed at %s:%d: %s\n\0")
+                else:
+                    fmt = self.visit_StringLiteral(None, name="fmt_panic_at", value_override="panic at %s:%d: %s\n\0")
+                self.builder.call(self.printf, [self.builder.bitcast(fmt, voidptr_ty), vals[1], line, vals[0]])
+            elif is_assert:
+                fmt = self.visit_StringLiteral(None, name="fmt_assert", value_override="assertion failed: %s\n\0")
+                self.builder.call(self.printf, [self.builder.bitcast(fmt, voidptr_ty), vals[0]])
+            else:
+                fmt = self.visit_StringLiteral(None, name="fmt_panic", value_override="panic: %s\n\0")
+                self.builder.call(self.printf, [self.builder.bitcast(fmt, voidptr_ty), vals[0]])
+            self.builder.call(self.exit_func, [ir.Constant(ir.IntType(32), 101)])
+            self.builder.unreachable()
+            if is_assert:
+                self.builder.position_at_end(ok_bb)
+            else:
+                # Code after a panic is dead but still has to be emitted somewhere
+                self.builder.position_at_end(self.builder.append_basic_block("after_panic"))
             return None
 
         elif callee_name == "fprintf":
@@ -1903,11 +5727,9 @@ class CodeGen:
             if self.target == "spirv" and hasattr(self, "spirv_global_invocation_id"):
                 gid = self.builder.load(self.spirv_global_invocation_id, name="spirv_gid")
                 return self.builder.extract_element(gid, ir.Constant(ir.IntType(32), 0), name="spirv_gid_x")
-            if not hasattr(self, "gpu_global_id") or self.gpu_global_id is None:
-                self.gpu_global_id = ir.GlobalVariable(self.module, ir.IntType(32), name="__gpu_global_id_sim")
-                self.gpu_global_id.initializer = ir.Constant(ir.IntType(32), 0)
-                self.gpu_global_id.linkage = "internal"
-            return self.builder.load(self.gpu_global_id, name="gpu_global_id")
+            # CPU backend: the id of the invocation running on this thread
+            self._uses_par = True
+            return self.builder.call(self._par_rt['__nexa_gpu_global_id'], [], name="gpu_global_id")
 
         elif callee_name == "gpu::dispatch":
             if len(node.args) < 2: raise Exception("gpu::dispatch expects at least 2 args")
@@ -1917,24 +5739,23 @@ class CodeGen:
             threads_val = self.visit(node.args[1])
             gpu_args = [self.visit(node.args[i]) for i in range(2, len(node.args))]
             if self.target == "native":
-                if "__nexa_gpu_dispatch" not in self.module.globals:
-                    void_ptr = ir.IntType(8).as_pointer()
-                    dispatch_ty = ir.FunctionType(ir.IntType(32), [void_ptr, ir.IntType(32), ir.IntType(32), void_ptr.as_pointer()])
-                    ir.Function(self.module, dispatch_ty, name="__nexa_gpu_dispatch")
-                dispatch_fn = self.module.globals["__nexa_gpu_dispatch"]
-                k_name_const = self._get_or_create_string(kernel_name)
-                i32 = ir.IntType(32)
-                arg_count = len(gpu_args)
-                args_array = self.builder.alloca(ir.IntType(8).as_pointer(), size=ir.Constant(i32, max(1, arg_count)), name="gpu_args_array")
-                for i, arg in enumerate(gpu_args):
-                    arg_ptr = self.builder.alloca(arg.type)
-                    self.builder.store(arg, arg_ptr)
-                    void_arg = self.builder.bitcast(arg_ptr, ir.IntType(8).as_pointer())
-                    ptr_to_slot = self.builder.gep(args_array, [ir.Constant(i32, i)])
-                    self.builder.store(void_arg, ptr_to_slot)
-                self.builder.call(dispatch_fn, [k_name_const, threads_val, ir.Constant(i32, arg_count), args_array])
+                # CPU backend: arguments go through an array of pointers to
+                # their values, read by the kernel's launcher
+                self._uses_par = True
+                kernel = self.module.get_global(kernel_name)
+                void_ptr = ir.IntType(8).as_pointer()
+                args_array = self._entry_alloca(ir.ArrayType(void_ptr, max(1, len(gpu_args))), name="gpu_args_array")
+                self._store_gpu_args(kernel, gpu_args, args_array, lambda i, ty: self._entry_alloca(ty))
+                threads = self._coerce_scalar(threads_val, ir.IntType(64))
+                launcher, grain = self._gpu_launcher(kernel)
+                self.builder.call(self._par_rt['__nexa_gpu_launch'],
+                                  [self.builder.bitcast(launcher, void_ptr), threads, ir.Constant(ir.IntType(64), grain),
+                                   self.builder.bitcast(args_array, void_ptr)])
             return None
 
+        elif callee_name == "gpu::bind":
+            return self._emit_gpu_bind(node)
+
         # 4. Struct Instantiation
         if isinstance(callee_name, str) and (callee_name in self.struct_types or ('<' in callee_name and callee_name.split('<')[0] in self.struct_types)):
             struct_key = callee_name
@@ -1949,6 +5770,7 @@ class CodeGen:
             for i, arg in enumerate(node.args):
                 arg_val = self.visit(arg)
                 struct_val = self.builder.insert_value(struct_val, arg_val, i)
+                self._mark_moved(arg)
             return struct_val
 
         # 5. Enum Variant Instantiation
@@ -1960,12 +5782,15 @@ class CodeGen:
             if enum_key in self.enum_definitions:
                 enum_ty, max_size = self.enum_definitions[enum_key]
                 tag = self.enum_types[enum_key][parts[1]]
+                if isinstance(enum_ty, ir.IntType):
+                    return ir.Constant(enum_ty, tag)
                 enum_val = ir.Constant(enum_ty, ir.Undefined)
                 tag_val = ir.Constant(ir.IntType(32), tag)
                 enum_val = self.builder.insert_value(enum_val, tag_val, 0)
                 if node.args:
                     payload_val = self.visit(node.args[0])
-                    enum_ptr = self.builder.alloca(enum_ty)
+                    self._mark_moved(node.args[0])
+                    enum_ptr = self._entry_alloca(enum_ty)
                     self.builder.store(enum_val, enum_ptr)
                     zero = ir.Constant(ir.IntType(32), 0)
                     one = ir.Constant(ir.IntType(32), 1)
@@ -1990,7 +5815,7 @@ class CodeGen:
             sz = self.builder.call(self.ftell, [f], name="file_size")
             self.builder.call(self.fseek, [f, ir.Constant(i64, 0), ir.Constant(i32, 0)])
             sz_i32 = self.builder.trunc(sz, i32)
-            buf_void = self.builder.call(self.malloc, [self.builder.add(sz_i32, ir.Constant(i32, 1))])
+            buf_void = self._emit_heap_alloc(self.builder.add(sz, ir.Constant(i64, 1)), node)
             buf = self.builder.bitcast(buf_void, ir.IntType(8).as_pointer())
             self.builder.call(self.fread, [buf_void, ir.Constant(i64, 1), sz, f])
             self.builder.call(self.fclose, [f])
@@ -2012,21 +5837,37 @@ class CodeGen:
             return None
 
         elif callee_name == "memcpy":
-            dest = self.visit(node.args[0])
-            src = self.visit(node.args[1])
-            size = self.visit(node.args[2])
+            # Typed pointers (*T from generic code) go through i8*
+            byte_ptr = ir.IntType(8).as_pointer()
+            dest = self.builder.bitcast(self.visit(node.args[0]), byte_ptr)
+            src = self.builder.bitcast(self.visit(node.args[1]), byte_ptr)
+            size = self._coerce_scalar(self.visit(node.args[2]), ir.IntType(32))
             return self.builder.call(self.memcpy, [dest, src, size, ir.Constant(ir.IntType(1), 0)])
 
         # 7. Regular Function Calls
         callee_func_name = callee_name
+        # malloc/free/realloc go through the runtime hooks, except inside the
+        # @[global_allocator] type itself, which sits underneath them
+        if callee_func_name in self._alloc_hooks:
+            owner = getattr(self._current_function_node, 'name', '') or ''
+            if not (self._global_allocator and owner.startswith(f"{self._global_allocator}_")):
+                if self._track:
+                    return self._emit_tracked_alloc_call(callee_func_name, node)
+                callee_func_name = self._alloc_hooks[callee_func_name].name
         if isinstance(callee_func_name, str) and '::' in callee_func_name:
             parts = callee_func_name.split('::')
             struct_name = parts[0].split('<')[0]
             callee_func_name = f"{struct_name}_{parts[1]}"
 
         if isinstance(callee_func_name, str) and callee_func_name in self.module.globals:
-            callee_func = self.module.globals[callee_func_name]
+            callee_func = self._specialize_for_closures(self.module.globals[callee_func_name], node.args)
             processed_args = [self.visit(arg) for arg in node.args]
+            for arg, expected in zip(node.args, callee_func.function_type.args):
+                if not isinstance(expected, ir.PointerType):
+                    self._mark_moved(arg)
+            callee_node = self._function_nodes.get(callee_func_name)
+            if callee_node is not None and any(a == 'send' for a, _ in callee_node.attrs):
+                self._mark_sent_captures(node.args)
             # ... simple cast ...
             for i in range(min(len(processed_args), len(callee_func.function_type.args))):
                 expected = callee_func.function_type.args[i]
@@ -2041,6 +5882,8 @@ class CodeGen:
                             processed_args[i] = self.builder.sext(actual, expected)
                         else:
                             processed_args[i] = self.builder.trunc(actual, expected)
+                    elif isinstance(expected, (ir.FloatType, ir.DoubleType)):
+                        processed_args[i] = self._coerce_scalar(actual, expected)
                     else:
                         processed_args[i] = self.builder.bitcast(actual, expected)
             return self.builder.call(callee_func, processed_args)
@@ -2052,33 +5895,26 @@ class CodeGen:
         ret_val = None
         if node.value:
             ret_val = self.visit(node.value)
+            self._mark_moved(node.value)
+        self._drop_stmt_temps()
 
         # Unwind scopes: Drop everything in current function scopes (LIFO)
         for scope in reversed(self.scopes):
             self.emit_scope_drops(scope)
+        self._emit_main_exit()
 
         if not self.builder.block.is_terminated:
-            if getattr(self._current_function_node, 'is_async', False):
-                # Set done = true and store result in manual state
-                for scope in reversed(self.scopes):
-                    if '$async_state' in scope:
-                        state = scope['$async_state']
-                        done_ptr = self.builder.gep(state, [ir.Constant(ir.IntType(32), 0), ir.Constant(ir.IntType(32), 0)])
-                        self.builder.store(ir.Constant(ir.IntType(1), 1), done_ptr)
-                        if ret_val:
-                            res_ptr = self.builder.gep(state, [ir.Constant(ir.IntType(32), 0), ir.Constant(ir.IntType(32), 1)])
-                            self.builder.store(ret_val, res_ptr)
-                        void_ptr = ir.IntType(8).as_pointer()
-                        h = self.builder.bitcast(state, void_ptr)
-                        self.builder.ret(h)
-                        break
+            if self._coro is not None:
+                self._emit_task_return(ret_val)
             elif ret_val:
-                self.builder.ret(ret_val)
+                self.builder.ret(self._coerce_scalar(ret_val, self.builder.function.function_type.return_type))
             else:
                 self.builder.ret_void()
 
     def _declare_function(self, node):
         if node.generics: return
+        if node.body is not None:
+            self._function_nodes[node.name] = node
 
         # Determine function type
         arg_types = []
@@ -2087,11 +5923,15 @@ class CodeGen:
                 arg_types.append(self.get_llvm_type(ptype))
         
         ret_type = ir.VoidType()
-        if getattr(node, 'is_async', False):
-            # Async functions return a coroutine handle (i8*)
+        is_async_main = getattr(node, 'is_async', False) and node.name == 'main'
+        if getattr(node, 'is_async', False) and not is_async_main:
+            # Async functions return a handle to their frame (Task<T>)
             ret_type = ir.IntType(8).as_pointer()
         elif node.return_type != 'void':
             ret_type = self.get_llvm_type(node.return_type)
+        if is_async_main and "__nexa_main_task" not in self.module.globals:
+            # `async fn main` becomes a task driven by a plain main()
+            ir.Function(self.module, ir.FunctionType(ir.IntType(8).as_pointer(), []), name="__nexa_main_task")
 
         # Add env pointer to lambda signatures
         if getattr(node, 'is_lambda', False):
@@ -2100,13 +5940,24 @@ class CodeGen:
 
         func_ty = ir.FunctionType(ret_type, arg_types, var_arg=getattr(node, 'is_vararg', False))
 
+        if node.body is None and node.name in getattr(self, '_task_rt', {}):
+            self._uses_tasks = True  # std::task calls into the async runtime
+        if node.body is None and node.name in getattr(self, '_thread_rt', {}):
+            self._uses_threads = True  # std::sync channels
+        if node.body is None and node.name in getattr(self, '_par_rt', {}):
+            self._uses_par = True  # std::par loops
+        if node.body is None and node.name in getattr(self, '_number_rt', {}):
+            self._uses_numbers = True  # std::json::parse_f64
+        if node.body is None and node.name in getattr(self, '_out_rt', {}):
+            self._uses_stdout = True  # std::io's write*
+
         # Check if exists
         try:
             func = self.module.get_global(node.name)
         except (KeyError, AttributeError):
             func = ir.Function(self.module, func_ty, name=node.name)
 
-        if node.is_kernel:
+        if node.is_kernel and self.target == "spirv":
             func.calling_convention = 'spir_kernel'
 
         return func
@@ -2114,15 +5965,18 @@ class CodeGen:
     def visit_ExternBlock(self, node):
         pass # Headers already declared in Pass 2
 
-    def visit_FunctionDef(self, node):
+    def visit_FunctionDef(self, node, name=None, closure_bindings=None):
         if getattr(node, 'generics', None): return
         
         # If it's a declaration only (extern), stop here
         if node.body is None:
             return
 
-        # Function already declared in Pass 2
-        func = self.module.get_global(node.name)
+        if getattr(node, 'is_async', False):
+            return self._emit_async_function(node)
+
+        # Function already declared in Pass 2 (or as a closure specialization)
+        func = self.module.get_global(name or node.name)
         if self.target == "spirv" and self.spirv_env == "vulkan" and node.is_kernel:
             self._kernel_function_names.add(node.name)
 
@@ -2139,21 +5993,6 @@ class CodeGen:
         # Create new scope
         self.scopes.append({})
 
-        is_async = getattr(node, 'is_async', False)
-        if is_async:
-            # Manual Coroutine State
-            res_ty = self.get_llvm_type(node.return_type)
-            # struct { i1 done, T result }
-            state_ty = ir.LiteralStructType([ir.IntType(1), res_ty])
-            state_ptr = self.builder.call(self.malloc, [ir.Constant(ir.IntType(32), 16)]) # Simplified size
-            state = self.builder.bitcast(state_ptr, state_ty.as_pointer())
-            
-            # Init state: done = false
-            done_ptr = self.builder.gep(state, [ir.Constant(ir.IntType(32), 0), ir.Constant(ir.IntType(32), 0)])
-            self.builder.store(ir.Constant(ir.IntType(1), 0), done_ptr)
-            
-            self.scopes[-1]['$async_state'] = state
-
         # Register arguments in scope
         if self.target == "spirv" and self.spirv_env == "vulkan" and node.is_kernel:
             for pname, ptype in node.params:
@@ -2177,6 +6016,7 @@ class CodeGen:
 
             # Special case for main(argc, argv)
             is_main = node.name == "main" and not getattr(node, 'is_lambda', False)
+            is_destructor = node.name.split('__args__')[0].endswith('_drop')
             
             for i, (pname, ptype) in enumerate(node.params):
                 arg_val = func.args[i + offset]
@@ -2190,6 +6030,16 @@ class CodeGen:
                 
                 alloca = self.builder.alloca(self.get_llvm_type(actual_ptype), name=pname)
                 self.builder.store(arg_val, alloca)
+                # By-value parameters are owned and dropped on exit unless
+                # moved on. A method taking `self` by value consumes it itself
+                # (drop, StringBuilder::build), and so does a free-function
+                # destructor (String_drop(s: String)), so those are left alone
+                if pname == 'self' or is_main or offset == 1 or is_destructor:
+                    self._unowned_slots.add(alloca)
+                else:
+                    self._track_drop_flag(alloca, actual_ptype)
+                if closure_bindings and pname in closure_bindings:
+                    self._closure_targets[alloca] = closure_bindings[pname]
 
                 # Store in scope: (Pointer, TypeName)
                 self.scopes[-1][pname] = (alloca, actual_ptype)
@@ -2198,10 +6048,12 @@ class CodeGen:
         for stmt in node.body:
             if self.builder.block.is_terminated:
                 break
-            self.visit(stmt)
+            self.visit_stmt(stmt)
 
         # Add return void/undef if missing
         if not self.builder.block.is_terminated:
+            self.emit_scope_drops(self.scopes[-1])
+            self._emit_main_exit()
             if isinstance(func.function_type.return_type, ir.VoidType):
                 self.builder.ret_void()
             elif isinstance(func.function_type.return_type, ir.IntType):
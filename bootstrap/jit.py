@@ -1,5 +1,6 @@
 import llvmlite.binding as llvm
 import ctypes
+import ctypes.util
 import os
 import sys
 
@@ -48,35 +49,31 @@ def fs_read_file_sret(out_ptr, path_ptr):
     buf = fs_read_file(path_ptr)
     ctypes.memmove(out_ptr, ctypes.byref(buf), ctypes.sizeof(Buffer))
 
-# --- Coroutine Hooks ---
+def missing_symbol():
+    print("[JIT] called a C function whose library is not installed")
+    sys.stdout.flush()
+    os._exit(1)
 
-@ctypes.CFUNCTYPE(None, c_void_p)
-def __nexa_resume(handle):
-    pass 
+MISSING_SYMBOL = ctypes.CFUNCTYPE(None)(missing_symbol)
 
-@ctypes.CFUNCTYPE(ctypes.c_bool, c_void_p)
-def __nexa_is_done(handle):
-    return True 
+# Libraries behind the std::db and std::net bindings, loaded when present
+OPTIONAL_LIBS = ("sqlite3", "curl")
 
-@ctypes.CFUNCTYPE(None, c_void_p)
-def __nexa_destroy(handle):
-    pass
-
-@ctypes.CFUNCTYPE(None, c_char_p, c_int32, c_int32, c_void_p)
-def __nexa_gpu_dispatch(kernel_name_ptr, threads, arg_count, args_ptr):
-    kernel_name = ctypes.string_at(kernel_name_ptr).decode('utf-8')
-    # Convert void** args to a list of pointers
-    args = ctypes.cast(args_ptr, ctypes.POINTER(ctypes.c_void_p))
-    
-    # Check if we have a real GPU driver linked or use a fallback
-    print(f"[JIT-GPU] Dispatching kernel '{kernel_name}' for {threads} threads...")
-    
-    # In JIT mode, we'll use a simple multithreaded simulation if real hardware is not linked
-    # Note: In 'native' mode (nxc build), it uses the C++ Silicon Driver.
-    for i in range(threads):
-        # This is a fallback for JIT. 
-        # A real JIT GPU dispatch would load OpenCL.dll here.
-        pass
+def resolve_externs(mod):
+    # MCJIT leaves calls to unresolved symbols pointing at garbage, which
+    # crashes even programs that never reach them (anything that imports
+    # std::db without libsqlite3): route them to a stub that exits instead
+    for name in OPTIONAL_LIBS:
+        path = ctypes.util.find_library(name)
+        if path:
+            try:
+                llvm.load_library_permanently(path)
+            except RuntimeError:
+                pass
+    stub = ctypes.cast(MISSING_SYMBOL, c_void_p).value
+    for f in mod.functions:
+        if f.is_declaration and not f.name.startswith("llvm.") and "::" not in f.name and not llvm.address_of_symbol(f.name):
+            llvm.add_symbol(f.name, stub)
 
 # --- JIT Engine ---
 
@@ -86,10 +83,16 @@ def run_jit(llvm_ir):
     llvm.initialize_native_asmprinter()
     
     target = llvm.Target.from_default_triple()
-    target_machine = target.create_target_machine()
+    # Compile for the host CPU so SIMD kernel steps get AVX2/AVX-512
+    try:
+        features = llvm.get_host_cpu_features().flatten()
+    except RuntimeError:
+        features = ""
+    target_machine = target.create_target_machine(cpu=llvm.get_host_cpu_name(), features=features)
     
     mod = llvm.parse_assembly(llvm_ir)
     mod.verify()
+    resolve_externs(mod)
     
     ee = llvm.create_mcjit_compiler(mod, target_machine)
     ee.finalize_object()
@@ -102,9 +105,6 @@ def run_jit(llvm_ir):
     llvm.add_symbol("memcpy", ctypes.cast(libc.memcpy, c_void_p).value)
     llvm.add_symbol("printf", ctypes.cast(libc.printf, c_void_p).value)
     
-    # GPU Dispatch symbol
-    llvm.add_symbol("__nexa_gpu_dispatch", ctypes.cast(__nexa_gpu_dispatch, c_void_p).value)
-    
     # Custom symbols
     FS_READ_PROTO = ctypes.CFUNCTYPE(None, c_void_p, c_void_p)
     fs_read_func = FS_READ_PROTO(fs_read_file_sret)
@@ -118,21 +118,26 @@ def run_jit(llvm_ir):
     fs_append_func = FS_APPEND_PROTO(fs_append_file)
     llvm.add_symbol("fs::append_file", ctypes.cast(fs_append_func, c_void_p).value)
 
-    # Async hooks
-    llvm.add_symbol("__nexa_resume", ctypes.cast(__nexa_resume, c_void_p).value)
-    llvm.add_symbol("__nexa_is_done", ctypes.cast(__nexa_is_done, c_void_p).value)
-    llvm.add_symbol("__nexa_destroy", ctypes.cast(__nexa_destroy, c_void_p).value)
+    # Async hooks (__nexa_resume & co.) and the CPU backend behind
+    # gpu::dispatch are emitted into the module by CodeGen
     
     main_ptr = ee.get_function_address("main")
     if not main_ptr:
         print("Error: 'main' function not found in JIT module.")
         return 1
         
-    main_func = ctypes.CFUNCTYPE(c_int32)(main_ptr)
+    # `fn main()` without a return type exits with 0
+    returns_void = str(mod.get_function("main").type).startswith("void")
+    main_func = ctypes.CFUNCTYPE(None if returns_void else c_int32)(main_ptr)
     
     print("[JIT] Running main...")
     try:
         ret = main_func()
+        # Threads the program left running (detached JoinHandles, the
+        # std::par pool) still point into the JIT'd code: keep it mapped.
+        ee.detach()
+        if returns_void:
+            ret = 0
         print(f"[JIT] main returned: {ret}")
         return ret
     except OSError as e:
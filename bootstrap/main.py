@@ -3,7 +3,7 @@ import os
 import argparse
 from lexer import Lexer
 import n_parser
-from n_parser import ModDecl, FunctionDef, StructDef, EnumDef, ImplDef
+from n_parser import ModDecl, FunctionDef, StructDef, EnumDef, ImplDef, ExternBlock
 from codegen import CodeGen
 from errors import CompilerError
 import semantic
@@ -25,6 +25,27 @@ def mangle_ast(nodes, prefix):
             node.struct_name = f"{prefix}_{node.struct_name}"
             for method in node.methods:
                 method.module = node.module
+        elif isinstance(node, ExternBlock):
+            # C symbols keep their names; only the types in their
+            # signatures resolve inside the module
+            if getattr(node, 'module', None):
+                node.module = f"{prefix}::{node.module}"
+            else:
+                node.module = prefix
+
+def tag_source(nodes, path):
+    # Remember which file each function came from (--track-alloc call sites)
+    rel = os.path.relpath(path)
+    if rel.startswith(".."):
+        rel = os.path.abspath(path)
+    for node in nodes:
+        if isinstance(node, FunctionDef):
+            node.source_file = rel
+        elif isinstance(node, ImplDef):
+            for method in node.methods:
+                method.source_file = rel
+        elif isinstance(node, ModDecl) and node.body is not None:
+            tag_source(node.body, path)
 
 def resolve_modules(ast, base_dir):
     new_ast = []
@@ -57,6 +78,7 @@ def resolve_modules(ast, base_dir):
                 tokens = lx.tokenize()
                 p = n_parser.Parser(tokens)
                 mod_ast = p.parse()
+                tag_source(mod_ast, mod_path)
                 
                 # Recurse
                 mod_ast = resolve_modules(mod_ast, os.path.dirname(mod_path))
@@ -83,6 +105,9 @@ def main():
     ap.add_argument("--run-jit", action="store_true", help="Run the generated code immediately using JIT (no external compiler required)")
     ap.add_argument("--run-tests", action="store_true", help="Find and run all functions marked with @[test]")
     ap.add_argument("--out", default=None, help="Output path (default: output.ll or output.spv)")
+    ap.add_argument("--kernel-lanes", type=int, choices=[1, 4, 8, 16], default=8, help="Global ids per SIMD step when kernels run on the CPU (8 for AVX2, 16 for AVX-512; 1 runs one id per kernel call)")
+    ap.add_argument("--track-alloc", action="store_true", help="Count malloc/realloc/free and arena allocations per call site and write a JSON report when main returns")
+    ap.add_argument("--alloc-report", default="alloc_report.json", help="Report path for --track-alloc (default: alloc_report.json)")
     args = ap.parse_args()
 
     filepath = args.file
@@ -96,6 +121,7 @@ def main():
     # 2. Parsing
     p = n_parser.Parser(tokens)
     ast = p.parse()
+    tag_source(ast, filepath)
     
     # 2.5 Resolve Modules
     ast = resolve_modules(ast, os.path.dirname(os.path.abspath(filepath)))
@@ -173,6 +199,8 @@ def main():
         emit_kernels_only=emit_kernels_only,
         spirv_env=spirv_env,
         spirv_local_size=args.spirv_local_size,
+        track_alloc=args.alloc_report if args.track_alloc else None,
+        kernel_lanes=args.kernel_lanes,
     )
     llvm_ir = codegen.generate(ast)
 
@@ -181,6 +209,8 @@ def main():
         print("[JIT] Starting JIT...")
         ret = run_jit(str(llvm_ir))
         print(f"[JIT] Finished with code {ret}")
+        if args.track_alloc:
+            print(f"[JIT] Allocation report: {args.alloc_report}")
         return
 
     if args.emit == "ll":
@@ -1,8 +1,9 @@
 from lexer import Lexer
-from n_parser import Parser, FunctionDef, StructDef, EnumDef, ImplDef, TraitDef, MatchExpr, CaseArm, ArrayLiteral, IndexAccess, UnaryExpr, VariableExpr, IfStmt, WhileStmt, ForStmt, VarDecl, Assignment, CallExpr, MemberAccess, MethodCall, ReturnStmt, BinaryExpr, RegionStmt, FloatLiteral, CharLiteral, IntegerLiteral, BreakStmt, ContinueStmt, UseStmt, TypeAlias
+from n_parser import Parser, FunctionDef, StructDef, EnumDef, ImplDef, TraitDef, MatchExpr, CaseArm, ArrayLiteral, IndexAccess, UnaryExpr, VariableExpr, IfStmt, WhileStmt, ForStmt, VarDecl, Assignment, CallExpr, MemberAccess, MethodCall, ReturnStmt, BinaryExpr, RegionStmt, FloatLiteral, CharLiteral, IntegerLiteral, BreakStmt, ContinueStmt, UseStmt, TypeAlias, LambdaExpr
 from errors import CompilerError
 import sys
 import copy
+import re
 
 class SemanticAnalyzer:
     def __init__(self):
@@ -15,7 +16,7 @@ class SemanticAnalyzer:
         self.impls = set() # {(struct_name, trait_name)}
         self.aliases = {} # {alias_name: full_qualified_name}
         self.loop_stack = [] # list of labels (None if no label)
-        self.functions = set(['print', 'gpu::global_id', 'gpu::dispatch', 'panic', 'assert', 'slice_from_array', 'fs::read_file', 'fs::write_file', 'fs::append_file', '__nexa_panic', '__nexa_assert'])
+        self.functions = set(['print', 'gpu::global_id', 'gpu::dispatch', 'gpu::bind', 'panic', 'assert', 'slice_from_array', 'fs::read_file', 'fs::write_file', 'fs::append_file', '__nexa_panic', '__nexa_assert'])
         self.function_defs = {} # name -> list of FunctionDef
         self.structs = {} # name -> {field: type}
         self.struct_defs = {} # name -> StructDef (for privacy check)
@@ -34,6 +35,9 @@ class SemanticAnalyzer:
         self.lambda_base_scopes = [] # Stack of len(self.scopes) when lambda started
         self.lambda_capture_stack = [] # Stack of dicts: {name: type}
         self.lambda_count = 0
+        self.impl_generics = set() # type parameters of the impl being analyzed
+        self.copy_types = set() # structs marked @[derive(Copy)]
+        self.expected_type = None # declared type the expression being checked flows into
 
 
     def get_suggestion(self, name, possibilities):
@@ -50,7 +54,16 @@ class SemanticAnalyzer:
         if not name: return name
         # Normalize: remove spaces
         name = name.replace(' ', '')
-        
+        for sigil in ('&mut', '&'):
+            if name.startswith(sigil):
+                return sigil + self.resolve_type_name(name[len(sigil):])
+        if name.endswith('*'):
+            return self.resolve_type_name(name[:-1]) + '*'
+        if name.startswith('[') and name.endswith(']') and ':' in name:
+            # [T:N] arrays
+            elem, size = name[1:-1].rsplit(':', 1)
+            return f"[{self.resolve_type_name(elem)}:{size}]"
+
         # Mark as used if it's a known struct/enum
         base_name = name.split('<')[0] if '<' in name else name
         if base_name in self.struct_used: self.struct_used[base_name] = True
@@ -140,13 +153,23 @@ class SemanticAnalyzer:
 
     def is_copy_type(self, type_name: str) -> bool:
         if not type_name: return False
-        if type_name in ('i32', 'i64', 'u64', 'u8', 'bool', 'f32', 'string', 'char'):
+        if type_name in ('i32', 'i64', 'u64', 'u8', 'bool', 'f32', 'f64', 'string', 'char'):
             return True
         if type_name.endswith('*'):
             return True
+        if type_name.startswith('&'):
+            # Passing a reference on reborrows it; the referent is not moved
+            return True
+        if type_name.split('<')[0] in self.copy_types:
+            return True
+        if self.simd_type(type_name):
+            return True
         return False
 
     def move_var(self, name: str, node=None):
+        if '::' in name:
+            # Unit enum variants (Ordering::SeqCst) are values, not places
+            return
         var_info = self.lookup(name)
         if not var_info:
             self.error(f"Semantic Error: Move of undefined variable '{name}'", node)
@@ -161,6 +184,216 @@ class SemanticAnalyzer:
 
         var_info['moved'] = True
 
+    THREAD_LOCAL_TYPES = ('std_rc_Rc', 'std_rc_Weak')
+
+    # Iterators whose items are bitwise copies of elements a collection
+    # still owns, and the adapters that hand their source's items through
+    BORROWING_ITERATORS = ('std_vec_VecIterator', 'std_map_HashMapIterator')
+    PASS_THROUGH_ITERATORS = ('std_vec_Filter', 'std_vec_Take', 'std_vec_Enumerate', 'std_vec_Zip')
+
+    def iterator_borrows_items(self, type_name):
+        # for-in drops the loop variable after each iteration unless it does
+        base = type_name.split('<')[0]
+        if base in self.BORROWING_ITERATORS:
+            return True
+        if base in self.PASS_THROUGH_ITERATORS and '<' in type_name:
+            return any(self.iterator_borrows_items(a) for a in self.split_generic_args(type_name[type_name.find('<')+1:-1]))
+        return False
+
+    def check_thread_send(self, func_def, node):
+        # Closures passed to __nexa_thread_spawn, or to fn-typed parameters
+        # of a @[send] function, run on another thread: a captured borrow
+        # could outlive its referent, and owned captures move into the thread.
+        sends = func_def.name == '__nexa_thread_spawn' or any(a == 'send' for a, _ in getattr(func_def, 'attrs', []))
+        if not sends: return
+        for (pname, ptype), arg in zip(func_def.params, node.args):
+            if not (isinstance(ptype, str) and ptype.startswith('fn(')): continue
+            closure = arg if isinstance(arg, LambdaExpr) else None
+            if isinstance(arg, VariableExpr):
+                v = self.lookup(arg.name)
+                closure = v.get('lambda') if v else None
+            if closure is None: continue
+            for name, ctype in sorted(getattr(closure, 'captures', {}).items()):
+                v = self.lookup(name)
+                if ctype.startswith('&') or (v and v.get('is_ref')):
+                    shown = ctype if ctype.startswith('&') else f"&{ctype[:-1]}"
+                    self.error(f"Ownership Error: closure sent to another thread captures borrow '{name}' ({shown})", arg,
+                               hint="capture an owned value or a raw pointer instead", error_code="E0008")
+                if ctype.split('<')[0] in self.THREAD_LOCAL_TYPES:
+                    # Rc counts are not atomic
+                    self.error(f"Ownership Error: closure sent to another thread captures '{name}' ({ctype}), which is not thread-safe", arg,
+                               hint="share it through std::sync::Arc instead", error_code="E0008")
+                if not self.is_copy_type(ctype):
+                    self.move_var(name, arg)
+
+    # Argument counts of the atomic intrinsics, and which orderings each
+    # ordering argument may not use (constant Ordering::X paths only)
+    ATOMIC_ARITY = {'atomic_load': 2, 'atomic_store': 3, 'fetch_add': 3, 'fetch_sub': 3, 'atomic_swap': 3, 'compare_exchange': 5, 'fence': 1}
+    ATOMIC_INVALID_ORDERINGS = {
+        'atomic_load': (1, ('Release', 'AcqRel'), "loads use Relaxed, Acquire or SeqCst"),
+        'atomic_store': (2, ('Acquire', 'AcqRel'), "stores use Relaxed, Release or SeqCst"),
+        'compare_exchange': (4, ('Release', 'AcqRel'), "the failure ordering is a load: Relaxed, Acquire or SeqCst"),
+        'fence': (0, ('Relaxed',), "a Relaxed fence orders nothing; use Acquire, Release, AcqRel or SeqCst"),
+    }
+
+    def check_atomic_intrinsic(self, op, type_name, node):
+        if len(node.args) != self.ATOMIC_ARITY[op]:
+            self.error(f"Type Error: '{op}' expects {self.ATOMIC_ARITY[op]} arguments, got {len(node.args)}", node, error_code="E0002")
+        arg_types = [self.visit(a) for a in node.args]
+        if op != 'fence' and not (arg_types[0].endswith('*') or arg_types[0].startswith('&')):
+            self.error(f"Type Error: '{op}' expects a pointer to {type_name}, got {arg_types[0]}", node, error_code="E0002")
+        if op in ('fetch_add', 'fetch_sub') and type_name not in ('i32', 'i64', 'u8', 'u64'):
+            self.error(f"Type Error: '{op}' needs an integer type, got {type_name}", node, error_code="E0002")
+        if op in self.ATOMIC_INVALID_ORDERINGS:
+            index, invalid, hint = self.ATOMIC_INVALID_ORDERINGS[op]
+            arg = node.args[index]
+            if isinstance(arg, VariableExpr) and '::' in arg.name and arg.name.rsplit('::', 1)[1] in invalid:
+                self.error(f"Type Error: '{op}' cannot use {arg.name.rsplit('::', 1)[1]} ordering", node, hint=hint, error_code="E0002")
+        if op in ('atomic_store', 'fence'): return 'void'
+        return type_name
+
+    def check_gpu_dispatch(self, node):
+        # gpu::dispatch(kernel, threads, args...): the first argument names a
+        # kernel fn (not a variable) and the rest are its parameters.
+        if len(node.args) < 2 or not isinstance(node.args[0], VariableExpr):
+            self.error("Type Error: gpu::dispatch expects a kernel fn, a thread count and the kernel's arguments", node, error_code="E0002")
+        threads = self.visit(node.args[1])
+        if threads not in ('i32', 'i64'):
+            self.error(f"Type Error: gpu::dispatch thread count must be an integer, got {threads}", node, error_code="E0002")
+        self.resolve_kernel(node, node.args[0], node.args[2:])
+        return 'void'
+
+    def check_gpu_bind(self, node):
+        # gpu::bind(kernel, args...): a std::gpu::Dispatch to record on a
+        # gpu::Queue, checked like gpu::dispatch without the thread count
+        if not node.args or not isinstance(node.args[0], VariableExpr):
+            self.error("Type Error: gpu::bind expects a kernel fn and the kernel's arguments", node, error_code="E0002")
+        if 'std_gpu_Dispatch' not in self.structs:
+            self.error("Type Error: gpu::bind needs std::gpu", node, hint="add `mod std;` and `use std::gpu::Queue;`", error_code="E0002")
+        self.resolve_kernel(node, node.args[0], node.args[1:])
+        return 'std_gpu_Dispatch'
+
+    def resolve_kernel(self, node, kernel, args):
+        # It is resolved like a call so codegen gets the mangled kernel name
+        func_def, mangled = self.resolve_overload(kernel.name, [self.visit(a) for a in args], node)
+        if not func_def.is_kernel:
+            self.error(f"Type Error: '{kernel.name}' is not a kernel fn", node, hint=f"declare it as `kernel fn {kernel.name}(...)`", error_code="E0002")
+        func_def.used = True
+        kernel.name = mangled
+
+    # Built-in SIMD vectors: <elem>x<lanes> (f32x8, i32x4, ...) lower to an
+    # LLVM <lanes x elem>, and comparisons give a boolx<lanes> mask.
+    # Operators work lane by lane and broadcast a scalar operand; both
+    # vector operands must have the same element type and lane count.
+    SIMD_ELEMS = ('i32', 'i64', 'f32', 'f64', 'bool')
+    SIMD_LANES = (2, 4, 8, 16, 32, 64)
+    SIMD_REDUCTIONS = ('reduce_sum', 'reduce_product', 'reduce_min', 'reduce_max')
+
+    def simd_type(self, type_name):
+        # (element type, lanes) of a vector type name, else None
+        if not isinstance(type_name, str): return None
+        elem, x, lanes = type_name.rpartition('x')
+        if x and elem in self.SIMD_ELEMS and lanes.isdigit() and int(lanes) in self.SIMD_LANES:
+            return elem, int(lanes)
+        return None
+
+    def check_simd_binary(self, node, l, r):
+        lv, rv = self.simd_type(l), self.simd_type(r)
+        vec = l if lv else r
+        elem, lanes = lv or rv
+        if lv and rv and lv[1] != rv[1]:
+            self.error(f"Type Error: lane count mismatch: {l} {node.op} {r}", node, hint=f"{l} has {lv[1]} lanes, {r} has {rv[1]}", error_code="E0002")
+        if lv and rv and lv[0] != rv[0]:
+            self.error(f"Type mismatch: {l} {node.op} {r}", node, hint=f"convert one side with cast::<{l}>(...)", error_code="E0002")
+        scalar = r if lv and not rv else l if rv and not lv else None
+        if scalar is not None and scalar != elem and not self.check_type_compatibility(elem, scalar, node):
+            self.error(f"Type mismatch: {l} {node.op} {r}", node, hint=f"a scalar operand is broadcast to every lane and must be {elem}", error_code="E0002")
+        if node.op in ('EQEQ', 'NEQ', 'LT', 'GT', 'LTE', 'GTE'):
+            return f"boolx{lanes}"
+        if (node.op in ('AND', 'OR')) != (elem == 'bool'):
+            self.error(f"Type Error: '{node.op}' is not defined on {vec}", node, error_code="E0002")
+        return vec
+
+    def check_simd_memory(self, vec, elem, type_name, node):
+        # Vectors load from and store to consecutive elements of a slice,
+        # Buffer or pointer of the element type
+        if elem == 'bool' or type_name not in (f"Slice<{elem}>", f"Buffer<{elem}>", f"{elem}*"):
+            self.error(f"Type Error: {vec} loads and stores need []{elem}, Buffer<{elem}> or *{elem}, got {type_name}", node, error_code="E0002")
+
+    def check_simd_call(self, node, callee):
+        # f32x4(a, b, c, d), f32x4::splat(x) and f32x4::load(src, index)
+        vec, _, func = callee.partition('::')
+        elem, lanes = self.simd_type(vec)
+        arg_types = [self.visit(a) for a in node.args]
+        expected = {'': lanes, 'splat': 1, 'load': 2}
+        if func not in expected:
+            self.error(f"Type Error: '{vec}' has no function '{func}'", node, hint="vector functions are splat and load", error_code="E0002")
+        if len(arg_types) != expected[func]:
+            self.error(f"Type Error: '{callee}' expects {expected[func]} arguments, got {len(arg_types)}", node, error_code="E0002")
+        if func == 'load':
+            self.check_simd_memory(vec, elem, arg_types[0], node)
+            if arg_types[1] not in ('i32', 'i64'):
+                self.error(f"Type Error: {vec}::load index must be an integer, got {arg_types[1]}", node, error_code="E0002")
+        else:
+            for t in arg_types:
+                if t != elem and not self.check_type_compatibility(elem, t, node):
+                    self.error(f"Type Error: {vec} lanes are {elem}, got {t}", node, error_code="E0002")
+        node.callee = callee
+        return vec
+
+    def check_simd_method(self, node, vec):
+        elem, lanes = self.simd_type(vec)
+        name = node.method_name
+        arg_types = [self.visit(a) for a in node.args]
+        node.simd_type = vec
+        def arity(n):
+            if len(arg_types) != n:
+                self.error(f"Type Error: '{name}' on {vec} expects {n} arguments, got {len(arg_types)}", node, error_code="E0002")
+        if name == 'shuffle':
+            # a.shuffle(b, i...): lane k of the result is lane i_k of a ++ b
+            indices = node.args[1:]
+            if not arg_types or arg_types[0] != vec:
+                self.error(f"Type Error: shuffle takes a second {vec}, then lane indices", node, error_code="E0002")
+            if len(indices) not in self.SIMD_LANES:
+                self.error(f"Type Error: shuffle needs {', '.join(map(str, self.SIMD_LANES))} lane indices, got {len(indices)}", node, error_code="E0002")
+            for index in indices:
+                if not isinstance(index, IntegerLiteral) or not 0 <= index.value < 2 * lanes:
+                    self.error(f"Type Error: shuffle lane indices must be integer literals below {2 * lanes}", index, error_code="E0002")
+            return f"{elem}x{len(indices)}"
+        if name == 'replace':
+            arity(2)
+            if arg_types[0] != 'i32' or (arg_types[1] != elem and not self.check_type_compatibility(elem, arg_types[1], node)):
+                self.error(f"Type Error: replace takes a lane index and a {elem}", node, error_code="E0002")
+            return vec
+        if elem == 'bool' and name in ('any', 'all'):
+            arity(0)
+            return 'bool'
+        if elem == 'bool' and name == 'select':
+            # Lanes of the first vector where the mask is set, else the second
+            arity(2)
+            picked = self.simd_type(arg_types[0])
+            if arg_types[0] != arg_types[1] or not picked or picked[1] != lanes:
+                self.error(f"Type Error: select on {vec} needs two vectors of the same type with {lanes} lanes, got {arg_types[0]} and {arg_types[1]}", node, error_code="E0002")
+            return arg_types[0]
+        if elem != 'bool' and name in self.SIMD_REDUCTIONS:
+            arity(0)
+            return elem
+        if elem != 'bool' and name in ('min', 'max'):
+            arity(1)
+            if arg_types[0] != vec:
+                self.error(f"Type Error: {name} on {vec} takes another {vec}, got {arg_types[0]}", node, error_code="E0002")
+            return vec
+        if elem != 'bool' and name == 'store':
+            arity(2)
+            self.check_simd_memory(vec, elem, arg_types[0], node)
+            if arg_types[1] not in ('i32', 'i64'):
+                self.error(f"Type Error: {vec}.store index must be an integer, got {arg_types[1]}", node, error_code="E0002")
+            return 'void'
+        methods = ['any', 'all', 'select'] if elem == 'bool' else list(self.SIMD_REDUCTIONS) + ['min', 'max', 'store']
+        suggestion = self.get_suggestion(name, methods + ['shuffle', 'replace'])
+        hint = f"did you mean '.{suggestion}()'?" if suggestion else None
+        self.error(f"Method '{name}' not found on type '{vec}'", node, hint=hint, error_code="E0005")
+
     def check_privacy(self, target_node, target_name):
         target_mod = getattr(target_node, 'module', "")
         if not target_mod: return
@@ -175,7 +408,7 @@ class SemanticAnalyzer:
             raise Exception(f"Privacy Error: '{target_name}' is private to module '{target_mod}'")
 
     def get_mangled_name(self, name, params):
-        if name in ('print', 'panic', 'assert', 'malloc', 'free', 'realloc', 'memcpy') or name.startswith('gpu::') or name.startswith('fs::'):
+        if name in ('print', 'panic', 'assert', 'malloc', 'free', 'realloc', 'memcpy') or name.startswith('gpu::') or name.startswith('fs::') or name.startswith('Arena_'):
             return name
         
         # Don't mangle if already mangled
@@ -265,6 +498,10 @@ class SemanticAnalyzer:
 
     def generate_derive(self, node, trait):
         from n_parser import ImplDef, FunctionDef, CallExpr, StringLiteral, MemberAccess, VariableExpr, ReturnStmt, IntegerLiteral, MethodCall
+        if trait == 'Copy':
+            # Marker only: values are duplicated bitwise instead of moved
+            self.copy_types.add(node.name)
+            return None
         if trait == 'Debug':
             # Generate Debug for Struct
             if isinstance(node, StructDef):
@@ -463,7 +700,13 @@ class SemanticAnalyzer:
             self.generic_structs['Task'] = StructDef('Task', [('coro_handle', 'u8*'), ('done', 'bool')], generics=[('T', None, False)])
         if 'Buffer' not in self.generic_structs and 'Buffer' not in self.structs:
             self.generic_structs['Buffer'] = StructDef('Buffer', [('ptr', 'T*'), ('len', 'i32')], generics=[('T', None, False)])
-        self.structs['Arena'] = {'chunk': 'u8*', 'offset': 'i32', 'capacity': 'i32'}
+        self.structs['Arena'] = {'chunk': 'u8*', 'offset': 'i64', 'capacity': 'i64', 'large': 'u8*'}
+        # Arena methods are emitted by CodeGen._define_arena_methods
+        self.struct_methods['Arena'] = {
+            'alloc': [FunctionDef('Arena_alloc', [('self', 'Arena*'), ('size', 'i32')], 'u8*', None)],
+            'alloc_aligned': [FunctionDef('Arena_alloc_aligned', [('self', 'Arena*'), ('size', 'i32'), ('align', 'i32')], 'u8*', None)],
+            'reset': [FunctionDef('Arena_reset', [('self', 'Arena*')], 'void', None)],
+        }
 
         # 1.5 Process Imports (Use Statements)
         for node in ast:
@@ -479,6 +722,18 @@ class SemanticAnalyzer:
             if type(node).__name__ == "UseStmt": continue
             if isinstance(node, FunctionDef) and getattr(node, 'is_lambda', False): continue
             self.visit(node)
+
+        # 2.5 @[global_allocator]: its alloc/free/realloc back every heap allocation
+        allocators = [n for n in ast if isinstance(n, StructDef) and any(a == 'global_allocator' for a, _ in n.attrs)]
+        if len(allocators) > 1:
+            self.error("Semantic Error: More than one @[global_allocator] type", allocators[1])
+        for node in allocators:
+            self.struct_used[node.name] = True
+            methods = self.struct_methods.get(node.name, {})
+            for m in ('alloc', 'free', 'realloc'):
+                if m not in methods:
+                    self.error(f"Semantic Error: @[global_allocator] type '{node.name}' must define '{m}'", node)
+                for f in methods[m]: f.used = True
         
         # 3. Dead Code Analysis
         for name, funcs in self.function_defs.items():
@@ -517,7 +772,12 @@ class SemanticAnalyzer:
                   node.params[i] = (pname, self.resolve_type_name(self.mangle_type_if_local(ptype, prefix)))
         elif name == 'StructDef':
              node.fields = [(n, self.resolve_type_name(self.mangle_type_if_local(t, prefix))) for n, t in node.fields]
-             self.structs[node.name] = {n: self.resolve_type_name(self.mangle_type_if_local(t, prefix)) for n, t in node.fields}
+             if not node.generics:
+                  self.structs[node.name] = dict(node.fields)
+        elif name == 'EnumDef':
+             node.variants = [(v, [self.resolve_type_name(self.mangle_type_if_local(t, prefix)) for t in ps]) for v, ps in node.variants]
+             if not node.generics:
+                  self.enums[node.name] = dict(node.variants)
         elif name == 'TypeAlias':
              node.original_type = self.resolve_type_name(self.mangle_type_if_local(node.original_type, prefix))
              if prefix:
@@ -543,6 +803,9 @@ class SemanticAnalyzer:
 
     def mangle_type_if_local(self, type_name, prefix):
         if not type_name: return type_name
+        for sigil in ('&mut ', '&', '*'):
+            if type_name.startswith(sigil):
+                return sigil + self.mangle_type_if_local(type_name[len(sigil):], prefix)
         if '<' in type_name and type_name.endswith('>'):
              base = type_name.split('<', 1)[0]
              base = self.mangle_type_if_local(base, prefix)
@@ -571,11 +834,65 @@ class SemanticAnalyzer:
         visitor = getattr(self, method_name, self.generic_visit)
         return visitor(node)
 
+    def visit_stmt(self, node):
+        # A borrow taken inside a statement (`v.push(&x)`, `let n = len(&s)`)
+        # ends with it, unless the statement binds something that can hold
+        # on to it: a reference, a pointer or a non-scalar value
+        scope = self.scopes[-1]
+        start = len(scope.get('active_borrows', []))
+        t = self.visit(node)
+        if isinstance(node, (CallExpr, MethodCall)) and isinstance(t, str):
+            node.discarded_type = t  # CodeGen drops an unused result
+        borrows = scope.get('active_borrows', [])
+        if len(borrows) == start: return
+        if isinstance(node, VarDecl):
+            var = scope.get(node.name)
+            if not var or not self.is_scalar_type(var['type']): return
+        elif isinstance(node, Assignment):
+            t = getattr(node.target, 'type_name', None)
+            if isinstance(node.target, VariableExpr):
+                var = self.lookup(node.target.name)
+                t = var['type'] if var else None
+            if not self.is_scalar_type(t): return
+        self.end_borrows(start)
+
+    def end_borrows(self, start):
+        # Release the borrows the current scope took since `start`
+        borrows = self.scopes[-1].get('active_borrows', [])
+        for var_name, role in borrows[start:]:
+            var_info = self.lookup(var_name)
+            if var_info:
+                if role == 'reader': var_info['readers'] -= 1
+                elif role == 'writer': var_info['writer'] = False
+        del borrows[start:]
+
+    def visit_condition(self, node):
+        # `while (r.read_line(&mut line))`: the borrow ends with the test
+        start = len(self.scopes[-1].get('active_borrows', []))
+        t = self.visit(node)
+        self.end_borrows(start)
+        return t
+
+    def is_scalar_type(self, type_name):
+        return type_name in ('i32', 'i64', 'u64', 'u8', 'bool', 'f32', 'f64', 'char') or bool(self.simd_type(type_name or ''))
+
+    def visit_expecting(self, node, type_name):
+        # Lets Vec::new() or Option::None pick the generic arguments of the
+        # declared type they are bound to
+        prev = self.expected_type
+        self.expected_type = type_name
+        try:
+            return self.visit(node)
+        finally:
+            self.expected_type = prev
+
     def visit_ExternBlock(self, node): pass
     def visit_TraitDef(self, node): pass
     def visit_StructDef(self, node): pass
     def visit_EnumDef(self, node): pass
     def visit_ImplDef(self, node):
+        # Generic impls are templates: only their instances are checked
+        if node.generics: return
         prev_mod = self.current_module
         if getattr(node, 'module', None):
              self.current_module = node.module
@@ -613,10 +930,68 @@ class SemanticAnalyzer:
              # Update body
              self.substitute_generics(method.body, mapping)
              
+             self.impl_generics = {g[0] for g in (node.generics or [])}
              self.visit(method)
+             self.impl_generics = set()
         
         self.current_module = prev_mod
 
+    def is_module_function(self, name):
+        # `use std::io::write;` in main must not redirect calls to the
+        # `write` a std module defines or declares extern for itself
+        module = self.current_module
+        if not module or not isinstance(name, str): return False
+        if f"{module.replace('::', '_')}_{name}" in self.functions: return True
+        return any(getattr(d, 'is_extern', False) and getattr(d, 'module', None) == module for d in self.function_defs.get(name, []))
+
+    def generic_function_name(self, name):
+        # Mangled name of the generic function a call to `name` refers to:
+        # one of the current module's, a global one, or one brought in by `use`
+        if self.current_module:
+            local = f"{self.current_module.replace('::', '_')}_{name}"
+            if local in self.generic_functions: return local
+        if name in self.generic_functions: return name
+        target = self.aliases.get(name)
+        if isinstance(target, str) and target.replace('::', '_') in self.generic_functions:
+            return target.replace('::', '_')
+        return None
+
+    def check_generic_function_call(self, node, name, callee):
+        # channel::<i64>(16), or block_on(f) with the type arguments inferred
+        # from the arguments and the type the result is bound to
+        def_node = self.generic_functions[name]
+        names = [g[0] for g in def_node.generics]
+        arg_types = None
+        if '<' in callee:
+            targs = [self.resolve_type_name(a.strip()) for a in self.split_generic_args(callee[callee.find('<')+1:-1])]
+        else:
+            arg_types = [self.visit(a) for a in node.args]
+            bindings = {}
+            for (_, ptype), atype in zip(def_node.params, arg_types):
+                self.unify_types(ptype, atype, names, bindings)
+            if self.expected_type:
+                self.unify_types(def_node.return_type, self.expected_type, names, bindings)
+            if any(g not in bindings for g in names):
+                self.error(f"Type Error: cannot infer the type arguments of '{callee}'", node, hint=f"write {callee}::<...>(...)", error_code="E0002")
+            targs = [bindings[g] for g in names]
+        if len(targs) != len(names):
+            self.error(f"Type Error: '{callee}' takes {len(names)} type arguments, got {len(targs)}", node, error_code="E0002")
+        instance = f"{name}<{','.join(targs)}>"
+        self.instantiate_generic_function(instance)
+        if instance not in self.functions:
+            self.error(f"Type Error: '{callee}' needs concrete type arguments", node, error_code="E0002")
+        if arg_types is None:
+            params = self.function_defs[instance][0].params
+            arg_types = [self.visit_expecting(a, pt) for a, (_, pt) in zip(node.args, params)]
+        func_def, mangled_name = self.resolve_overload(instance, arg_types, node)
+        node.callee = mangled_name
+        func_def.used = True
+        self.check_thread_send(func_def, node)
+        for arg, arg_t in zip(node.args, arg_types):
+            if isinstance(arg, VariableExpr) and not self.is_copy_type(arg_t):
+                self.move_var(arg.name)
+        return func_def.return_type
+
     def visit_UseStmt(self, node):
         full_name = "::".join(node.path)
         if node.is_glob:
@@ -670,30 +1045,42 @@ class SemanticAnalyzer:
                        self.error(f"Semantic Error: Implementation of trait '{node.trait_name}' for '{struct_name}' is missing associated type '{assoc_type}'", node)
              self.impls.add((struct_name, node.trait_name))
              
-        # Resolve associated types and Self in signatures
-        mapping = {"Self": struct_name}
+        # Resolve associated types and Self in signatures. In a generic impl
+        # Self is the struct applied to the impl's own parameters (Vec<T>).
+        impl_generics = [g[0] for g in node.generics]
+        self_type = f"{struct_name}<{','.join(impl_generics)}>" if impl_generics else struct_name
+        mapping = {"Self": self_type}
         if hasattr(node, 'associated_types'):
             for assoc_name, assoc_type in node.associated_types.items():
                  mapping[f"Self_{assoc_name}"] = assoc_type
 
         for method in node.methods:
+             # Handle self parameters BEFORE submap (which strips spaces and maps Self)
+             if method.params:
+                  pname, ptype = method.params[0]
+                  if pname == 'self':
+                       if ptype == 'Self': method.params[0] = ('self', self_type)
+                       elif ptype.replace(' ', '') in ('&Self', '&mutSelf'): method.params[0] = ('self', f"{self_type}*")
+
              # Update signature
              method.return_type = self.apply_submap(method.return_type, mapping)
              new_params = []
              for pn, pt in method.params:
                   new_params.append((pn, self.apply_submap(pt, mapping)))
              method.params = new_params
-             
-             if method.params:
-                  pname, ptype = method.params[0]
-                  if pname == 'self':
-                       if ptype == 'Self': method.params[0] = ('self', struct_name)
-                       elif ptype in ('&Self', '&mut Self'): method.params[0] = ('self', f"{struct_name}*")
-             
+
              if method.name not in self.struct_methods[struct_name]:
                  self.struct_methods[struct_name][method.name] = []
              self.struct_methods[struct_name][method.name].append(method)
-             
+
+             if impl_generics or method.generics:
+                  # A template: each receiver type / set of method type
+                  # arguments gets its own copy (see instantiate_method)
+                  method.template_of = (struct_name, method.name, impl_generics, getattr(node, 'module', ''))
+                  method.impl_bounds = [(g[0], g[1]) for g in node.generics if isinstance(g[1], str) and g[1]]
+                  method.instances = {}
+                  continue
+
              # Also register in global function defs for direct calls (Type_method)
              mangled_base = f"{struct_name}_{method.name}"
              method.name = mangled_base # Update method name to mangled base
@@ -703,6 +1090,10 @@ class SemanticAnalyzer:
              self.functions.add(mangled_base)
 
     def check_trait_impl(self, type_name, trait_name):
+        trait_name = trait_name.split('<')[0]  # F: Future<T>
+        if trait_name == 'Copy':
+            # Marker bound: primitives, pointers and @[derive(Copy)] types
+            return self.is_copy_type(type_name)
         if (type_name, trait_name) in self.impls: return True
         if '<' in type_name:
              base = type_name.split('<')[0]
@@ -736,8 +1127,19 @@ class SemanticAnalyzer:
 
     def visit_MethodCall(self, node):
         receiver_type = self.visit(node.receiver)
-        base_type = receiver_type.lstrip('&').replace('mut ', '').rstrip('*')
+        base_type = receiver_type
+        if base_type.startswith('&mut'): base_type = base_type[4:].lstrip()
+        base_type = base_type.lstrip('&').rstrip('*')
         lookup_type = base_type.split('<')[0] if '<' in base_type else base_type
+        if self.simd_type(base_type):
+            return self.check_simd_method(node, base_type)
+
+        # Receiver is a bare impl type parameter (e.g. `iter: I`): the call can
+        # only be resolved once the impl is instantiated, so defer it.
+        if base_type in self.impl_generics:
+            for arg in node.args: self.visit(arg)
+            node.deferred = True
+            return '_'
             
         if lookup_type not in self.struct_methods:
             raise Exception(f"Semantic Error: Type '{base_type}' has no methods")
@@ -749,42 +1151,23 @@ class SemanticAnalyzer:
             self.error(f"Method '{node.method_name}' not found on type '{base_type}'", node, hint=hint, error_code="E0005")
         
         arg_types = [self.visit(arg) for arg in node.args]
-        
-        # Overload resolution for methods
-        candidates = methods[node.method_name]
-        best_cand = None
-        
-        # 1. Exact match
-        for cand in candidates:
-            method_params = cand.params[1:] if cand.params and cand.params[0][0] == 'self' else cand.params
-            if len(method_params) != len(arg_types): continue
-            match = True
-            for (pname, ptype), atype in zip(method_params, arg_types):
-                if ptype != atype:
-                    match = False; break
-            if match:
-                best_cand = cand; break
-        
-        # 2. Match with compatibility/coercion
-        if not best_cand:
-            for cand in candidates:
-                method_params = cand.params[1:] if cand.params and cand.params[0][0] == 'self' else cand.params
-                if len(method_params) != len(arg_types): continue
-                match = True
-                for (pname, ptype), atype in zip(method_params, arg_types):
-                    if not self.check_type_compatibility(ptype, atype, node):
-                        match = False; break
-                if match:
-                    best_cand = cand; break
-        
+
+        # Overload resolution for methods; templates are instantiated for
+        # the receiver's type arguments first
+        owner = base_type if '<' in base_type else lookup_type
+        candidates = [self.instantiate_method(owner, cand, arg_types, node) if hasattr(cand, 'template_of') else cand
+                      for cand in methods[node.method_name]]
+        best_cand = self.select_overload([c for c in candidates if c is not None], arg_types, node)
+
         if not best_cand:
             self.error(f"No overload of method '{node.method_name}' on type '{base_type}' matches arguments: ({', '.join(arg_types)})", node)
 
+        if best_cand.name.startswith(f"{owner}_"): lookup_type = owner
         node.struct_type = lookup_type
         node.receiver_type = receiver_type
         node.method_def = best_cand # Store for codegen
         best_cand.used = True
-        
+
         # Mangle name
         node.method_name = self.get_mangled_name(f"{lookup_type}_{node.method_name}", best_cand.params)
         
@@ -829,6 +1212,10 @@ class SemanticAnalyzer:
             inner = obj_type[len("Slice<"):-1]
             node.type_name = inner
             return inner
+        if self.simd_type(obj_type):
+            # A lane of a SIMD vector
+            node.type_name = self.simd_type(obj_type)[0]
+            return node.type_name
         raise Exception(f"Type Error: Indexing non-array type '{obj_type}'")
 
     def visit_UnaryExpr(self, node):
@@ -860,12 +1247,16 @@ class SemanticAnalyzer:
             node.type_name = f"{t}*"
             return node.type_name
         elif node.op == '!':
+            if self.simd_type(t) and self.simd_type(t)[0] == 'bool':
+                node.type_name = t
+                return t
             if t != 'bool':
                 raise Exception(f"Type Error: Logical NOT requires bool, got {t}")
             node.type_name = 'bool'
             return 'bool'
         elif node.op == '-':
-            if t not in ('i32', 'i64', 'f32'):
+            simd = self.simd_type(t)
+            if t not in ('i32', 'i64', 'f32', 'f64') and not (simd and simd[0] != 'bool'):
                 raise Exception(f"Type Error: Negation requires numeric type, got {t}")
             node.type_name = t
             return t
@@ -873,6 +1264,11 @@ class SemanticAnalyzer:
 
     def visit_MatchExpr(self, node):
         expr_type = self.visit(node.value)
+        # Matching through a reference (match (self) in a &self method)
+        # binds views of the payloads rather than taking them
+        node.by_ref = expr_type.endswith('*') or expr_type.startswith('&')
+        if node.by_ref:
+             expr_type = expr_type[4:] if expr_type.startswith('&mut') else expr_type.lstrip('&').rstrip('*')
         node.enum_name = expr_type # Set for codegen
         if expr_type and '<' in expr_type: self.instantiate_generic_type(expr_type)
         
@@ -886,19 +1282,23 @@ class SemanticAnalyzer:
              variants = {vname: payloads for vname, payloads in enum_def.variants}
         else:
              raise Exception(f"Match expression must be an Enum. Type: {expr_type}")
-             
+        node.payload_types = list(variants.items())
+
         covered = set()
         for case in node.cases:
-            if case.variant_name not in variants: raise Exception(f"Enum has no variant '{case.variant_name}'")
+            if case.variant_name == '_' and not case.var_names:
+                # Wildcard arm: every variant not matched above
+                covered.update(variants)
+            elif case.variant_name not in variants: raise Exception(f"Enum has no variant '{case.variant_name}'")
             covered.add(case.variant_name)
             self.enter_scope()
             if case.var_names:
                 payloads = variants[case.variant_name]
                 if len(case.var_names) != len(payloads): raise Exception("Payload mismatch")
                 for i, vname in enumerate(case.var_names): self.declare_variable(vname, payloads[i])
-            self.visit(case.body)
+            self.visit_stmt(case.body)
             self.exit_scope()
-        if len(covered) != len(variants):
+        if not set(variants) <= covered:
              raise Exception("Match not exhaustive")
 
     def generic_visit(self, node):
@@ -935,6 +1335,7 @@ class SemanticAnalyzer:
         if is_concrete:
              self.structs[name] = dict(new_fields)
              self.ast_root.append(StructDef(name, new_fields))
+             self.instantiate_drop(name)
 
     def instantiate_generic_enum(self, name):
         if name in self.enums: return
@@ -959,6 +1360,7 @@ class SemanticAnalyzer:
         if is_concrete:
              self.enums[name] = {v: ps for v, ps in new_variants}
              self.ast_root.append(EnumDef(name, new_variants))
+             self.instantiate_drop(name)
 
     def instantiate_generic_function(self, name):
         if name in self.functions: return
@@ -975,8 +1377,8 @@ class SemanticAnalyzer:
         prev_mod = self.current_module
         if getattr(def_node, 'module', None): self.current_module = def_node.module
         
-        new_params = [(pn, self.resolve_type_name(self.apply_submap(pt, mapping))) for pn, pt in def_node.params]
-        new_ret = self.resolve_type_name(self.apply_submap(def_node.return_type, mapping))
+        new_params = [(pn, self.resolve_type_name(self.substitute_type(pt, mapping))) for pn, pt in def_node.params]
+        new_ret = self.resolve_type_name(self.substitute_type(def_node.return_type, mapping))
         
         for _, pty in new_params: self.instantiate_generic_type(pty)
         self.instantiate_generic_type(new_ret)
@@ -991,21 +1393,152 @@ class SemanticAnalyzer:
         is_concrete = all(self.is_deeply_concrete(arg) for arg in args)
         if is_concrete:
              new_func = FunctionDef(name, new_params, new_ret, new_body, def_node.is_kernel)
+             new_func.source_file = getattr(def_node, 'source_file', None)
+             new_func.module = getattr(def_node, 'module', None)
              self.ast_root.append(new_func)
              self.functions.add(name)
              if name not in self.function_defs:
                  self.function_defs[name] = []
              self.function_defs[name].append(new_func)
 
+    def select_overload(self, candidates, arg_types, node):
+        # Exact parameter types first, then with coercions
+        for exact in (True, False):
+            for cand in candidates:
+                method_params = cand.params[1:] if cand.params and cand.params[0][0] == 'self' else cand.params
+                if len(method_params) != len(arg_types): continue
+                if all(ptype == atype if exact else self.check_type_compatibility(ptype, atype, node)
+                       for (_, ptype), atype in zip(method_params, arg_types)):
+                    return cand
+        return None
+
+    def instantiate_method(self, owner, template, arg_types, node):
+        # Copy of a generic impl's method (or of a generic method) for the
+        # receiver type `owner` (Vec<i32>): impl parameters come from the
+        # receiver, method parameters are inferred from the arguments and
+        # from fn-type bounds (F: fn(T) -> U). The copy is named after the
+        # owner and analyzed and emitted like any other impl method.
+        struct_name, method_name, impl_generics, module = template.template_of
+        mapping = {}
+        if impl_generics:
+            if '<' not in owner: return None
+            args = self.split_generic_args(owner[owner.find('<')+1:-1])
+            if len(args) != len(impl_generics): return None
+            mapping = dict(zip(impl_generics, args))
+            for gname, bound in getattr(template, 'impl_bounds', []):
+                if not self.check_trait_impl(mapping[gname], bound):
+                    self.error(f"Type Error: method '{method_name}' on '{owner}' needs {gname}: {bound}, which '{mapping[gname]}' is not", node,
+                               hint="borrow the value through a pointer (as_ptr()) instead", error_code="E0002")
+        params = template.params[1:] if template.params and template.params[0][0] == 'self' else template.params
+        if len(params) != len(arg_types): return None
+
+        prev_mod = self.current_module
+        self.current_module = module
+        if template.generics:
+            names = [g[0] for g in template.generics]
+            fn_bounded = [g for g, bound, _ in template.generics if isinstance(bound, str) and bound.replace(' ', '').startswith('fn(')]
+            bindings = {}
+            for i, ((_, ptype), atype) in enumerate(zip(params, arg_types)):
+                arg = node.args[i] if node is not None and i < len(getattr(node, 'args', [])) else None
+                if ptype in fn_bounded and isinstance(arg, LambdaExpr):
+                    # F: fn(T) -> U given a lambda binds to the lambda's own type
+                    atype = arg.lambda_name
+                self.unify_types(self.substitute_type(ptype, mapping), atype, names, bindings)
+            for gname, bound, _ in template.generics:
+                if isinstance(bound, str) and bound.replace(' ', '').startswith('fn(') and gname in bindings:
+                    bound = self.resolve_type_name(self.substitute_type(bound, mapping))
+                    self.unify_types(bound, bindings[gname], names, bindings)
+            if self.expected_type and any(g not in bindings for g in names):
+                # let z: Zip<I, J, i32, i32> = a.zip(b): the rest comes from the declared type
+                self.unify_types(self.resolve_type_name(self.substitute_type(template.return_type, mapping)), self.expected_type, names, bindings)
+            missing = [g for g in names if g not in bindings]
+            if missing:
+                self.current_module = prev_mod
+                self.error(f"Type Error: cannot infer {', '.join(missing)} for method '{method_name}' on '{owner}'", node,
+                           hint="pass a closure with typed parameters and return type", error_code="E0002")
+            mapping.update({g: bindings[g] for g in names})
+
+        key = (owner, tuple(sorted(mapping.items())))
+        if key not in template.instances:
+            method = copy.deepcopy(template)
+            method.generics = []
+            method.name = f"{owner}_{method_name}"
+            method.params = [(pn, self.resolve_type_name(self.substitute_type(pt, mapping))) for pn, pt in method.params]
+            method.return_type = self.resolve_type_name(self.substitute_type(method.return_type, mapping))
+            self.substitute_generics(method.body, mapping)
+            del method.template_of, method.instances
+            method.module = module
+            template.instances[key] = method
+
+            self.struct_methods.setdefault(owner, {}).setdefault(method_name, []).append(method)
+            self.function_defs.setdefault(method.name, []).append(method)
+            self.functions.add(method.name)
+            impl = ImplDef(owner, [method])
+            impl.module = module
+            self.ast_root.append(impl)
+            for _, pty in method.params: self.instantiate_generic_type(pty)
+            self.instantiate_generic_type(method.return_type)
+        self.current_module = prev_mod
+        return template.instances[key]
+
+    def instantiate_drop(self, type_name):
+        # Destructors run implicitly, so they are instantiated with the type
+        base = type_name.split('<')[0]
+        for template in self.struct_methods.get(base, {}).get('drop', []):
+            if hasattr(template, 'template_of'):
+                self.instantiate_method(type_name, template, [], None)
+
+    def unify_types(self, pattern, actual, names, bindings):
+        # Binds the type parameters `names` occurring in `pattern` so that it
+        # matches `actual`; returns False on a structural mismatch.
+        p, a = pattern.replace(' ', ''), actual.replace(' ', '')
+        if p in names:
+            bindings.setdefault(p, a)
+            return True
+        if p.startswith('&'):
+            inner = p[4:] if p.startswith('&mut') else p[1:]
+            if a.endswith('*'): return self.unify_types(inner, a[:-1], names, bindings)
+            if a.startswith('&'): return self.unify_types(inner, a[4:] if a.startswith('&mut') else a[1:], names, bindings)
+            return False
+        if p.endswith('*'):
+            return a.endswith('*') and self.unify_types(p[:-1], a[:-1], names, bindings)
+        if p.startswith('fn('): a = self.closure_signature(a) or a
+        if p.startswith('fn(') and a.startswith('fn('):
+            p_args, p_ret = self.split_fn_type(p)
+            a_args, a_ret = self.split_fn_type(a)
+            if len(p_args) != len(a_args): return False
+            return all([self.unify_types(pa, aa, names, bindings) for pa, aa in zip(p_args + [p_ret], a_args + [a_ret])])
+        if '<' in p and p.endswith('>') and '<' in a and a.endswith('>'):
+            if p.split('<', 1)[0] != a.split('<', 1)[0]: return False
+            p_args = self.split_generic_args(p[p.find('<')+1:-1])
+            a_args = self.split_generic_args(a[a.find('<')+1:-1])
+            if len(p_args) != len(a_args): return False
+            return all([self.unify_types(pa, aa, names, bindings) for pa, aa in zip(p_args, a_args)])
+        return p == a
+
+    def infer_instance(self, base, patterns, arg_types, generics):
+        # Concrete instance of generic struct/enum `base` whose fields (or a
+        # variant's payloads) `patterns` are given values of `arg_types`
+        names = [g[0] for g in generics]
+        bindings = {}
+        for ptype, atype in zip(patterns, arg_types):
+            self.unify_types(ptype, atype, names, bindings)
+        expected = self.expected_type
+        if expected and expected.split('<')[0] == base and '<' in expected:
+            for g, a in zip(names, self.split_generic_args(expected[expected.find('<')+1:-1])):
+                bindings.setdefault(g, a)
+        if any(g not in bindings for g in names): return None
+        return f"{base}<{','.join(bindings[g] for g in names)}>"
+
     def visit_IfStmt(self, node):
-        if self.visit(node.condition) != 'bool': raise Exception("If condition must be bool")
+        if self.visit_condition(node.condition) != 'bool': raise Exception("If condition must be bool")
         self.enter_scope()
-        for s in node.then_branch: self.visit(s)
+        for s in node.then_branch: self.visit_stmt(s)
         self.exit_scope()
         
         if node.else_branch:
              self.enter_scope()
-             for s in node.else_branch: self.visit(s)
+             for s in node.else_branch: self.visit_stmt(s)
              self.exit_scope()
 
     def visit_ForStmt(self, node):
@@ -1028,7 +1561,13 @@ class SemanticAnalyzer:
             method = methods.get('next')
             if not method:
                  raise Exception(f"Type '{coll_type}' does not implement 'next()'")
-                 
+            if isinstance(method, list): method = method[0] # overload list
+            if hasattr(method, 'template_of'):
+                 method = self.instantiate_method(coll_type, method, [], node)
+                 args = []
+            method.used = True
+            node.next_func = self.get_mangled_name(method.name, method.params)
+
             ret_type = method.return_type
             
             real_ret = ret_type
@@ -1050,23 +1589,24 @@ class SemanticAnalyzer:
                  raise Exception(f"Iterator next() must return Option<T>, got {real_ret}")
             
             node.item_type = item_type # Store for codegen
+            node.items_borrowed = self.iterator_borrows_items(coll_type)
             
             self.declare_variable(node.var_name, item_type, node=node)
-            for s in node.body: self.visit(s)
+            for s in node.body: self.visit_stmt(s)
         else:
             if self.visit(node.start_expr) != 'i32' or self.visit(node.end_expr) != 'i32': 
                 raise Exception("For loop range must be i32")
             self.declare_variable(node.var_name, 'i32', node=node)
-            for s in node.body: self.visit(s)
+            for s in node.body: self.visit_stmt(s)
             
         self.loop_stack.pop()
         self.exit_scope()
 
     def visit_WhileStmt(self, node):
-        if self.visit(node.condition) != 'bool': raise Exception("While condition must be bool")
+        if self.visit_condition(node.condition) != 'bool': raise Exception("While condition must be bool")
         self.loop_stack.append(node.label)
         self.enter_scope()
-        for s in node.body: self.visit(s)
+        for s in node.body: self.visit_stmt(s)
         self.loop_stack.pop()
         self.exit_scope()
 
@@ -1104,8 +1644,8 @@ class SemanticAnalyzer:
             if '<' in pt: self.instantiate_generic_type(pt)
             self.declare_variable(pn, pt, node=node)
         
-        # Mangle name for overloading (except main and externs)
-        if node.name != 'main' and not node.name.endswith('::main') and node.body is not None:
+        # Mangle name for overloading (except main, externs and lambdas, whose names are unique)
+        if node.name != 'main' and not node.name.endswith('::main') and node.body is not None and not getattr(node, 'is_lambda', False):
             node.name = self.get_mangled_name(node.name, node.params)
             self.functions.add(node.name) # Add mangled name to known functions
             
@@ -1116,7 +1656,7 @@ class SemanticAnalyzer:
             # For now, let's just make sure it's valid.
             pass
 
-        for s in node.body: self.visit(s)
+        for s in node.body: self.visit_stmt(s)
         self.exit_scope()
         self.current_function = None
         self.current_module = prev_mod
@@ -1124,6 +1664,14 @@ class SemanticAnalyzer:
     def check_type_compatibility(self, expected, actual, node):
         if expected == actual:
             return True
+
+        # '_' is the result of a deferred call inside a generic body
+        if actual == '_' or expected == '_':
+            return True
+
+        # A closure type is called as its fn type; it only ever holds its lambda
+        if self.closure_signature(actual) == expected or (expected.startswith('__lambda_') and self.closure_signature(expected) == actual):
+            return True
             
         # Handle Generics (e.g. Vec<T> == Vec<i32> if T is generic in current context? No, that's already handled elsewhere)
         if '<' in expected and '<' in actual:
@@ -1131,39 +1679,59 @@ class SemanticAnalyzer:
                   return True
                   
         # Coercion
-        numeric_types = ('i32', 'i64', 'u8', 'f32')
+        numeric_types = ('i32', 'i64', 'u8', 'f32', 'f64')
         if expected in numeric_types and actual in numeric_types:
              # Upcasts (allowed, no warning usually, or maybe warning if we want to be strict)
              if (expected == 'i64' and actual == 'i32') or (expected == 'i64' and actual == 'u8') or (expected == 'i32' and actual == 'u8'):
                   return True
              if (expected == 'f32' and actual in ('i32', 'i64', 'u8')):
                   return True
+             if (expected == 'f64' and actual in ('f32', 'i32', 'i64', 'u8')):
+                  return True
              
              # Downcasts (warning for potential precision loss)
              if (expected == 'i32' and actual == 'i64') or (expected == 'u8' and actual in ('i32', 'i64', 'i32')):
                   self.warnings.append((f"Potential precision loss: coercing {actual} to {expected}", node.line, node.column))
                   return True
-             if (expected in ('i32', 'i64', 'u8') and actual == 'f32'):
+             if (expected == 'f32' and actual == 'f64'):
+                  self.warnings.append((f"Potential precision loss: coercing {actual} to {expected}", node.line, node.column))
+                  return True
+             if (expected in ('i32', 'i64', 'u8') and actual in ('f32', 'f64')):
                   self.warnings.append((f"Potential precision loss: coercing {actual} to {expected} (float to int)", node.line, node.column))
                   return True
                   
+        # Task<T> is a frame handle; executors take it as a raw pointer
+        if expected in ('u8*', '*u8') and actual.startswith('Task<'):
+             return True
+
         # String to u8* or i8* coercion
         if expected in ('u8*', 'i8*', '*u8', '*i8') and actual == 'string':
              return True
         if expected == 'string' and actual in ('u8*', 'i8*', '*u8', '*i8'):
              return True
 
+        # References lower to pointers: &T / &mut T accept a borrowed T*
+        if expected.startswith('&') and actual.endswith('*'):
+             inner = expected[1:].replace(' ', '')
+             if inner + '*' == actual or (inner.startswith('mut') and inner[3:] + '*' == actual):
+                  return True
+
         return False
 
     def visit_VarDecl(self, node):
         if node.type_name: node.type_name = self.resolve_type_name(node.type_name)
-        init_t = self.visit(node.initializer)
+        init_t = self.visit_expecting(node.initializer, node.type_name)
         if node.type_name is None: node.type_name = init_t
         if '<' in node.type_name: self.instantiate_generic_type(node.type_name)
         if init_t != node.type_name and not self.check_type_compatibility(node.type_name, init_t, node):
              self.error(f"Type Error: {init_t} != {node.type_name}", node, error_code="E0002")
         if isinstance(node.initializer, VariableExpr) and not self.is_copy_type(init_t): self.move_var(node.initializer.name)
         self.declare_variable(node.name, node.type_name, node=node)
+        if isinstance(node.initializer, UnaryExpr) and node.initializer.op in ('&', '&mut'):
+            self.scopes[-1][node.name]['is_ref'] = True
+        if isinstance(node.initializer, LambdaExpr):
+            # Remembered so thread sends can check what the closure captures
+            self.scopes[-1][node.name]['lambda'] = node.initializer
 
     def visit_Assignment(self, node):
         val_t = self.visit(node.value)
@@ -1176,22 +1744,31 @@ class SemanticAnalyzer:
              v['moved'] = False
         else:
              target_t = self.visit(node.target)
+             if isinstance(node.target, IndexAccess) and not isinstance(node.target.object, VariableExpr) \
+                     and self.simd_type(self.visit(node.target.object)):
+                  self.error("Type Error: only a vector variable's lanes can be assigned", node, hint="use v.replace(i, x)", error_code="E0002")
              if target_t != val_t and not self.check_type_compatibility(target_t, val_t, node):
                   self.error("Type mismatch in assignment", node, error_code="E0002")
         if isinstance(node.value, VariableExpr) and not self.is_copy_type(val_t): self.move_var(node.value.name)
 
     def visit_BinaryExpr(self, node):
         l, r = self.visit(node.left), self.visit(node.right)
+        if self.simd_type(l) or self.simd_type(r):
+            return self.check_simd_binary(node, l, r)
         if node.op in ('PLUS', 'MINUS'):
             if l.endswith('*') and r in ('i32', 'i64'): return l
             if r.endswith('*') and l in ('i32', 'i64') and node.op == 'PLUS': return r
         if l != r and not self.check_type_compatibility(l, r, node) and not self.check_type_compatibility(r, l, node):
             self.error(f"Type mismatch: {l} {node.op} {r}", node, error_code="E0002")
-        if node.op in ('PLUS', 'MINUS', 'STAR', 'SLASH', 'PERCENT'): return l
+        if node.op in ('PLUS', 'MINUS', 'STAR', 'SLASH', 'PERCENT'):
+            if r == 'f64' and l == 'f32': return r
+            return l
         if node.op in ('EQEQ', 'LT', 'GT', 'LTE', 'GTE', 'NEQ', 'AND', 'OR'): return 'bool'
         raise Exception("Unsupported binary op")
 
-    def visit_IntegerLiteral(self, node): return 'i32'
+    def visit_IntegerLiteral(self, node):
+        if -2**31 <= node.value < 2**31: return 'i32'
+        return 'i64'
     def visit_FloatLiteral(self, node): return 'f32'
     def visit_BooleanLiteral(self, node): return 'bool'
     def visit_StringLiteral(self, node): return 'string'
@@ -1213,6 +1790,7 @@ class SemanticAnalyzer:
         func_node = FunctionDef(lambda_name, resolved_params, ret_type, node.body, is_pub=True)
         func_node.lambda_node = node
         func_node.is_lambda = True
+        func_node.source_file = getattr(self.current_function, 'source_file', None)
         func_node.line = node.line
         func_node.column = node.column
         
@@ -1242,6 +1820,11 @@ class SemanticAnalyzer:
             prefix = self.resolve_type_name(parts[0])
             suffix = parts[1]
             node.name = f"{prefix}::{suffix}"
+            expected = self.expected_type
+            if prefix in self.generic_enums and expected and '<' in expected and expected.split('<')[0] == prefix:
+                 # Option::None bound to a declared Option<i32>
+                 prefix = expected
+                 node.name = f"{prefix}::{suffix}"
             if '<' in prefix: self.instantiate_generic_type(prefix)
             if prefix in self.enums:
                  variants = self.enums[prefix]
@@ -1282,6 +1865,7 @@ class SemanticAnalyzer:
         return v['type']
 
     def process_fn_call(self, node, callee_type):
+        callee_type = self.closure_signature(callee_type) or callee_type
         if not callee_type.startswith('fn('):
              raise Exception(f"Type Error: Cannot call non-function type '{callee_type}'")
         main_part, _, ret_type = callee_type.rpartition(')->')
@@ -1297,25 +1881,39 @@ class SemanticAnalyzer:
              name = node.callee.name
              v = self.lookup(name)
              if v:
-                  return self.process_fn_call(node, v['type'])
+                  # visited as a variable so a lambda records it as a capture
+                  return self.process_fn_call(node, self.visit(node.callee))
              node.callee = name
         
         callee = node.callee
-        if callee in self.aliases:
+        if isinstance(callee, str) and '::' not in callee.split('<')[0]:
+            generic = self.generic_function_name(callee.split('<')[0])
+            if generic:
+                return self.check_generic_function_call(node, generic, callee)
+        if callee in self.aliases and not self.is_module_function(callee):
             callee = self.aliases[callee]
             node.callee = callee
+        if isinstance(callee, str) and self.simd_type(callee.split('::')[0]):
+            return self.check_simd_call(node, callee)
         
         # Handle built-in intrinsics and special internal functions
-        if callee in ('print', 'panic', 'assert', 'slice_from_array', 'fs::read_file', 'fs::write_file', 'fs::append_file', 'malloc', 'free', 'realloc', 'memcpy', '__nexa_panic', '__nexa_assert', 'gpu::dispatch', 'gpu::global_id'):
+        if callee in ('print', 'panic', 'assert', 'slice_from_array', 'fs::read_file', 'fs::write_file', 'fs::append_file', 'malloc', 'free', 'realloc', 'memcpy', '__nexa_panic', '__nexa_assert', 'gpu::dispatch', 'gpu::bind', 'gpu::global_id'):
             if callee == 'gpu::dispatch':
-                # O primeiro argumento de gpu::dispatch é um nome de função (kernel), não uma variável
-                if len(node.args) > 0:
-                    # Skip visit para o primeiro arg se for o nome do kernel
-                    for i in range(1, len(node.args)):
-                        self.visit(node.args[i])
-                return 'void'
+                return self.check_gpu_dispatch(node)
+            if callee == 'gpu::bind':
+                return self.check_gpu_bind(node)
             
-            for a in node.args: self.visit(a)
+            arg_types = [self.visit(a) for a in node.args]
+            if callee == 'slice_from_array':
+                # slice_from_array(&arr) views a [T:N] array as a []T
+                t = arg_types[0] if len(arg_types) == 1 else ''
+                t = t[:-1] if t.endswith('*') else t
+                if not (t.startswith('[') and ':' in t):
+                    self.error(f"Type Error: slice_from_array expects &[T:N], got {arg_types}", node, error_code="E0002")
+                slice_type = f"Slice<{t[1:t.rfind(':')]}>"
+                self.instantiate_generic_type(slice_type)
+                node.type_name = slice_type
+                return slice_type
             if callee == 'fs::read_file': 
                 self.instantiate_generic_type('Buffer<u8>')
                 node.type_name = 'Buffer<u8>'
@@ -1342,24 +1940,64 @@ class SemanticAnalyzer:
                       for (gname, bound, is_const), gval in zip(struct_def.generics, args):
                            generics_mapping[gname] = gval
 
-            if prefix in self.enums:
+            base_prefix = prefix.split('<')[0]
+            arg_types = None
+            if base_prefix in self.generic_enums and '<' not in prefix:
+                 # Option::Some(x): the instance follows from the payload
+                 payloads = dict(self.generic_enums[base_prefix].variants).get(suffix)
+                 if payloads is None:
+                      self.error(f"Enum '{base_prefix}' has no variant '{suffix}'", node, error_code="E0004")
+                 arg_types = [self.visit(arg) for arg in node.args]
+                 instance = self.infer_instance(base_prefix, payloads, arg_types, self.generic_enums[base_prefix].generics)
+                 if not instance:
+                      self.error(f"Type Error: cannot infer the type arguments of '{prefix}::{suffix}'", node, hint=f"write {prefix}::<...>::{suffix}", error_code="E0002")
+                 self.instantiate_generic_type(instance)
+                 prefix = instance
+                 node.callee = f"{prefix}::{suffix}"
+
+            if prefix in self.enums and suffix in self.enums[prefix]:
+                # (other paths on an enum are its static methods)
                 variants = self.enums[prefix]
-                if suffix not in variants: raise Exception("Variant not found")
                 payloads = variants[suffix]
                 if len(node.args) != len(payloads): raise Exception("Arg mismatch")
                 self.enter_scope()
                 for i, arg in enumerate(node.args):
-                    if self.visit(arg) != payloads[i]: raise Exception("Type mismatch")
+                    arg_t = arg_types[i] if arg_types else self.visit_expecting(arg, payloads[i])
+                    if arg_t != payloads[i] and not self.check_type_compatibility(payloads[i], arg_t, node):
+                        self.error(f"Type Error: '{suffix}' expects {payloads[i]}, got {arg_t}", node, error_code="E0002")
                     if isinstance(arg, VariableExpr) and not self.is_copy_type(payloads[i]): self.move_var(arg.name)
                 self.exit_scope(); return prefix
-            
-            # Support variants of non-concrete generic enums
-            base_prefix = prefix.split('<')[0]
-            if base_prefix in self.generic_enums:
-                 # We can't type-check the payload thoroughly without instantiation,
-                 # but for now we accept it and return the prefix.
-                 for arg in node.args: self.visit(arg)
-                 return prefix
+
+            # Vec::<i32>::new(), or Vec::new() bound to a declared Vec<i32>:
+            # static methods of generic impls are instantiated for the type
+            templates = [m for m in self.struct_methods.get(base_prefix, {}).get(suffix, []) if hasattr(m, 'template_of')]
+            if templates:
+                 owner = prefix
+                 generic_owner = base_prefix in self.generic_structs or base_prefix in self.generic_enums
+                 arg_types = [self.visit(arg) for arg in node.args]
+                 if generic_owner and '<' not in owner:
+                      # Rc::new(cfg): the type arguments follow from the
+                      # arguments or from the declared type the result is bound to
+                      generic_def = self.generic_structs.get(base_prefix) or self.generic_enums.get(base_prefix)
+                      owner = None
+                      for t in templates:
+                           params = [pt for pn, pt in t.params if pn != 'self']
+                           if len(params) == len(arg_types):
+                                owner = self.infer_instance(base_prefix, params, arg_types, generic_def.generics)
+                                if owner: break
+                      if not owner:
+                           self.error(f"Type Error: cannot infer the type arguments of '{prefix}::{suffix}'", node, hint=f"write {prefix}::<...>::{suffix}", error_code="E0002")
+                      self.instantiate_generic_type(owner)
+                 candidates = [self.instantiate_method(owner, t, arg_types, node) for t in templates]
+                 func_def = self.select_overload([c for c in candidates if c is not None], arg_types, node)
+                 if not func_def:
+                      self.error(f"No overload of '{prefix}::{suffix}' matches arguments: ({', '.join(arg_types)})", node)
+                 func_def.used = True
+                 node.callee = self.get_mangled_name(func_def.name, func_def.params)
+                 for arg, arg_t in zip(node.args, arg_types):
+                      if isinstance(arg, VariableExpr) and not self.is_copy_type(arg_t):
+                           self.move_var(arg.name)
+                 return func_def.return_type
             
             # Check for mangled function or struct
             mangled_base = f"{prefix}_{suffix}"
@@ -1378,7 +2016,11 @@ class SemanticAnalyzer:
                  func_def, mangled_full = self.resolve_overload(mangled_base, arg_types, node)
                  node.callee = mangled_full
                  func_def.used = True
-                 
+                 self.check_thread_send(func_def, node)
+                 for arg, arg_t in zip(node.args, arg_types):
+                      if isinstance(arg, VariableExpr) and not self.is_copy_type(arg_t):
+                           self.move_var(arg.name)
+
                  ret = func_def.return_type
                  if generics_mapping: ret = self.apply_submap(ret, generics_mapping)
                  return ret
@@ -1406,8 +2048,32 @@ class SemanticAnalyzer:
                   self.visit(node.args[0])
                   if len(node.args) == 2: self.visit(node.args[1])
              return 'void'
-        if isinstance(callee, str) and callee.startswith('cast<'): self.visit(node.args[0]); return callee[5:-1]
-        if isinstance(callee, str) and callee.startswith('sizeof<'): return 'i32'
+        if isinstance(callee, str) and callee.startswith('cast<'):
+            src, dst = self.visit(node.args[0]), self.resolve_type_name(callee[5:-1])
+            node.callee = f"cast<{dst}>"
+            src_v, dst_v = self.simd_type(src), self.simd_type(dst)
+            if (src_v or dst_v) and not (src_v and dst_v and src_v[1] == dst_v[1]):
+                self.error(f"Type Error: cannot cast {src} to {dst}", node, hint="vectors convert lane by lane to a vector with the same lane count", error_code="E0002")
+            return dst
+        if isinstance(callee, str) and callee.startswith('sizeof<'):
+            node.callee = f"sizeof<{self.resolve_type_name(callee[7:-1])}>"
+            self.instantiate_generic_type(node.callee[7:-1])
+            return 'i32'
+        if isinstance(callee, str) and callee.startswith('ptr_offset<'):
+            for a in node.args: self.visit(a)
+            node.callee = f"ptr_offset<{self.resolve_type_name(callee[11:-1])}>"
+            return f"{node.callee[11:-1]}*"
+        if isinstance(callee, str) and '<' in callee and callee.split('<')[0] in self.ATOMIC_ARITY:
+            op = callee.split('<')[0]
+            type_name = self.resolve_type_name(callee[len(op)+1:-1])
+            node.callee = f"{op}<{type_name}>"
+            return self.check_atomic_intrinsic(op, type_name, node)
+        if callee == 'fence' and callee not in self.functions:
+            return self.check_atomic_intrinsic('fence', None, node)
+        if isinstance(callee, str) and callee.startswith('drop_in_place<'):
+            for a in node.args: self.visit(a)
+            node.callee = f"drop_in_place<{self.resolve_type_name(callee[14:-1])}>"
+            return 'void'
 
         # Try local module lookup if not found
         if callee not in self.functions and callee not in self.structs and '<' not in callee:
@@ -1429,7 +2095,7 @@ class SemanticAnalyzer:
              base = callee.split('<')[0]
              resolved_base = self.resolve_type_name(base)
              if resolved_base in self.generic_structs:
-                  callee = f"{resolved_base}<{callee[callee.find('<')+1:]}"
+                  callee = self.resolve_type_name(callee)
                   node.callee = callee
                   self.instantiate_generic_struct(callee)
 
@@ -1441,15 +2107,27 @@ class SemanticAnalyzer:
                  if base in self.generic_structs:
                       self.instantiate_generic_struct(struct_name)
             
+            arg_types = None
             if struct_name not in self.structs:
                  # Check if base exists but not instantiated
                  base = struct_name.split('<')[0] if '<' in struct_name else struct_name
-                 if base in self.generic_structs:
+                 if base in self.generic_structs and '<' not in struct_name:
+                      # Vec(ptr, 0, 0): the instance follows from the fields
+                      def_node = self.generic_structs[base]
+                      arg_types = [self.visit(a) for a in node.args]
+                      instance = self.infer_instance(base, [t for _, t in def_node.fields], arg_types, def_node.generics)
+                      if not instance:
+                           self.error(f"Type Error: cannot infer the type arguments of '{base}'", node, hint=f"write {base}::<...>(...)", error_code="E0002")
+                      self.instantiate_generic_struct(instance)
+                      struct_name = instance
+                      node.callee = instance
+                 elif base in self.generic_structs:
                       # Still not instantiated? maybe args are not concrete
                       # We return the generic type name
                       for a in node.args: self.visit(a)
                       return struct_name
-                 raise Exception(f"Semantic Error: Unknown struct '{struct_name}'")
+                 else:
+                      raise Exception(f"Semantic Error: Unknown struct '{struct_name}'")
 
             # Mark struct as used
             base_struct = struct_name.split('<')[0]
@@ -1460,7 +2138,7 @@ class SemanticAnalyzer:
             if len(node.args) != len(fields): raise Exception(f"Arg mismatch for '{struct_name}' constructor")
             self.enter_scope()
             for i, (fname, ftype) in enumerate(fields.items()):
-                arg_t = self.visit(node.args[i])
+                arg_t = arg_types[i] if arg_types else self.visit_expecting(node.args[i], ftype)
                 if arg_t != ftype: 
                     raise Exception(f"Type mismatch field '{fname}': expected {ftype}, got {arg_t}")
             self.exit_scope()
@@ -1477,6 +2155,7 @@ class SemanticAnalyzer:
             
             node.callee = mangled_name
             func_def.used = True
+            self.check_thread_send(func_def, node)
             
             # Re-visit args in scope if needed? No, already visited.
             # But we should check for moves if not copy.
@@ -1537,62 +2216,52 @@ class SemanticAnalyzer:
 
     def visit_BlockStmt(self, node):
         self.enter_scope()
-        for s in node.stmts: self.visit(s)
+        for s in node.stmts: self.visit_stmt(s)
         self.exit_scope()
 
     def visit_RegionStmt(self, node):
         self.enter_scope(); self.declare_variable(node.name, 'Arena', node=node)
-        for s in node.body: self.visit(s)
+        for s in node.body: self.visit_stmt(s)
         self.exit_scope()
 
     def visit_ReturnStmt(self, node):
         if node.value:
-            t = self.visit(node.value)
+            t = self.visit_expecting(node.value, self.current_function.return_type if self.current_function else None)
             if isinstance(node.value, VariableExpr) and not self.is_copy_type(t):
                  if '::' not in node.value.name:
                       self.move_var(node.value.name)
 
+    TYPE_ATTRS = ('type_name', 'return_type', 'struct_type', 'item_type', 'option_type', 'iterator_type', 'enum_name')
+
     def substitute_generics(self, node, mapping):
         if isinstance(node, list):
             for x in node: self.substitute_generics(x, mapping)
             return
         if not hasattr(node, '__dict__'): return
 
-        # 1. Update Type Annotations recursively
-        # We handle all attributes that might carry a type name string
-        for attr in ('type_name', 'struct_type', 'item_type', 'option_type', 'iterator_type', 'enum_name'):
-            if hasattr(node, attr):
-                val = getattr(node, attr)
-                if isinstance(val, str):
-                    setattr(node, attr, self.apply_submap(val, mapping))
-
-        if isinstance(node, CallExpr):
-            if isinstance(node.callee, str) and '<' in node.callee:
-                 node.callee = self.apply_submap(node.callee, mapping)
-            elif hasattr(node.callee, 'name'): # VariableExpr
-                 if '<' in node.callee.name:
-                      node.callee.name = self.apply_submap(node.callee.name, mapping)
-                 elif node.callee.name in mapping:
-                      node.callee.name = mapping[node.callee.name]
-
-        if hasattr(node, 'name') and not isinstance(node, (FunctionDef, StructDef, EnumDef)):
-             val = getattr(node, 'name')
-             if isinstance(val, str):
-                  if val in mapping:
-                       setattr(node, 'name', mapping[val])
-                  elif '<' in val:
-                       setattr(node, 'name', self.apply_submap(val, mapping))
-
-        # 2. Recurse on Children
+        # Type annotations, typed lambda parameters and turbofish paths
+        # (cast<T*>, Vec<T>::new) carry type names
+        for attr in self.TYPE_ATTRS:
+            if isinstance(getattr(node, attr, None), str):
+                setattr(node, attr, self.substitute_type(getattr(node, attr), mapping))
+        if isinstance(node, LambdaExpr):
+            node.params = [(pn, self.substitute_type(pt, mapping)) for pn, pt in node.params]
+        if isinstance(node, CallExpr) and isinstance(node.callee, str):
+            node.callee = self.substitute_type(node.callee, mapping)
+        if isinstance(node, VariableExpr) and ('<' in node.name or '::' in node.name or node.name in mapping):
+            node.name = self.substitute_type(node.name, mapping)
+
         for k, v in node.__dict__.items():
-            if k in ('type_name', 'struct_type', 'item_type', 'option_type', 'iterator_type', 'enum_name', 'callee', 'name', 'module'): continue 
-            if isinstance(v, (list, object)) and not isinstance(v, (str, int, bool, float)) and v is not None:
+            if k in self.TYPE_ATTRS or k in ('callee', 'name', 'module'):
+                if not hasattr(v, '__dict__'): continue
+            if isinstance(v, list) or hasattr(v, '__dict__'):
                 self.substitute_generics(v, mapping)
 
     def apply_submap(self, t, mapping):
         if not t: return t
         # Normalize: remove spaces
         t = t.replace(' ', '')
+        if t.startswith('fn('): return self.substitute_type(t, mapping)
         if t.startswith('&mut'): return '&mut' + self.apply_submap(t[4:], mapping)
         if t.startswith('&'): return '&' + self.apply_submap(t[1:], mapping)
         if t.endswith('*'): return self.apply_submap(t[:-1], mapping) + '*'
@@ -1602,14 +2271,39 @@ class SemanticAnalyzer:
             return f"{b}<{','.join(args)}>"
         return mapping.get(t, t)
 
+    def closure_signature(self, t):
+        # A lambda bound to an fn-bounded type parameter keeps a type of its
+        # own, named after its function (__lambda_3), so each closure gets its
+        # own instance. Returns the fn type it is called as, or None.
+        if not (isinstance(t, str) and t.startswith('__lambda_')): return None
+        func = self.function_defs.get(t)
+        if not isinstance(func, FunctionDef): return None
+        return f"fn({','.join(pt for _, pt in func.params)})->{func.return_type}"
+
+    def split_fn_type(self, t):
+        # 'fn(A,B)->R' -> (['A', 'B'], 'R')
+        depth = 0
+        for i, char in enumerate(t):
+            if char in '(<': depth += 1
+            elif char == ')' or (char == '>' and t[i-1] != '-'): depth -= 1
+            if depth == 0 and char == ')':
+                params, ret = t[3:i], t[i+1:]
+                break
+        return self.split_generic_args(params), ret[2:] if ret.startswith('->') else 'void'
+
+    def substitute_type(self, t, mapping):
+        # Replace whole identifiers, so T in *T, Vec<T> or fn(T)->U
+        if not t or not mapping: return t
+        return re.sub(r'[A-Za-z_][A-Za-z0-9_]*', lambda m: mapping.get(m.group(0), m.group(0)), t)
+
     def split_generic_args(self, s):
         args = []
         depth = 0
         current = ""
         for char in s:
-            if char == '<': depth += 1
-            elif char == '>': depth -= 1
-            
+            if char in '<(': depth += 1
+            elif char == ')' or (char == '>' and not current.endswith('-')): depth -= 1
+
             if char == ',' and depth == 0:
                 args.append(current.strip())
                 current = ""